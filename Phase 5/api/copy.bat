@@ -3,4 +3,11 @@ cd /d %~dp0
 copy lora_api.py ..\gateway\lib\
 copy lora_api.py ..\node1\lib\
 copy lora_api.py ..\node2\lib\
+copy lora_airtime.py ..\gateway\lib\
+copy lora_airtime.py ..\node1\lib\
+copy lora_airtime.py ..\node2\lib\
+copy lora_async.py ..\gateway\lib\
+copy timer_wheel.py ..\gateway\lib\
+copy timer_wheel.py ..\node1\lib\
+copy timer_wheel.py ..\node2\lib\
 pause
\ No newline at end of file
@@ -9,6 +9,8 @@ import socket
 import struct
 from network import LoRa
 from machine import Timer
+from machine import idle
+from lora_airtime import time_on_air, DutyCycle
 
 # About loraAPI
 # This class provides functionality for a nano-gateway and provides communications
@@ -35,11 +37,39 @@ class loraAPI:
     # s: text as bytes
     SEND_FORMAT = "BB%ds"
 
-    # A three-byte package used to acknowledge a package was received,
-    # B: 1 byte for the device_id,
-    # B: 1 byte for the package size (size=1),
-    # B: 1 byte for the Ok (200) or error messages
-    ACKNOWLEDGE_FORMAT = "BBB"
+    # Reliable delivery (see send_reliable() below)
+    # The first byte of a message tells us what kind of message it is:
+    #   1 to 3: packed messages (see PACKED_TYPES)
+    #   123: "{", the start of JSON text
+    #   RELIABLE_DATA and RELIABLE_ACK below
+    #
+    # A message sent with send_reliable() gets two extra bytes in front:
+    # B: RELIABLE_DATA
+    # B: 1 byte sequence number, counting up from 0 to 255 and back to 0
+    RELIABLE_DATA = 0xF0
+
+    # The reply to every RELIABLE_DATA message:
+    # B: RELIABLE_ACK
+    # B: the next sequence number expected. Everything before it has arrived.
+    # B: 8 bits, one for each of the 8 sequence numbers after that,
+    #    set if that message has also arrived
+    RELIABLE_ACK = 0xF1
+
+    # Several messages packed into one package (see queue() below).
+    # B: LORA_FRAME
+    # then for each message:
+    # B: 1 byte for the device_id the message is to (from the gateway) or from (from a node)
+    # B: 1 byte for the message size
+    # %d: the message
+    # A frame from the gateway may hold messages for several nodes, so it is
+    # sent to device_id 0, which every node listens to.
+    LORA_FRAME = 0xF2
+
+    # The largest package we send. This is the LoRaWAN limit at the fastest
+    # data rate (SF7, 125 kHz) in each of the regions listed below.
+    LORA_MAX_PAYLOAD = 242 # bytes
+    # The longest message: what fits in a package after its 2 byte header
+    LORA_MAX_MESSAGE = LORA_MAX_PAYLOAD - 2
 
     # Please pick the region that matches where you are using the device:
     # Asia = LoRa.AS923
@@ -48,11 +78,105 @@ class loraAPI:
     # United States = LoRa.US915
     LORA_REGION = LoRa.AU915
 
-    LORA_ACKNOWLEDGEMENT_TIMEOUT = 3 # seconds
+    # Duty cycle limits for each region, used by can_send() and next_send_time().
+    # Each sub-band is (lowest frequency Hz, highest frequency Hz, duty cycle),
+    # e.g. 0.01 = 1% of the time, measured over an hour.
+    # Check your local regulations, these are the usual LoRaWAN limits.
+    DUTY_CYCLE_BANDS = {
+        LoRa.AS923: [(915000000, 928000000, 0.01)],
+        LoRa.AU915: [],     # No duty cycle limit, but see LORA_MAX_DWELL
+        LoRa.EU868: [
+            (863000000, 867999999, 0.01),
+            (868000000, 868600000, 0.01),
+            (868700000, 869200000, 0.001),
+            (869400000, 869650000, 0.1),
+            (869700000, 870000000, 0.01),
+        ],
+        LoRa.US915: [],
+    }
+
+    # The longest a single package may be on air in each region (milliseconds)
+    LORA_MAX_DWELL = {
+        LoRa.AS923: 400,
+        LoRa.AU915: 400,
+        LoRa.EU868: None,
+        LoRa.US915: 400,
+    }
+
+    # Packed (binary) messages
+    # send_packed() sends the same dictionaries as send_as_json() but uses
+    # a few bytes of binary data instead of JSON text, saving airtime.
+    # {"submits": {"temperature": 23.4123, "humidity": 55.12}} is 55 bytes as
+    # JSON text but only 6 bytes packed.
+    #
+    # A packed message looks like this:
+    # B: 1 byte message type tag (see PACKED_TYPES)
+    # B: 1 byte with a bit set for each field that is present (see PACKED_FIELDS)
+    # then each present field as a fixed-point number, in PACKED_FIELDS order.
+    #
+    # JSON text always starts with "{" (123), so the tags must stay below that
+    # and both kinds of message can share the network.
+    PACKED_TYPES = {
+        "submits": 1,
+        "requests": 2,
+        "responses": 3,
+        "summaries": 4,
+        "samples": 5,
+    }
+
+    # These message types carry a list of field names instead of values,
+    # e.g. {"requests": ["temperature", "humidity"]}
+    PACKED_LIST_TYPES = ("requests",)
+
+    # These carry a summary of several readings: how many, then
+    # [mean, lowest, highest, standard deviation] for each field, e.g.
+    # {"summaries": {"count": 6, "temperature": [21.5, 21.2, 21.9, 0.25]}}
+    # After the mask byte, B: 1 byte count, then 4 values for each field.
+    PACKED_STATS_TYPES = ("summaries",)
+
+    # These carry a list of readings for each field, oldest first, e.g.
+    # {"samples": {"temperature": [21.2, 21.4], "humidity": [55.0, 55.1]}}
+    # After the mask byte, B: 1 byte count, then 'count' values for each field.
+    PACKED_SERIES_TYPES = ("samples",)
+
+    # Each field is (name, struct format, scale).
+    # Values are multiplied by scale and sent as whole numbers, so
+    # a temperature of 23.4123 is sent as 2341 in 2 bytes ("h") and
+    # arrives as 23.41. Up to 8 fields can be listed.
+    PACKED_FIELDS = (
+        ("temperature", "h", 100),
+        ("humidity", "H", 100),
+    )
+
+    # Smallest and largest whole number each struct format can hold.
+    # MicroPython's struct doesn't complain about values that don't fit, it
+    # just sends the wrong number, so pack() checks them first.
+    PACKED_RANGES = {
+        "b": (-128, 127),
+        "B": (0, 255),
+        "h": (-32768, 32767),
+        "H": (0, 65535),
+        "i": (-2147483648, 2147483647),
+        "I": (0, 4294967295),
+    }
+
+    # How many reliable messages can be sent before waiting for
+    # acknowledgements (1 to 8). 1 means send one and wait.
+    RELIABLE_WINDOW = 4
+
+    # Resend a message if it isn't acknowledged in this time.
+    # Each retry waits a little longer than the last.
+    RELIABLE_RETRANSMIT_TIMEOUT = 3000 # milliseconds
+    RELIABLE_MAX_RETRIES = 3
+
     LORA_RESPONSE_TIMEOUT = 3 # seconds
 
     LORA_RECEIVE_BUFFER_SIZE = 512
 
+    # After listen() is called, packages that arrive while nobody is waiting
+    # in receive() are kept here. The oldest are dropped when it's full.
+    LORA_INBOX_SIZE = 8
+
     # Creates a new object of the loraAPI type
     def __init__(self, device_id=0, device_name='No-name', device_colour='white', device_colour_code=0xFFFFFF, is_gateway=False):
 
@@ -85,22 +209,79 @@ class loraAPI:
         self.sock = socket.socket(socket.AF_LORA, socket.SOCK_RAW)
         self.sock.setblocking(False)
 
+        # Used by listen(). See below.
+        self.listening = False
+        self.handlers = []
+        self.inbox = []
+        # Packages the radio callback has received, waiting for collect()
+        self.arrived = []
+        # Optional flag (anything with a set() method) the radio callback sets
+        # when a package arrives. loraAsync uses it to wake up recv().
+        self.arrival = None
+
+        # Used by send_reliable().
+        # For each device_id: [next sequence number, {sequence number: [package, time sent, tries]}]
+        self.reliable_sent = {}
+        # For each device_id: [next sequence number expected, bits for the 8 after that]
+        self.reliable_received = {}
+
+        # Used by queue(). Messages waiting to be sent as (device_id, message)
+        self.queued = []
+        self.queued_size = 0
+        # Used by hold_for(). For each node that sleeps: messages waiting until it's heard from
+        self.held = {}
+        # Counts of what flush() has sent. records - frames is how many
+        # transmissions were saved by packing messages together.
+        self.frame_stats = {"frames": 0, "records": 0, "airtime_saved_ms": 0}
+
+        # Keeps track of time on air, see can_send()
+        self.duty_cycle = DutyCycle(loraAPI.DUTY_CYCLE_BANDS.get(loraAPI.LORA_REGION, []),
+                                    loraAPI.LORA_MAX_DWELL.get(loraAPI.LORA_REGION), diff=time.ticks_diff)
+
     # Convert a dictionary data structure to JSON and send it out over LoRa
     # Parameter: dictionary
     #   Must be a Python dictionary data type.
     # Parameter: device_id
     #   If the sender is the gateway, device_id is the destination node device_id.
     #   Otherwise, nodes send their own device_id so the gateway can reply to them.
-    def send_as_json(self, dictionary, device_id=0):
+    # Parameter: reliable
+    #   If True, use send_reliable() so the message is resent until it arrives.
+    # Parameter: queue
+    #   If True, use queue() so the message can share a package with others.
+    def send_as_json(self, dictionary, device_id=0, reliable=False, queue=False):
 
         # Make sure 'dictionary' really is one.
         if isinstance(dictionary,(dict,)) and len(dictionary) > 0:
             # Format the data structure into text in JSON format
             # To Do: Exception handling here
-            self.send(json.dumps(dictionary), device_id)
+            if reliable:
+                self.send_reliable(json.dumps(dictionary), device_id, queue)
+            elif queue:
+                self.queue(json.dumps(dictionary), device_id)
+            else:
+                self.send(json.dumps(dictionary), device_id)
         else:
             print("send_as_json() failed. Was not given a dictionary data structure")
 
+    # Pack a dictionary into binary and send it out over LoRa
+    # Takes the same parameters as send_as_json()
+    # If it can't be packed (see pack()) it's sent as JSON text instead.
+    def send_packed(self, dictionary, device_id=0, reliable=False, queue=False):
+
+        message = loraAPI.pack(dictionary)
+
+        # Anything that can't be packed (a value too big, a field not in
+        # PACKED_FIELDS...) still goes, as JSON text
+        if message is None:
+            print("send_packed() could not pack {}, sending it as JSON".format(dictionary))
+            self.send_as_json(dictionary, device_id, reliable, queue)
+        elif reliable:
+            self.send_reliable(message, device_id, queue)
+        elif queue:
+            self.queue(message, device_id)
+        else:
+            self.send(message, device_id)
+
     # Send a message out on the LoRa network
     # Parameter: message
     #   Must be a string of bytes.
@@ -112,10 +293,15 @@ class loraAPI:
         # Gateway must have a device_id to send to
         # device_id is not required when sending to gateway
         # as it has a different package format
-        if self.is_gateway and device_id == 0:
+        # (Frames from flush() are the exception, they go to every node)
+        if self.is_gateway and device_id == 0 and not (len(message) > 0 and message[0] == loraAPI.LORA_FRAME):
             print("loraAPI.send() requires device_id when gateway sends")
             return
 
+        if not loraAPI.fits(message):
+            print("loraAPI.send() can't send {} bytes, the most is {}".format(len(message), loraAPI.LORA_MAX_MESSAGE))
+            return
+
         format = "BB%ds"
 
         if not self.is_gateway:
@@ -142,7 +328,8 @@ class loraAPI:
         #       "B" = 1 byte for the length of the package
         #      "6s" = 6 bytes of string data (text)
 
-        package = struct.pack(loraAPI.SEND_FORMAT % len(message), device_id, len(message), message)
+        data = message.encode() if isinstance(message, str) else message
+        package = struct.pack(loraAPI.SEND_FORMAT % len(data), device_id, len(data), data)
         # print("SEND begin")
         # print("Length Index: {}".format(length_index))
         #
@@ -153,15 +340,11 @@ class loraAPI:
 
         # Send the message on the network
         self.sock.send(package)
+        self.duty_cycle.record(time.ticks_ms(), self.lora.frequency(), self.airtime(len(package)))
 
         # Print out what was sent
         print("{} ({}) sent {} to {}".format(self.device_name, self.device_colour, message, 'node{}'.format(device_id) if self.is_gateway else 'gateway'))
 
-        # if (self.package_was_acknowledged()):
-        #     print("ACK")
-        # else:
-        #     print("NACK")
-
     # Waits for a limited time for a LoRa package.
     # Returns whatever message is received with the device_id of who sent it.
     # If waiting time runs out, returns (None, None)
@@ -179,30 +362,276 @@ class loraAPI:
                 # print("TIMEOUT")
                 return None, None
 
+            # Messages already collected, e.g. by service() after listen(),
+            # or the rest of a package that held several messages
+            if len(self.inbox) > 0:
+                return self.inbox.pop(0)
+
+            self.service()
+
+            if self.listening:
+                # Sleep until something happens, e.g. the radio finishes
+                # receiving a package. Much quicker than time.sleep(0.1).
+                idle()
+                continue
+
             # Try to get a LoRa package
             package = self.sock.recv(loraAPI.LORA_RECEIVE_BUFFER_SIZE)
 
             # If the length of [package] not 0, a valid package was received.
+            # Its messages go into the inbox, ready for the next time around.
             if (len(package) > 0):
+                self._collect(package)
+                continue
 
-                # Unpack the package into its three component parts
-                device_id, length, message = struct.unpack(loraAPI.RECEIVE_FORMAT % package[1], package)
+            # Slow down the loop
+            time.sleep(0.1)
 
-                # Packages received at the gateway are tagged with the sender's device_id
-                if self.is_gateway:
-                    print("Received {} from device ID {}".format(message, device_id))
-                    return device_id, message
+    # Unpacks a package from the LoRa socket into device_id and message.
+    # Returns (None, None) if the package isn't for us.
+    def unpack_package(self, package):
 
-                # Packages recieved at a node could be for any nodeself.
-                # Need to check the package's device_id matches the node's own device_id
-                if device_id == self.device_id:
-                    print("Received {}".format(message))
-                    return device_id, message
-                # else:
-                #     print("Ignored message for device ID {}".format(device_id))
+        # Unpack the package into its three component parts
+        device_id, length, message = struct.unpack(loraAPI.RECEIVE_FORMAT % package[1], package)
 
-            # Slow down the loop
-            time.sleep(0.1)
+        # Packages received at the gateway are tagged with the sender's device_id
+        if self.is_gateway:
+            print("Received {} from device ID {}".format(message, device_id))
+            return device_id, message
+
+        # Packages recieved at a node could be for any nodeself.
+        # Need to check the package's device_id matches the node's own device_id
+        # Frames sent to device_id 0 may have messages for every node.
+        if device_id == self.device_id or (device_id == 0 and len(message) > 0 and message[0] == loraAPI.LORA_FRAME):
+            print("Received {}".format(message))
+            return device_id, message
+        # else:
+        #     print("Ignored message for device ID {}".format(device_id))
+
+        return None, None
+
+    # Start receiving packages as soon as the radio has them, instead of
+    # checking the socket every 0.1 seconds in receive().
+    # Parameter: handler
+    #   Optional function to call with (device_id, message) for each package.
+    #   Call listen() again to add more handlers.
+    #   Without any handlers, packages wait in the inbox for receive().
+    # Handlers are called by collect(), from the main program (service()
+    # and receive() call it), never from the radio callback.
+    # Handlers take every message, so they can't be used with loraAsync.recv().
+    def listen(self, handler=None):
+
+        if handler is not None:
+            if self.arrival is not None:
+                raise ValueError("listen() handlers can't be used with loraAsync")
+            self.handlers.append(handler)
+
+        if not self.listening:
+            # The radio calls _lora_callback() whenever a package arrives
+            self.lora.callback(trigger=LoRa.RX_PACKET_EVENT, handler=self._lora_callback)
+            self.listening = True
+
+    # Called by the LoRa radio when it has received a package.
+    # This runs at the same time as the main program, so it only puts the
+    # package aside (appending to a list can't be interrupted half way).
+    # Everything else (acknowledging, sending, the handlers) is left to
+    # collect(), so only the main program changes the queues and inbox.
+    def _lora_callback(self, lora):
+
+        if not lora.events() & LoRa.RX_PACKET_EVENT:
+            return
+
+        # More than one package may be waiting, so take them all
+        while(True):
+            package = self.sock.recv(loraAPI.LORA_RECEIVE_BUFFER_SIZE)
+            if len(package) == 0:
+                break
+            if len(self.arrived) >= loraAPI.LORA_INBOX_SIZE:
+                self.arrived.pop(0)
+            self.arrived.append(package)
+
+        if self.arrival is not None:
+            self.arrival.set()
+
+    # Deal with the packages the radio callback has put aside: acknowledge
+    # them, then hand each message to the listen() handlers or put it in the
+    # inbox for receive(). service() and receive() call this.
+    def collect(self):
+
+        while len(self.arrived) > 0:
+            self._collect(self.arrived.pop(0))
+
+    # Unpacks a package and hands each message in it to the listen() handlers,
+    # or puts it in the inbox for receive().
+    def _collect(self, package):
+
+        try:
+            device_id, message = self.unpack_package(package)
+        except (Exception):
+            return  # Damaged package
+
+        if message is None:
+            return
+
+        if len(message) > 0 and message[0] == loraAPI.LORA_FRAME:
+            records = loraAPI.unpack_frame(message)
+        else:
+            records = [(device_id, message)]
+
+        for device_id, message in records:
+
+            # A frame from the gateway can have messages for other nodes
+            if not self.is_gateway and device_id != self.device_id:
+                continue
+
+            # A sleeping node listens for a moment after it sends, so anything
+            # held for it has to go now. It can't hear while it's sending, so
+            # it all goes in one package with the acknowledgement.
+            releasing = device_id in self.held and len(self.held[device_id]) > 0
+            if releasing:
+                self._release(device_id)
+
+            message = self._accept(device_id, message, releasing)
+            if releasing:
+                self.flush()
+                self.hold_for(device_id)
+
+            if message is None:
+                continue
+
+            if len(self.handlers) > 0:
+                for handler in self.handlers:
+                    handler(device_id, message)
+            else:
+                if len(self.inbox) >= loraAPI.LORA_INBOX_SIZE:
+                    self.inbox.pop(0)
+                self.inbox.append((device_id, message))
+
+    # True if message (text or bytes) fits in one package
+    @staticmethod
+    def fits(message, header=0):
+
+        if isinstance(message, str):
+            message = message.encode()
+        return header + len(message) <= loraAPI.LORA_MAX_MESSAGE
+
+    # Add a message to be sent in the same package as other queued messages,
+    # saving a transmission for each one. Takes the same parameters as send().
+    # Queued messages go out when flush() is called, which receive() and
+    # service() do, or as soon as the next one wouldn't fit.
+    def queue(self, message, device_id=0):
+
+        if self.is_gateway and device_id == 0:
+            print("loraAPI.queue() requires device_id when gateway sends")
+            return
+
+        if not self.is_gateway:
+            device_id = self.device_id
+
+        data = message.encode() if isinstance(message, str) else message
+
+        if not loraAPI.fits(data):
+            print("loraAPI.queue() can't send {} bytes, the most is {}".format(len(data), loraAPI.LORA_MAX_MESSAGE))
+            return
+
+        # A sleeping node wouldn't hear it now, so it waits (see hold_for())
+        if device_id in self.held:
+            self.held[device_id].append(data)
+            return
+
+        # Package header, frame byte and this message's device_id and size
+        if 2 + 1 + self.queued_size + 2 + len(data) > loraAPI.LORA_MAX_PAYLOAD:
+            self.flush()
+
+        self.queued.append((device_id, data))
+        self.queued_size += 2 + len(data)
+
+    # Call this on the gateway for a node that sleeps between readings. The
+    # node only listens for a moment after each time it sends, so messages
+    # queue()d for it (e.g. send_as_json(..., queue=True)) are held until
+    # the gateway next hears from it, and then sent straight away.
+    def hold_for(self, device_id):
+
+        if device_id not in self.held:
+            self.held[device_id] = []
+
+    # Queue the messages held for a node by hold_for(). Messages for it are
+    # queued as normal until hold_for() is called again.
+    def _release(self, device_id):
+
+        waiting = self.held.pop(device_id)
+        for data in waiting:
+            self.queue(data, device_id)
+
+    # Send everything queued by queue()
+    def flush(self):
+
+        if len(self.queued) == 0:
+            return
+
+        records = self.queued
+        frame = None
+        if len(records) > 1:
+            frame = bytearray([loraAPI.LORA_FRAME])
+            device_ids = []
+            for device_id, data in records:
+                frame += struct.pack(loraAPI.SEND_FORMAT % len(data), device_id, len(data), data)
+                if device_id not in device_ids:
+                    device_ids.append(device_id)
+
+        # Only once the frame is made, so nothing is lost if that fails
+        self.queued = []
+        self.queued_size = 0
+
+        self.frame_stats["frames"] += 1
+        self.frame_stats["records"] += len(records)
+
+        # Each message on its own would have been a package with a 2 byte header
+        self.frame_stats["airtime_saved_ms"] += sum([self.airtime(2 + len(data)) for device_id, data in records])
+
+        # Just one message doesn't need a frame around it
+        if frame is None:
+            self.frame_stats["airtime_saved_ms"] -= self.airtime(2 + len(records[0][1]))
+            self.send(records[0][1], records[0][0])
+            return
+
+        self.frame_stats["airtime_saved_ms"] -= self.airtime(2 + len(frame))
+
+        # Frames with messages for more than one node go to all of them
+        self.send(bytes(frame), device_ids[0] if len(device_ids) == 1 else 0)
+
+    # Split a LORA_FRAME message back into a list of (device_id, message)
+    @staticmethod
+    def unpack_frame(message):
+
+        records = []
+        position = 1
+        while position + 2 <= len(message):
+            device_id = message[position]
+            length = message[position + 1]
+            records.append((device_id, message[position + 2:position + 2 + length]))
+            position += 2 + length
+        return records
+
+    # Time on air in milliseconds for a package of n_bytes
+    # (including the 2 byte header) with the radio's current settings
+    def airtime(self, n_bytes):
+
+        bandwidth = {LoRa.BW_125KHZ: 125000, LoRa.BW_250KHZ: 250000, LoRa.BW_500KHZ: 500000}[self.lora.bandwidth()]
+        coding_rate = {LoRa.CODING_4_5: 1, LoRa.CODING_4_6: 2, LoRa.CODING_4_7: 3, LoRa.CODING_4_8: 4}[self.lora.coding_rate()]
+        return time_on_air(n_bytes, self.lora.sf(), bandwidth, coding_rate, self.lora.preamble())
+
+    # Returns True if a package of n_bytes can be sent now without going over
+    # the region's duty cycle or dwell time limits.
+    def can_send(self, n_bytes=LORA_MAX_PAYLOAD):
+
+        return self.next_send_time(n_bytes) == 0
+
+    # Returns how many milliseconds until a package of n_bytes can be sent,
+    # 0 if it can be sent now, or None if it is too long to ever be sent.
+    def next_send_time(self, n_bytes=LORA_MAX_PAYLOAD):
+
+        return self.duty_cycle.wait(time.ticks_ms(), self.lora.frequency(), self.airtime(n_bytes))
 
     # This function takes data from receive(), interprets the message as JSON text
     # and converts it back into a dictionary type object. Displays an error if it
@@ -230,14 +659,350 @@ class loraAPI:
         # convert the JSON formatted text back into a dictionary.
         return device_id, data
 
-    def send_acknowledgement(self, device_id):
+    # Send a message that will be resent until the other end acknowledges it.
+    # Several messages can be on their way at once (up to RELIABLE_WINDOW).
+    # Messages that arrive twice are only passed on once by receive().
+    # Takes the same parameters as send(), and queue=True to use queue().
+    # Returns False, without sending, if the message is too long for one
+    # package, or if the oldest message still waiting for acknowledgement
+    # was RELIABLE_WINDOW messages ago.
+    def send_reliable(self, message, device_id=0, queue=False):
+
+        # Its own 2 byte header (RELIABLE_DATA and the sequence number) has to fit too
+        if not loraAPI.fits(message, 2):
+            print("send_reliable() can't send {} bytes, the most is {}".format(len(message), loraAPI.LORA_MAX_MESSAGE - 2))
+            return False
+
+        # Each node keeps its own sequence numbers with the gateway
+        if not self.is_gateway:
+            device_id = self.device_id
+
+        if device_id not in self.reliable_sent:
+            self.reliable_sent[device_id] = [0, {}]
+        sent = self.reliable_sent[device_id]
+
+        # The window is counted from the oldest message still waiting, so the
+        # receiver never sees a sequence number too far ahead of what it expects
+        oldest = max([(sent[0] - sequence) & 0xFF for sequence in sent[1]] or [0])
+        if oldest >= loraAPI.RELIABLE_WINDOW:
+            print("send_reliable() waiting for acknowledgements from {}".format(device_id))
+            return False
+
+        sequence = sent[0]
+        sent[0] = (sequence + 1) & 0xFF
+
+        data = message.encode() if isinstance(message, str) else message
+        package = bytes([loraAPI.RELIABLE_DATA, sequence]) + data
+        sent[1][sequence] = [package, time.ticks_ms(), 1]
+        if queue:
+            self.queue(package, device_id)
+        else:
+            self.send(package, device_id)
+        return True
+
+    # Returns how many reliable messages to device_id haven't been acknowledged yet
+    def unacknowledged(self, device_id=0):
+
+        if not self.is_gateway:
+            device_id = self.device_id
+        if device_id not in self.reliable_sent:
+            return 0
+        return len(self.reliable_sent[device_id][1])
+
+    # Deal with packages that have arrived (see collect()), resend reliable
+    # messages that haven't been acknowledged in time, and send any queued
+    # messages.
+    # receive() calls this, so it only needs calling directly if receive()
+    # isn't being used.
+    def service(self):
+
+        self.collect()
+
+        self.flush()
+
+        now = time.ticks_ms()
+        for device_id, sent in list(self.reliable_sent.items()):
+            for sequence, waiting in list(sent[1].items()):
+                package, sent_time, tries = waiting
+                if time.ticks_diff(now, sent_time) < loraAPI.RELIABLE_RETRANSMIT_TIMEOUT * tries:
+                    continue
+                if tries > loraAPI.RELIABLE_MAX_RETRIES:
+                    print("Gave up on message {} to {}".format(sequence, device_id))
+                    del sent[1][sequence]
+                    continue
+                # A sleeping node wouldn't hear it, so it waits with the rest
+                # of what's held for it. It's only another try once it has gone.
+                if device_id in self.held:
+                    if package not in self.held[device_id]:
+                        self.held[device_id].append(package)
+                        waiting[2] = tries + 1
+                    waiting[1] = now
+                    continue
+                self.send(package, device_id)
+                waiting[1] = now
+                waiting[2] = tries + 1
+
+    # Everything needed to carry on where we left off after a restart, e.g.
+    # waking up from deep sleep, which starts the board from scratch.
+    # Returns a dictionary that converts nicely into JSON (node1's
+    # nodeRuntime keeps it in a file on flash) with:
+    #   "sent": sequence numbers and unacknowledged reliable messages.
+    #           Without these a node that wakes up counts from 0 again and
+    #           the gateway throws its messages away as ones it already has.
+    #   "received": the sequence numbers expected from each sender
+    #   "airtime": time on air used recently, for the duty cycle limits
+    # Queued messages are sent first, as they can't be saved.
+    def save_state(self):
+
+        self.flush()
+
+        # JSON keys have to be text, so device_ids are turned into strings
+        sent = {}
+        for device_id, (sequence, waiting) in self.reliable_sent.items():
+            sent[str(device_id)] = [sequence, [[s, list(package), tries] for s, (package, sent_time, tries) in waiting.items()]]
+        received = {}
+        for device_id, (expected, bits) in self.reliable_received.items():
+            received[str(device_id)] = [expected, bits]
+
+        return {"sent": sent, "received": received, "airtime": self.duty_cycle.save(time.ticks_ms())}
+
+    # Carry on from a dictionary made by save_state().
+    # Parameter: elapsed
+    #   Milliseconds since save_state() was called, e.g. how long we slept
+    # Unacknowledged messages are sent again the next time service() runs.
+    def restore_state(self, state, elapsed=0):
+
+        now = time.ticks_ms()
+        for device_id, (sequence, waiting) in state.get("sent", {}).items():
+            messages = {}
+            for s, package, tries in waiting:
+                # Make it look like it was sent long enough ago to be due now
+                messages[s] = [bytes(package), time.ticks_add(now, -loraAPI.RELIABLE_RETRANSMIT_TIMEOUT * tries), tries]
+            self.reliable_sent[int(device_id)] = [sequence, messages]
+        for device_id, (expected, bits) in state.get("received", {}).items():
+            self.reliable_received[int(device_id)] = [expected, bits]
+        if "airtime" in state:
+            self.duty_cycle.restore(state["airtime"], now, elapsed)
+
+    # Looks at every message received and deals with reliable delivery.
+    # Returns the message to pass on, or None if there is nothing to pass on
+    # (an acknowledgement, or a message that has already arrived before).
+    # queue_ack=True queues the acknowledgement instead of sending it.
+    def _accept(self, device_id, message, queue_ack=False):
+
+        if len(message) < 2:
+            return message
+
+        # An acknowledgement of our reliable messages
+        if message[0] == loraAPI.RELIABLE_ACK and len(message) == 3:
+            if device_id in self.reliable_sent:
+                waiting = self.reliable_sent[device_id][1]
+                expected = message[1]
+                bits = message[2]
+                for sequence in list(waiting):
+                    offset = (sequence - expected) & 0xFF
+                    # Everything before 'expected' has arrived. After that,
+                    # check the bit for each sequence number.
+                    if offset >= 128 or (0 < offset <= 8 and bits & (1 << (offset - 1))):
+                        del waiting[sequence]
+            return None
+
+        if message[0] != loraAPI.RELIABLE_DATA:
+            return message
+
+        sequence = message[1]
+        if device_id not in self.reliable_received:
+            self.reliable_received[device_id] = [sequence, 0]
+        received = self.reliable_received[device_id]
+        expected, bits = received
+
+        offset = (sequence - expected) & 0xFF
+        duplicate = False
+
+        if offset == 0:
+            # The one we were waiting for. Move past it and anything
+            # after it that has already arrived.
+            expected = (expected + 1) & 0xFF
+            while bits & 1:
+                expected = (expected + 1) & 0xFF
+                bits >>= 1
+            bits >>= 1
+        elif offset <= 8:
+            # Arrived early, because an earlier one was lost
+            duplicate = bits & (1 << (offset - 1))
+            bits |= 1 << (offset - 1)
+        elif offset >= 256 - 16:
+            # Already passed this one. Our acknowledgement must have been lost.
+            duplicate = True
+        else:
+            # Way out of order. The sender must have restarted.
+            expected = (sequence + 1) & 0xFF
+            bits = 0
+
+        received[0] = expected
+        received[1] = bits
+
+        # Always acknowledge, even duplicates, in case our last one was lost
+        if queue_ack:
+            self.queue(bytes([loraAPI.RELIABLE_ACK, expected, bits]), device_id)
+        else:
+            self.send(bytes([loraAPI.RELIABLE_ACK, expected, bits]), device_id)
+
+        if duplicate:
+            return None
+        return message[2:]
+
+    # This function takes data from receive() and unpacks a message sent
+    # with send_packed() back into a dictionary. Works like receive_json().
+    def receive_packed(self):
+
+        device_id, message = self.receive()
+
+        if device_id is None or message is None:
+            return None, None
+
+        # A JSON message or a damaged package can't be unpacked,
+        # so just return the device_id with no data.
+        try:
+            data = loraAPI.unpack(message)
+        except (Exception):
+            return device_id, None
+
+        return device_id, data
+
+    # Bytes the package send_packed() would make of dictionary takes on the
+    # air, its 2 byte header (and RELIABLE_DATA header, if reliable) included.
+    # For can_send() and next_send_time().
+    @staticmethod
+    def packed_size(dictionary, reliable=False):
+
+        message = loraAPI.pack(dictionary)
+        if message is None:
+            message = json.dumps(dictionary).encode()
+        return 2 + (2 if reliable else 0) + len(message)
+
+    # Convert a dictionary like {"submits": {"temperature": 23.4}} into
+    # packed bytes. Returns None if the dictionary doesn't fit PACKED_TYPES
+    # and PACKED_FIELDS, or a value doesn't fit its field.
+    @staticmethod
+    def pack(dictionary):
+
+        # A package holds exactly one message type
+        if not isinstance(dictionary, (dict,)) or len(dictionary) != 1:
+            return None
+
+        name = list(dictionary)[0]
+        content = dictionary[name]
+
+        if name not in loraAPI.PACKED_TYPES:
+            return None
+
+        # Requests are a list of field names, everything else a dictionary
+        if not isinstance(content, (list, tuple) if name in loraAPI.PACKED_LIST_TYPES else (dict,)):
+            return None
+
+        try:
+            return loraAPI._pack(name, content)
+        except (TypeError, ValueError, OverflowError):
+            # A value that isn't a number (or is too big, NaN...)
+            return None
+
+    # pack() for a content of the right type
+    @staticmethod
+    def _pack(name, content):
+
+        is_list = name in loraAPI.PACKED_LIST_TYPES
+        is_stats = name in loraAPI.PACKED_STATS_TYPES
+        is_series = name in loraAPI.PACKED_SERIES_TYPES
+        mask = 0
+        format = "!BB"
+        values = []
+
+        # Summaries and samples have a count byte after the mask
+        count = None
+        if is_stats:
+            count = content.get("count", 0)
+            format += "B"
+        elif is_series:
+            count = max([len(content[field[0]]) for field in loraAPI.PACKED_FIELDS if content.get(field[0]) is not None] or [0])
+            format += "B"
+        if count is not None and (not isinstance(count, int) or not 0 <= count <= 255):
+            return None
+
+        for i, (field, field_format, scale) in enumerate(loraAPI.PACKED_FIELDS):
+            if is_list:
+                if field in content:
+                    mask |= 1 << i
+            elif is_stats or is_series:
+                if content.get(field) is None:
+                    continue
+                # 4 values for a summary, every reading for samples
+                if len(content[field]) != (4 if is_stats else count):
+                    return None
+                mask |= 1 << i
+                format += field_format * len(content[field])
+                for value in content[field]:
+                    values.append(loraAPI._fixed(value, field_format, scale))
+            elif content.get(field) is not None:
+                # Fields that are missing or None are left out
+                mask |= 1 << i
+                format += field_format
+                values.append(loraAPI._fixed(content[field], field_format, scale))
+
+        if count is not None:
+            return struct.pack(format, loraAPI.PACKED_TYPES[name], mask, count, *values)
+
+        return struct.pack(format, loraAPI.PACKED_TYPES[name], mask, *values)
+
+    # A value as the whole number pack() sends.
+    # Raises ValueError if it doesn't fit field_format, TypeError if it isn't a number.
+    @staticmethod
+    def _fixed(value, field_format, scale):
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError("not a number")
+        number = int(round(value * scale))
+        low, high = loraAPI.PACKED_RANGES[field_format]
+        if not low <= number <= high:
+            raise ValueError("out of range")
+        return number
+
+    # Convert packed bytes back into a dictionary.
+    # Returns None if the message type is unknown.
+    @staticmethod
+    def unpack(message):
+
+        if len(message) < 2:
+            return None
+
+        for name, tag in loraAPI.PACKED_TYPES.items():
+            if tag == message[0]:
+                break
+        else:
+            return None
+
+        mask = message[1]
+        fields = [field for i, field in enumerate(loraAPI.PACKED_FIELDS) if mask & (1 << i)]
+
+        if name in loraAPI.PACKED_LIST_TYPES:
+            return {name: [field[0] for field in fields]}
+
+        if name in loraAPI.PACKED_STATS_TYPES or name in loraAPI.PACKED_SERIES_TYPES:
+            count = message[2]
+            each = 4 if name in loraAPI.PACKED_STATS_TYPES else count
+            values = struct.unpack("!" + "".join([field[1] * each for field in fields]), message[3:])
+            content = {}
+            if name in loraAPI.PACKED_STATS_TYPES:
+                content["count"] = count
+            for i, (field, field_format, scale) in enumerate(fields):
+                content[field] = [value / scale for value in values[i * each:(i + 1) * each]]
+            return {name: content}
 
-        acknowledgement_package = struct.pack(loraAPI.ACKNOWLEDGE_FORMAT, device_id, 1, 200)
-        self.sock.send(acknowledgement_package)
+        format = "!" + "".join([field[1] for field in fields])
+        values = struct.unpack(format, message[2:])
 
-    def package_was_acknowledged(self):
+        content = {}
+        for (field, field_format, scale), value in zip(fields, values):
+            content[field] = value / scale
 
-        device_id, ack_code = self.receive()
-        if len(ack_code) == 1 and ack_code == 200:
-            return True
-        return False
+        return {name: content}
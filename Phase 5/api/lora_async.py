@@ -0,0 +1,114 @@
+# loraAsync
+# Core Electronics
+# An asyncio (uasyncio) wrapper for loraAPI so that receiving LoRa packages
+# doesn't stop other tasks from running.
+#
+# Needs uasyncio on the board. On a computer, Python's asyncio is used instead.
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import json
+
+# The radio callback runs outside asyncio, so it needs a flag that's safe to
+# set from there. uasyncio has ThreadSafeFlag. Python's asyncio doesn't, so
+# on a computer arrivalFlag below does the same job.
+class arrivalFlag:
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.loop = None
+
+    # Called by the radio callback, on another thread
+    def set(self):
+        if self.loop is None:
+            self.event.set()    # Nothing is waiting yet
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self):
+        self.loop = asyncio.get_running_loop()
+        await self.event.wait()
+        self.event.clear()
+
+try:
+    ThreadSafeFlag = asyncio.ThreadSafeFlag
+except AttributeError:
+    ThreadSafeFlag = arrivalFlag
+
+# About loraAsync
+# Wraps an existing loraAPI object. While one task waits in
+# 'await radio.recv()', other tasks (like MQTT) keep running.
+# The task sleeps until the radio callback says a package has arrived.
+#
+# recv() gets every message from the inbox, so loraAPI.listen() handlers
+# can't be used as well: they'd take the messages before recv() saw them.
+#
+# Example:
+#   gateway = loraAPI(device_name='Gateway', is_gateway=True)
+#   radio = loraAsync(gateway)
+#   device_id, data = await radio.recv_json()
+class loraAsync:
+
+    # While nothing arrives, recv() still wakes up this often (in seconds)
+    # to resend reliable messages that haven't been acknowledged and to send
+    # queued ones (see loraAPI.service()).
+    SERVICE_INTERVAL = 0.1
+
+    def __init__(self, api):
+        self.api = api
+
+        if len(api.handlers) > 0:
+            raise ValueError("loraAsync can't be used with loraAPI.listen() handlers")
+
+        # The radio callback sets this when a package arrives (see loraAPI.listen())
+        self.api.arrival = ThreadSafeFlag()
+        self.api.listen()
+
+    # Waits for the next LoRa package, letting other tasks run meanwhile.
+    # Returns the device_id and message, like loraAPI.receive().
+    async def recv(self):
+
+        while True:
+            # Deals with what has arrived and resends any reliable messages
+            # that haven't been acknowledged
+            self.api.service()
+            if len(self.api.inbox) > 0:
+                return self.api.inbox.pop(0)
+
+            try:
+                await asyncio.wait_for(self.api.arrival.wait(), loraAsync.SERVICE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    # Like loraAPI.receive_json(). Packed messages (see loraAPI.send_packed())
+    # are unpacked into the same dictionaries, so both kinds can be handled
+    # together. Returns (device_id, None) if the message is neither.
+    async def recv_json(self):
+
+        device_id, message = await self.recv()
+
+        try:
+            data = json.loads(message)
+        except (Exception):
+            try:
+                data = self.api.unpack(message)
+            except (Exception):
+                data = None
+            return device_id, data
+
+        return device_id, data
+
+    # Like loraAPI.send(). The LoRa socket doesn't block, so this only
+    # gives other tasks a turn afterwards.
+    async def send(self, message, device_id=0):
+
+        self.api.send(message, device_id)
+        await asyncio.sleep(0)
+
+    # Like loraAPI.send_as_json()
+    async def send_json(self, dictionary, device_id=0):
+
+        self.api.send_as_json(dictionary, device_id)
+        await asyncio.sleep(0)
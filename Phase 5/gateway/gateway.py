@@ -1,11 +1,20 @@
+import gc
 import json
+try:
+    import uasyncio as asyncio  # Runs several tasks at once
+except ImportError:
+    import asyncio
 import time
 import machine                # Interfaces with hardware components
 import ubinascii              # Needed to run any MicroPython code
 from network import WLAN      # For operation of WiFi network
 from machine import Timer
 from lora_api import loraAPI
+from lora_async import loraAsync
 from umqtt import MQTTClient  # For use of MQTT protocol to talk to Adafruit IO
+from umqtt_async import MQTTSupervisor
+from store_forward import storeForward
+from timer_wheel import timerWheel
 
 # SETTINGS
 
@@ -22,41 +31,261 @@ AIO_CLIENT_ID = ubinascii.hexlify(machine.unique_id())  # Can be anything
 AIO_CONTROL_FEED = "CoreChris/feeds/control"
 AIO_TEMP_FEED = "CoreChris/feeds/temp"
 AIO_HUMI_FEED = "CoreChris/feeds/humi"
+AIO_THRESHOLDS_FEED = "CoreChris/feeds/thresholds"   # JSON text, e.g. {"temperature": {"delta": 0.5}, "heartbeat": 1800}
+AIO_QOS = 1     # 1 means Adafruit IO acknowledges each value, and we resend it if it doesn't
+AIO_KEEPALIVE = 60          # seconds. Adafruit IO disconnects us if it hears nothing for longer.
+                            # When the connection is idle for half of this, we check it's still there.
+AIO_PING_TIMEOUT = 10000    # ms to wait for the answer before connecting again
 
 LORA_SENSOR_DEVICE_ID = 1
 
+HOUSEKEEPING_INTERVAL = 10 # seconds
+TIMER_RESOLUTION = 100     # ms. Timers (see timers below) run up to this late.
+
+# Readings waiting to be published are kept here while Adafruit IO can't be reached
+QUEUE_RAM_SIZE = 32                 # readings kept in RAM
+QUEUE_LOG = "/flash/aio_queue.log"  # more go in this file on flash
+QUEUE_LOG_SIZE = 1000               # readings the file can hold
+QUEUE_POLICY = "drop_oldest"        # when full: "drop_oldest", "drop_newest" or "downsample"
+QUEUE_BATCH = 8                     # readings sent together once the connection is back
+RETRY_INTERVAL = 5                  # seconds between tries while publishing fails
+
 # End SETTINGS
 
 # FUNCTIONS
 
+# True if thresholds is what node1's reportPolicy.update() takes:
+# {"heartbeat": seconds, field: {"delta": ..., "low": ..., "high": ..., "hysteresis": ...}, ...}
+# with numbers (or null to remove one) and nothing else
+def valid_thresholds(thresholds):
+    if not isinstance(thresholds, dict) or len(thresholds) == 0:
+        return False
+    for field in thresholds:
+        value = thresholds[field]
+        keys = ("delta", "low", "high", "hysteresis")
+        if field == "heartbeat":
+            value = {field: value}
+            keys = ("heartbeat",)
+        elif not isinstance(value, dict):
+            return False
+        for key in value:
+            number = value[key]
+            if key not in keys:
+                return False
+            if number is None:
+                continue
+            if isinstance(number, bool) or not isinstance(number, (int, float)):
+                return False
+            if number < 0 and key in ("heartbeat", "delta", "hysteresis"):
+                return False
+    return True
+
 # Function to respond to messages from Adafruit IO
 def sub_cb(topic, msg):          # sub_cb means "callback subroutine"
 
     print("io.adafruit.com says: {} {}".format(topic, msg))          # Outputs the message that was received. Debugging use.
-    if int(msg) == 1:
-        gateway.send_as_json({"requests": ["temperature", "humidity"]}, LORA_SENSOR_DEVICE_ID)
+
+    # New report by exception thresholds for node1 (see node1/lib/report_policy.py).
+    # Sent reliably, so node1 acknowledges them, as soon as it next sends something.
+    if topic == AIO_THRESHOLDS_FEED.encode():
+        try:
+            thresholds = json.loads(msg)
+        except ValueError:
+            thresholds = None
+        if not valid_thresholds(thresholds):
+            print("Thresholds must be JSON numbers, e.g. {\"temperature\": {\"delta\": 0.5}, \"heartbeat\": 1800}")
+            return
+        gateway.send_as_json({"thresholds": thresholds}, LORA_SENSOR_DEVICE_ID, reliable=True, queue=True)
+        return
+
+    try:
+        command = int(msg)
+    except ValueError:
+        print("The control feed takes 1 (a reading) or 2 (every sample), not {}".format(msg))
+        return
+
+    if command == 1:
+        gateway.send_as_json({"requests": ["temperature", "humidity"]}, LORA_SENSOR_DEVICE_ID, queue=True)
+    elif command == 2:
+        # Every reading node1 has kept, not just its summaries
+        gateway.send_as_json({"requests": ["samples"]}, LORA_SENSOR_DEVICE_ID, queue=True)
 
 def send_temp_to_aio():
     global temperature  # This makes the function use the variable called 'humidity'
                         # that is declared outside of this function.
 
-    send_to_aio(AIO_TEMP_FEED, temperature)
+    queue_for_aio(AIO_TEMP_FEED, temperature)
 
 def send_humi_to_aio():
     global humidity     # This makes the function use the variable called 'humidity'
                         # that is declared outside of this function.
 
-    send_to_aio(AIO_HUMI_FEED, humidity)
+    queue_for_aio(AIO_HUMI_FEED, humidity)
+
+# Publishing happens in its own task (publish_task below) so that a slow
+# network never holds up the LoRa radio. Other code just adds to the queue.
+# If Adafruit IO can't be reached, readings wait in the queue (and on flash
+# if there are a lot of them) instead of being lost.
+def queue_for_aio(feed, value):
+    publish_queue.put(feed, value)
+    publish_ready.set()
 
-def send_to_aio(feed, value):
+async def send_to_aio(feed, value):
 
     value_string = str(value)
     print("Publishing: {0} to {1} ... ".format(str(value_string), feed), end='')
     try:
-        adafruit_io.publish(topic=feed, msg=str(value_string))
+        # With QoS 1 this doesn't wait for Adafruit IO to acknowledge the value,
+        # so the next one can be sent straight away. Unacknowledged values are
+        # resent when the MQTT task checks for messages, or once it has
+        # connected again if the connection was lost. While it's
+        # disconnected this fails straight away and the value stays queued.
+        # Returns the packet id to wait for (see publish_task), or None if it failed.
+        pid = await aio.publish(topic=feed, msg=str(value_string), qos=AIO_QOS)
         print("DONE")
+        return pid
     except Exception as e:
         print("FAILED")
+        return None
+
+# Deal with a package received over LoRa.
+# It will either be an update from node1 (a reading, a summary of readings,
+# or the readings themselves), or a request for data from node2
+# device_id is the number of the node to reply to.
+# data is a Python dictionary object with either a dictionary {} or a list [] inside it
+def handle_package(device_id, data):
+    global temperature, humidity
+
+    # Note that we don't decide what to do based on which
+    # device_id sent the package. The contents of the package
+    # itself is what determines what we do with it. We can
+    # reassign device_ids however we like, it will still work.
+
+    # A "submits" package provides data we want
+    # Dictionaries have {key: value} pairs in them.
+    # We're asking if there's a key called "submits"
+    if "submits" in data:
+
+        # Now we'll take the value side of the "submits" pair...
+        submits = data['submits']
+
+        # ...and look inside that for another dictionary with keys
+        # for "temperature" and "humidity". If found, grab their values.
+        if "temperature" in submits:
+            temperature = submits['temperature']
+            print("Temp >> {}".format(temperature))
+            send_temp_to_aio()
+        if "humidity" in submits:
+            humidity = submits['humidity']
+            print("humi >> {}".format(humidity))
+            send_humi_to_aio()
+
+    # A "summaries" package sums up several readings. For each value there's
+    # a list of [mean, lowest, highest, standard deviation]. The mean goes
+    # to Adafruit IO like a single reading would.
+    if "summaries" in data:
+        summaries = data['summaries']
+        if "temperature" in summaries:
+            temperature = summaries['temperature'][0]
+            print("Temp >> {} over {} readings (low {}, high {}, sd {})".format(temperature, summaries['count'], *summaries['temperature'][1:]))
+            send_temp_to_aio()
+        if "humidity" in summaries:
+            humidity = summaries['humidity'][0]
+            print("humi >> {} over {} readings (low {}, high {}, sd {})".format(humidity, summaries['count'], *summaries['humidity'][1:]))
+            send_humi_to_aio()
+
+    # A "samples" package has the readings themselves, oldest first,
+    # which we asked for. They all go to Adafruit IO.
+    if "samples" in data:
+        samples = data['samples']
+        print("Samples >> {}".format(samples))
+        for value in samples.get("temperature", []):
+            queue_for_aio(AIO_TEMP_FEED, value)
+        for value in samples.get("humidity", []):
+            queue_for_aio(AIO_HUMI_FEED, value)
+
+    # A "requests" package asks us for data we have
+    # In reply we send a "responses" package
+    # queue=True lets replies to several nodes share one LoRa package.
+    # They are sent the next time the radio is checked.
+    if "requests" in data:
+        if "temperature" in data["requests"] and "humidity" in data["requests"]:
+            gateway.send_as_json({"responses": {"temperature": temperature, "humidity": humidity}}, device_id, queue=True)
+
+# TASKS
+# Each task below runs its own loop. Whenever one of them waits (await ...)
+# the others get a turn, so LoRa and MQTT are both looked after all the time.
+
+# Receive LoRa packages and deal with them
+async def lora_task():
+    while True:
+        device_id, data = await radio.recv_json()
+
+        if device_id and data:  # Ensure a valid package before trying to dissect it.
+                                # Same as: if device_is is not None and data is not None:
+            handle_package(device_id, data)
+
+# Connect to Adafruit IO and receive MQTT messages from it. They are handed
+# to sub_cb(). If the connection is lost this connects again by itself,
+# while the other tasks carry on.
+async def mqtt_task():
+    await aio.run()
+
+# Send everything in publish_queue to Adafruit IO, a batch at a time.
+# Readings are only removed from the queue once Adafruit IO has acknowledged
+# them (the PUBACK). Until then they're still in the queue, on flash if there
+# are a lot of them, so a reboot or a lost session doesn't lose them.
+async def publish_task():
+    while True:
+        await publish_ready.wait()
+        publish_ready.clear()
+        while publish_queue.depth() > 0:
+            sent = None
+            pids = []
+            for seq, feed, value in publish_queue.peek(QUEUE_BATCH):
+                pid = await send_to_aio(feed, value)
+                if pid is None:
+                    break
+                pids.append(pid)
+                sent = seq
+            if sent is not None:
+                # The MQTT task sends them again after a reconnect, so just wait
+                await aio.acked(pids)
+                publish_queue.commit(sent)
+            if publish_queue.depth() > 0 and sent is None:
+                # Couldn't send anything. Wait a while before trying again.
+                print("Publishing failed, {} readings waiting".format(publish_queue.depth()))
+                await asyncio.sleep(RETRY_INTERVAL)
+
+# Tidy up memory now and then, rather than in the middle of something else.
+# Called by a timer every HOUSEKEEPING_INTERVAL seconds.
+def housekeeping():
+    gc.collect()
+    if publish_queue.depth() > 0:
+        print("Publish queue: {}".format(publish_queue.metrics()))
+
+# Call every timer that is due. All the things that have to happen at a
+# certain time (housekeeping, checking the MQTT connection is alive) are
+# timers on the one timer wheel, so this is the only task that needs to
+# keep track of time.
+async def timer_task():
+    while True:
+        timers.run()
+        await asyncio.sleep(TIMER_RESOLUTION / 1000)
+
+async def main():
+    global publish_ready
+    publish_ready = asyncio.Event()
+
+    # Subscribed to every time the gateway connects
+    await aio.subscribe(AIO_CONTROL_FEED)
+    await aio.subscribe(AIO_THRESHOLDS_FEED)
+
+    asyncio.create_task(lora_task())
+    asyncio.create_task(mqtt_task())
+    asyncio.create_task(publish_task())
+    timers.add(HOUSEKEEPING_INTERVAL * 1000, housekeeping, HOUSEKEEPING_INTERVAL * 1000)
+    await timer_task()
 
 # CONNECT TO WIFI
 # We need to have a connection to WiFi for Internet access
@@ -71,15 +300,19 @@ while not wlan.isconnected():    # Code waits here until WiFi connects
 
 print("done.")
 
-# CONNECT TO ADAFRUIT IO
-# Use the MQTT protocol to connect to Adafruit IO
-adafruit_io = MQTTClient(AIO_CLIENT_ID, AIO_SERVER, AIO_PORT, AIO_USER, AIO_KEY)
+# SET UP ADAFRUIT IO
+# Use the MQTT protocol to talk to Adafruit IO. mqtt_task() connects.
+adafruit_io = MQTTClient(AIO_CLIENT_ID, AIO_SERVER, AIO_PORT, AIO_USER, AIO_KEY, keepalive=AIO_KEEPALIVE)
 
 # Subscribed messages will be delivered to this callback
 adafruit_io.set_callback(sub_cb)
-adafruit_io.connect()
-adafruit_io.subscribe(AIO_CONTROL_FEED)
-print("Connected to %s, subscribed to %s topic" % (AIO_SERVER, AIO_CONTROL_FEED))
+
+# Look up Adafruit IO's address now, while nothing else is running.
+# If it can't be found yet, mqtt_task() keeps trying without holding up the radio.
+try:
+    adafruit_io.addr = adafruit_io.lookup()
+except OSError as e:
+    print("Couldn't look up {} yet ({})".format(AIO_SERVER, repr(e)))
 
 # When we are given values for these, store them here
 temperature = None
@@ -88,48 +321,15 @@ humidity = None
 # Make this a gateway on the LoRa network.
 gateway = loraAPI(device_name='Gateway', device_colour="blue", device_colour_code=0x0000FF, is_gateway=True)
 
+# node1 sleeps between readings and only listens just after it sends one,
+# so requests for it wait until we next hear from it
+gateway.hold_for(LORA_SENSOR_DEVICE_ID)
+
+# Run the tasks from asyncio instead of one big while loop
+timers = timerWheel(resolution=TIMER_RESOLUTION)
+radio = loraAsync(gateway)
+aio = MQTTSupervisor(adafruit_io, ping_timeout=AIO_PING_TIMEOUT, timers=timers)
+publish_queue = storeForward(QUEUE_RAM_SIZE, QUEUE_LOG, QUEUE_LOG_SIZE, QUEUE_POLICY)
+
 # Do this forever!
-while (True):
-
-    # Check for an MQTT message from Adafruit IO
-    adafruit_io.check_msg()
-
-    # Receive the next LoRa package
-    # It will either be an update from node1, or a request for data from node2
-    # After this line, device_id is the number of the node to reply to.
-    # If receive_json() worked, we'll have a Python dictionary object with
-    # either a dictionary {} or a list [] inside it
-    device_id, data = gateway.receive_json()
-
-    if device_id and data:  # Ensure a valid package before trying to dissect it.
-                            # Same as: if device_is is not None and data is not None:
-
-        # Note that we don't decide what to do based on which
-        # device_id sent the package. The contents of the package
-        # itself is what determines what we do with it. We can
-        # reassign device_ids however we like, it will still work.
-
-        # A "submits" package provides data we want
-        # Dictionaries have {key: value} pairs in them.
-        # We're asking if there's a key called "submits"
-        if "submits" in data:
-
-            # Now we'll take the value side of the "submits" pair...
-            submits = data['submits']
-
-            # ...and look inside that for another dictionary with keys
-            # for "temperature" and "humidity". If found, grab their values.
-            if "temperature" in submits:
-                temperature = submits['temperature']
-                print("Temp >> {}".format(temperature))
-                send_temp_to_aio()
-            if "humidity" in submits:
-                humidity = submits['humidity']
-                print("humi >> {}".format(humidity))
-                send_humi_to_aio()
-
-        # A "requests" package asks us for data we have
-        # In reply we send a "responses" package
-        if "requests" in data:
-            if "temperature" in data["requests"] and "humidity" in data["requests"]:
-                gateway.send_as_json({"responses": {"temperature": temperature, "humidity": humidity}}, device_id)
+asyncio.run(main())
@@ -0,0 +1,254 @@
+# storeForward
+# Core Electronics
+# Keeps readings that couldn't be published yet (no WiFi, broker down) so
+# they can be sent once the connection is back, oldest first.
+#
+# The newest readings are kept in RAM. When RAM is full the oldest of them
+# move to a log file on flash, so they also survive a reboot. Readings are
+# added to the end of the log, and the ones sent or dropped at the start
+# are skipped over until they take up more room than the rest, then the
+# log is written again without them. When the log is full too, the
+# eviction policy decides what goes:
+#   DROP_OLDEST  forget the oldest readings
+#   DROP_NEWEST  don't keep the new reading
+#   DOWNSAMPLE   forget every second reading in the log, keeping the whole
+#                time span at half the detail
+#
+# Example:
+#   queue = storeForward(path="/flash/aio_queue.log")
+#   queue.put(feed, value)
+#   batch = queue.peek(8)           # [(seq, feed, value), ...]
+#   ...publish them...
+#   queue.commit(batch[-1][0])      # they were sent, forget them
+import time
+try:
+    import uos as os
+except ImportError:
+    import os
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DOWNSAMPLE = "downsample"
+
+class storeForward:
+
+    # Parameter: ram_size
+    #   Number of readings kept in RAM
+    # Parameter: path
+    #   Log file on flash. None keeps everything in RAM only.
+    # Parameter: log_size
+    #   Number of readings the log can hold
+    # Parameter: policy
+    #   What to do when everything is full, see above
+    def __init__(self, ram_size=32, path=None, log_size=1000, policy=DROP_OLDEST):
+        self.ring = [None] * ram_size   # (seq, feed, value), made once
+        self.head = 0                   # index of the oldest in the ring
+        self.count = 0                  # how many are in the ring
+        self.path = path
+        self.log_size = log_size
+        self.policy = policy
+        self.log_count = 0              # readings in the log not yet sent
+        self.log_offset = 0             # where the first of them starts in the file
+        self.seq = 0                    # every reading gets the next number
+
+        # Metrics
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.drain_start = None
+        self.drain_sent = 0
+        self.drain_rate = 0.0           # readings per second, current or last drain
+
+        if path:
+            self._load_log()
+
+    # Number of readings waiting
+    def depth(self):
+        return self.count + self.log_count
+
+    def put(self, feed, value):
+        self.seq += 1
+        self.enqueued += 1
+        if self.count == len(self.ring):
+            if not self.path:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                self._pop_ring()
+                self.dropped += 1
+            else:
+                if self.log_count >= self.log_size:
+                    if self.policy == DROP_NEWEST:
+                        self.dropped += 1
+                        return
+                    if self.policy == DOWNSAMPLE:
+                        self._downsample_log()
+                    else:
+                        # A tenth at a time, so the log's position file isn't
+                        # rewritten for every new reading
+                        self._drop_log(max(1, self.log_size // 10))
+                # Make room by moving the oldest in RAM to the log
+                self._append_log(self._pop_ring())
+                self.spilled += 1
+        self.ring[(self.head + self.count) % len(self.ring)] = (self.seq, feed, str(value))
+        self.count += 1
+
+    # Up to n of the oldest readings as (seq, feed, value), without removing them
+    def peek(self, n):
+        items = []
+        if self.log_count:
+            with open(self.path) as f:
+                f.seek(self.log_offset)
+                while len(items) < n:
+                    record = self._read_record(f)
+                    if record is None:
+                        break
+                    items.append(record)
+        i = 0
+        while len(items) < n and i < self.count:
+            items.append(self.ring[(self.head + i) % len(self.ring)])
+            i += 1
+        if items and self.drain_start is None:
+            self.drain_start = time.ticks_ms()
+            self.drain_sent = 0
+        return items
+
+    # Forget every reading up to and including number 'seq', they were sent.
+    # Numbers rather than a count, so readings dropped in the meantime
+    # can't make it forget the wrong ones.
+    def commit(self, seq):
+        n = 0
+        if self.log_count:
+            with open(self.path) as f:
+                f.seek(self.log_offset)
+                while self.log_count:
+                    offset = f.tell()
+                    record = self._read_record(f)
+                    if record is None or record[0] > seq:
+                        f.seek(offset)
+                        break
+                    self.log_count -= 1
+                    n += 1
+                self.log_offset = f.tell()
+            self._save_offset()
+        while self.count and self.ring[self.head][0] <= seq:
+            self._pop_ring()
+            n += 1
+        self.sent += n
+        self._measure_drain(n)
+
+    def metrics(self):
+        return {"depth": self.depth(), "ram": self.count, "log": self.log_count,
+                "enqueued": self.enqueued, "sent": self.sent, "dropped": self.dropped,
+                "spilled": self.spilled, "drain_rate": self.drain_rate}
+
+    def _measure_drain(self, n):
+        if self.drain_start is None:
+            return
+        self.drain_sent += n
+        elapsed = time.ticks_diff(time.ticks_ms(), self.drain_start)
+        if elapsed > 0:
+            self.drain_rate = self.drain_sent * 1000 / elapsed
+        if self.depth() == 0:
+            self.drain_start = None
+
+    def _pop_ring(self):
+        item = self.ring[self.head]
+        self.ring[self.head] = None
+        self.head = (self.head + 1) % len(self.ring)
+        self.count -= 1
+        return item
+
+    # The log holds one reading per line: seq <tab> feed <tab> value
+    def _append_log(self, item):
+        with open(self.path, "a") as f:
+            f.write("{}\t{}\t{}\n".format(item[0], item[1], item[2]))
+        self.log_count += 1
+
+    def _read_record(self, f):
+        line = f.readline()
+        if not line:
+            return None
+        seq, feed, value = line.rstrip("\n").split("\t", 2)
+        return (int(seq), feed, value)
+
+    def _drop_log(self, n):
+        with open(self.path) as f:
+            f.seek(self.log_offset)
+            while n and self._read_record(f):
+                self.log_count -= 1
+                self.dropped += 1
+                n -= 1
+            self.log_offset = f.tell()
+        self._save_offset()
+
+    # Write the log again with every second reading, which halves how
+    # often this can happen
+    def _downsample_log(self):
+        self._rewrite_log(True)
+        self._save_offset()
+
+    # Write the unsent part of the log to a new file, without what has been
+    # sent or dropped before it. With downsample only every second reading.
+    def _rewrite_log(self, downsample=False):
+        kept = 0
+        with open(self.path) as f, open(self.path + ".new", "w") as out:
+            f.seek(self.log_offset)
+            i = 0
+            while True:
+                record = self._read_record(f)
+                if record is None:
+                    break
+                if not downsample or i % 2:
+                    out.write("{}\t{}\t{}\n".format(record[0], record[1], record[2]))
+                    kept += 1
+                else:
+                    self.dropped += 1
+                i += 1
+        self._replace(self.path + ".new", self.path)
+        self.log_count = kept
+        self.log_offset = 0
+
+    # The offset of the first unsent reading is kept in a small file next
+    # to the log, so after a reboot the sent ones aren't sent again.
+    # An emptied log is removed, and one that's more than half sent or
+    # dropped readings is written again, so it never grows past about
+    # twice log_size readings.
+    def _save_offset(self):
+        if self.log_count == 0:
+            self._remove(self.path)
+            self.log_offset = 0
+        elif self.log_offset > os.stat(self.path)[6] - self.log_offset:
+            self._rewrite_log()
+        with open(self.path + ".pos", "w") as f:
+            f.write(str(self.log_offset))
+
+    def _load_log(self):
+        try:
+            with open(self.path + ".pos") as f:
+                self.log_offset = int(f.read() or 0)
+        except (OSError, ValueError):
+            self.log_offset = 0
+        try:
+            with open(self.path) as f:
+                f.seek(self.log_offset)
+                while True:
+                    record = self._read_record(f)
+                    if record is None:
+                        break
+                    self.log_count += 1
+                    self.seq = max(self.seq, record[0])
+        except OSError:
+            self.log_count = 0
+            self.log_offset = 0
+
+    def _replace(self, source, destination):
+        self._remove(destination)
+        os.rename(source, destination)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
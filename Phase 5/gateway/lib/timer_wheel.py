@@ -0,0 +1,144 @@
+# timerWheel
+# Core Electronics
+# Runs functions after a delay, or every so often, from one place in the
+# main loop. Useful for anything with a deadline: checking a connection
+# is still alive, resending an unacknowledged message, taking a reading.
+#
+# Timers are kept in a ring of slots, one slot per 'resolution' ms, so
+# adding, restarting or cancelling one takes the same short time however
+# many there are, and run() only looks at the slots whose time has come.
+# A timer can fire up to 'resolution' ms late, never early.
+# A callback that raises an exception has it printed, and the other
+# timers (and the same one, if it repeats) carry on as normal.
+#
+# Restarting a timer to a later time (e.g. pushing a timeout back each
+# time a message arrives) only changes the time it's due. It stays in its
+# slot, and when that slot comes round it just moves on. So a timer that
+# is restarted very often costs almost nothing.
+#
+# Example:
+#   timers = timerWheel()
+#   t = timers.add(5000, give_up)           # in 5 seconds
+#   timers.add(60000, take_reading, 60000)  # every minute
+#   timers.restart(t, 5000)                 # 5 seconds from now instead
+#   timers.cancel(t)
+#   while True:
+#       timers.run()
+#       ...
+import time
+
+# A timer is a list: [due, callback, period, slot]
+# slot is where it waits in the ring, -1 when it isn't waiting, or
+# _RUNNING while run() is going through the slot it was in
+_DUE = 0
+_CALLBACK = 1
+_PERIOD = 2
+_SLOT = 3
+_RUNNING = -2
+
+class timerWheel:
+
+    # Parameter: slots
+    #   Number of slots in the ring. Timers further ahead than
+    #   slots * resolution ms go round more than once.
+    # Parameter: resolution
+    #   Milliseconds per slot
+    def __init__(self, slots=64, resolution=100):
+        self.slots = [[] for i in range(slots)]
+        self.spare = []         # swapped with a slot as it's run, so nothing is made
+        self.resolution = resolution
+        self.pos = 0            # slot of the time run() got up to
+        self.last = time.ticks_ms()
+        self.count = 0          # timers waiting
+        self.fired = 0
+
+    # Calls callback() after delay ms, then every 'period' ms if given.
+    # Returns the timer, for restart() and cancel().
+    def add(self, delay, callback, period=0):
+        timer = [time.ticks_add(time.ticks_ms(), delay), callback, period, -1]
+        self._insert(timer, delay)
+        return timer
+
+    # Makes the timer due delay ms from now (its period if not given),
+    # whether or not it was waiting
+    def restart(self, timer, delay=None):
+        if delay is None:
+            delay = timer[_PERIOD]
+        now = time.ticks_ms()
+        due = time.ticks_add(now, delay)
+        if timer[_SLOT] >= 0:
+            if time.ticks_diff(due, timer[_DUE]) >= 0:
+                # Later: it'll find out when its slot comes round
+                timer[_DUE] = due
+                return
+            # Sooner: move it to an earlier slot
+            self.slots[timer[_SLOT]].remove(timer)
+            timer[_SLOT] = -1
+            self.count -= 1
+        timer[_DUE] = due
+        self._insert(timer, delay)
+
+    def cancel(self, timer):
+        if timer[_SLOT] >= 0:
+            self.slots[timer[_SLOT]].remove(timer)
+            self.count -= 1
+        timer[_SLOT] = -1
+
+    # True if the timer is waiting to fire
+    def active(self, timer):
+        return timer[_SLOT] >= 0
+
+    # Calls every timer that is due. Returns how many were.
+    def run(self):
+        now = time.ticks_ms()
+        steps = time.ticks_diff(now, self.last) // self.resolution
+        if steps <= 0:
+            return 0
+        self.last = time.ticks_add(self.last, steps * self.resolution)
+        # Every slot is looked at once at most, however long it's been
+        steps = min(steps, len(self.slots))
+        fired = 0
+        for i in range(steps):
+            self.pos = (self.pos + 1) % len(self.slots)
+            slot = self.slots[self.pos]
+            if not slot:
+                continue
+            self.slots[self.pos] = self.spare
+            self.count -= len(slot)
+            for timer in slot:
+                timer[_SLOT] = _RUNNING
+            for timer in slot:
+                # Cancelled or restarted by an earlier callback
+                if timer[_SLOT] != _RUNNING:
+                    continue
+                timer[_SLOT] = -1
+                left = time.ticks_diff(timer[_DUE], now)
+                if left > 0:
+                    # Restarted, or due on a later time round
+                    self._insert(timer, left)
+                    continue
+                if timer[_PERIOD]:
+                    timer[_DUE] = time.ticks_add(now, timer[_PERIOD])
+                    self._insert(timer, timer[_PERIOD])
+                fired += 1
+                # An error in one callback is printed rather than passed on,
+                # so the rest of the slot still runs and nothing is lost
+                try:
+                    timer[_CALLBACK]()
+                except Exception as e:
+                    print("Timer callback {} failed ({})".format(timer[_CALLBACK], repr(e)))
+            del slot[:]
+            self.spare = slot
+        self.fired += fired
+        return fired
+
+    def _insert(self, timer, delay):
+        ahead = (delay + self.resolution - 1) // self.resolution
+        if ahead < 1:
+            ahead = 1
+        elif ahead >= len(self.slots):
+            ahead = len(self.slots) - 1
+        i = (self.pos + ahead) % len(self.slots)
+        timer[_SLOT] = i
+        self.slots[i].append(timer)
+        self.count += 1
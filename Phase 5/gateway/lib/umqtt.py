@@ -1,12 +1,35 @@
 # https://github.com/micropython/micropython-lib/blob/master/umqtt.simple/umqtt/simple.py
 
+import time
+try:
+    import uos as os
+except ImportError:
+    import os
 import usocket as socket
 import ustruct as struct
 from ubinascii import hexlify
+try:
+    import uselect as select
+except ImportError:
+    import select
+try:
+    import uerrno as errno
+except ImportError:
+    import errno
 
 class MQTTException(Exception):
     pass
 
+def _bytes(s):
+    return s.encode() if isinstance(s, str) else s
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    ticks_ms = lambda: int(time.time() * 1000)
+    ticks_diff = lambda a, b: a - b
+
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
@@ -15,6 +38,8 @@ class MQTTClient:
             port = 8883 if ssl else 1883
         self.client_id = client_id
         self.sock = None
+        self.poll_in = None
+        self.poll_out = None
         self.server = server
         self.port = port
         self.ssl = ssl
@@ -28,20 +53,76 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Packets are built here and sent with one write
+        self.wbuf = bytearray(128)
+        # Incoming bytes are read here in bulk and parsed a packet at a time
+        self.rbuf = bytearray(256)
+        self.rmv = memoryview(self.rbuf)
+        self.rpos = 0
+        self.rlen = 0
+        self.resp = None
+        # Unfinished QoS 1 and 2 publishes, pid: [time sent, packet].
+        # The packet is the PUBLISH until a PUBREC arrives for a QoS 2
+        # publish, then the PUBREL. Either is sent again if not answered.
+        self.inflight = {}
+        # Ids of QoS 2 messages received and passed on, until released
+        self.rcv_pids = set()
+        # File the two above are saved in, see set_persist()
+        self.persist = None
+        # How many can be waiting at once, and when to send one again
+        self.window = 8
+        self.retransmit_ms = 5000
+        # Longest wait in ms (-1 forever) for room to send in the socket.
+        # With 0 a packet there's no room for at all raises OSError(EAGAIN)
+        # straight away, and nothing of it has been sent.
+        self.write_timeout = -1
+        # When something last arrived from the broker, and was last sent
+        self.last_rx = ticks_ms()
+        self.last_tx = self.last_rx
+        self.addr = None
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    def _wbuf(self, n):
+        if len(self.wbuf) < n:
+            self.wbuf = bytearray(n)
+        return self.wbuf
 
-    def _recv_len(self):
-        n = 0
-        sh = 0
-        while 1:
-            b = self.sock.read(1)[0]
-            n |= (b & 0x7f) << sh
-            if not b & 0x80:
-                return n
-            sh += 7
+    def _put_str(self, buf, i, s):
+        struct.pack_into("!H", buf, i, len(s))
+        buf[i + 2:i + 2 + len(s)] = s
+        return i + 2 + len(s)
+
+    # Length a PUBLISH packet will take in wbuf
+    def _publish_size(self, topic, msg, qos):
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        assert sz < 2097152
+        return sz + (2 if sz < 128 else 3 if sz < 16384 else 4)
+
+    # Puts a PUBLISH packet into buf at i, returns where it ends
+    def _put_publish(self, buf, i, topic, msg, retain, qos, pid):
+        buf[i] = 0x30 | qos << 1 | retain
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        i += 1
+        while sz > 0x7f:
+            buf[i] = (sz & 0x7f) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        i = self._put_str(buf, i + 1, topic)
+        if qos > 0:
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
+        buf[i:i + len(msg)] = msg
+        return i + len(msg)
+
+    def _next_pid(self):
+        self.pid = self.pid % 0xFFFF + 1
+        while self.pid in self.inflight:
+            self.pid = self.pid % 0xFFFF + 1
+        return self.pid
 
     def set_callback(self, f):
         self.cb = f
@@ -54,153 +135,461 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
+    # Opens the connection and waits for the broker to accept it.
+    # Returns 1 if the broker still had a session for this client, else 0.
     def connect(self, clean_session=True):
+        self.connect_start(clean_session)
+        while 1:
+            ret = self.connect_poll(-1)
+            if ret is not None:
+                return ret
+
+    # connect() in two halves for callers that mustn't wait: connect_start()
+    # returns once the connection is on its way, then connect_poll() returns
+    # None until the broker has answered and then what connect() would.
+    # Only the address lookup waits, and only if addr hasn't been set
+    # (e.g. with lookup() before anything else is running).
+    def connect_start(self, clean_session=True):
+        if self.addr is None:
+            self.addr = self.lookup()
         self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
         if self.ssl:
             import ussl
+            self.sock.connect(self.addr)
             self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+            self.sock.setblocking(False)
+        else:
+            self.sock.setblocking(False)
+            try:
+                self.sock.connect(self.addr)
+            except OSError as e:
+                if e.args[0] != errno.EINPROGRESS:
+                    raise
+        # The socket stays non-blocking, _fill() and _write() wait for it
+        # with poll instead
+        self.poll_in = select.poll()
+        self.poll_in.register(self.sock, select.POLLIN)
+        self.poll_out = select.poll()
+        self.poll_out.register(self.sock, select.POLLOUT)
+        self.rpos = 0
+        self.rlen = 0
+        self.clean_session = clean_session
+        self.connect_sent = False
+
+    # Looks up the server's address, waiting for DNS. Raises OSError if it
+    # can't be found.
+    def lookup(self):
+        return socket.getaddrinfo(self.server, self.port)[0][-1]
+
+    # Waits up to timeout ms (-1 forever) for the connection to open, then
+    # for the broker's answer
+    def connect_poll(self, timeout=0):
+        if not self.connect_sent:
+            if not self.poll_out.poll(timeout):
+                return None
+            self._send_connect()
+            self.connect_sent = True
+        p = self._next(timeout)
+        if p is None:
+            return None
+        op = self.rbuf[self.rpos]
+        resp = bytes(self.rmv[p[0]:p[1]])
+        self._consume(p[1])
+        if op != 0x20 or len(resp) != 2:
+            raise MQTTException(op)
+        if resp[1] != 0:
+            raise MQTTException(resp[1])
+        if self.clean_session:
+            self.rcv_pids = set()
+        # Finish whatever was left unfinished, e.g. before a reboot or
+        # when the last connection was lost
+        for e in self.inflight.values():
+            e[0] = ticks_ms() - self.retransmit_ms
+        self.retransmit()
+        return resp[0] & 1
 
-        sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
+    def _send_connect(self):
+        client_id = _bytes(self.client_id)
+        sz = 10 + 2 + len(client_id)
+        flags = self.clean_session << 1
         if self.user is not None:
-            sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
-        if self.keepalive:
-            assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
+            sz += 2 + len(_bytes(self.user)) + 2 + len(_bytes(self.pswd))
+            flags |= 0xC0
         if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
-
+            sz += 2 + len(_bytes(self.lw_topic)) + 2 + len(_bytes(self.lw_msg))
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+        assert self.keepalive < 65536
+        buf = self._wbuf(sz + 5)
+        buf[0] = 0x10
         i = 1
         while sz > 0x7f:
-            premsg[i] = (sz & 0x7f) | 0x80
+            buf[i] = (sz & 0x7f) | 0x80
             sz >>= 7
             i += 1
-        premsg[i] = sz
-
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        #print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
+        buf[i] = sz
+        i = self._put_str(buf, i + 1, b"MQTT")
+        struct.pack_into("!BBH", buf, i, 4, flags, self.keepalive)
+        i = self._put_str(buf, i + 4, client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            i = self._put_str(buf, i, _bytes(self.lw_topic))
+            i = self._put_str(buf, i, _bytes(self.lw_msg))
         if self.user is not None:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+            i = self._put_str(buf, i, _bytes(self.user))
+            i = self._put_str(buf, i, _bytes(self.pswd))
+        #print(hexlify(buf[:i], ":"))
+        self._write(buf, i)
 
     def disconnect(self):
-        self.sock.write(b"\xe0\0")
+        self._write(b"\xe0\0", 2)
         self.sock.close()
 
+    # Closes the socket without a DISCONNECT, e.g. once the connection has
+    # stopped working. What's in flight stays, connect() sends it again.
+    def close(self):
+        try:
+            self.sock.close()
+        except (OSError, AttributeError):
+            pass
+
     def ping(self):
-        self.sock.write(b"\xc0\0")
+        self._write(b"\xc0\0", 2)
+
+    def _write(self, buf, n):
+        mv = memoryview(buf)
+        i = 0
+        while i < n:
+            w = self.sock.write(mv[i:n])
+            if w is None:
+                if i == 0 and self.write_timeout == 0:
+                    raise OSError(errno.EAGAIN)
+                if not self.poll_out.poll(self.write_timeout):
+                    raise OSError(errno.ETIMEDOUT)
+            else:
+                i += w
+        self.last_tx = ticks_ms()
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
+        assert 0 <= qos <= 2
+        pid = self._send_publish(_bytes(topic), _bytes(msg), retain, qos)
         if qos > 0:
-            sz += 2
-        assert sz < 2097152
-        i = 1
-        while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+            self._wait_acked((pid,))
+
+    # QoS 1 or 2 publish that doesn't wait for the broker's answer. Only
+    # waits if 'window' publishes are already unfinished. Returns the pid;
+    # it stays in self.inflight until the PUBACK (or PUBCOMP) arrives.
+    def publish_nowait(self, topic, msg, retain=False, qos=1):
+        assert 1 <= qos <= 2
+        while len(self.inflight) >= self.window:
+            self._service(-1)
+        return self._send_publish(_bytes(topic), _bytes(msg), retain, qos)
+
+    # Sends several (topic, msg) publishes in one write.
+    # With qos=1 or 2 it returns once all of them are finished.
+    def publish_many(self, msgs, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        msgs = [(_bytes(t), _bytes(m)) for t, m in msgs]
+        n = 0
+        for topic, msg in msgs:
+            n += self._publish_size(topic, msg, qos)
+        buf = self._wbuf(n)
+        i = 0
+        pids = []
+        for topic, msg in msgs:
+            pid = self._next_pid() if qos > 0 else 0
+            start = i
+            i = self._put_publish(buf, i, topic, msg, retain, qos, pid)
+            if qos > 0:
+                pids.append(pid)
+                self.inflight[pid] = [ticks_ms(), buf[start:i]]
+        self._save()
+        self._write(buf, i)
+        self._wait_acked(pids)
+
+    def _send_publish(self, topic, msg, retain, qos):
+        pid = self._next_pid() if qos > 0 else 0
+        buf = self._wbuf(self._publish_size(topic, msg, qos))
+        n = self._put_publish(buf, 0, topic, msg, retain, qos, pid)
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
+            self.inflight[pid] = [ticks_ms(), buf[:n]]
+            self._save()
+        self._write(buf, n)
+        return pid
+
+    # Waits until every QoS 1 and 2 publish is finished, or until
+    # timeout milliseconds have passed. Returns True if they all were.
+    def flush(self, timeout=None):
+        start = ticks_ms()
+        while self.inflight:
+            if timeout is None:
+                self._service(-1)
+            else:
+                left = timeout - ticks_diff(ticks_ms(), start)
+                if left <= 0:
+                    return False
+                self._service(left)
+        return True
+
+    def _wait_acked(self, pids):
+        for pid in pids:
+            while pid in self.inflight:
+                self._service(-1)
+
+    # Sends again packets the broker hasn't answered in time.
+    # A PUBLISH sent again has the DUP flag set.
+    def retransmit(self):
+        now = ticks_ms()
+        for pid in self.inflight:
+            e = self.inflight[pid]
+            if ticks_diff(now, e[0]) >= self.retransmit_ms:
+                if e[1][0] & 0xf0 == 0x30:
+                    e[1][0] |= 8
+                try:
+                    self._write(e[1], len(e[1]))
+                except OSError as x:
+                    # No room in the socket, try the rest next time
+                    if x.args[0] == errno.EAGAIN:
                         return
-        elif qos == 2:
-            assert 0
+                    raise
+                e[0] = now
+
+    # Keeps the in-flight state in the file 'path' (e.g. on flash) from
+    # now on, so a reboot doesn't lose or repeat QoS 2 messages. Loads
+    # what was saved there; connect(clean_session=False) finishes it.
+    def set_persist(self, path):
+        self.persist = path
+        try:
+            f = open(path, "rb")
+        except OSError:
+            try:
+                f = open(path + ".tmp", "rb")
+            except OSError:
+                return
+        with f:
+            data = f.read()
+        i = 0
+        while i + 2 <= len(data):
+            n = data[i] << 8 | data[i + 1]
+            i += 2
+            if n == 0:
+                break
+            pkt = bytearray(data[i:i + n])
+            i += n
+            # The pid is just before the payload of a PUBLISH, or last in a PUBREL
+            if pkt[0] & 0xf0 == 0x30:
+                j = 1
+                while pkt[j] & 0x80:
+                    j += 1
+                j += 3 + (pkt[j + 1] << 8 | pkt[j + 2])
+                pid = pkt[j] << 8 | pkt[j + 1]
+            else:
+                pid = pkt[2] << 8 | pkt[3]
+            self.inflight[pid] = [ticks_ms(), pkt]
+            self.pid = max(self.pid, pid)
+        while i + 2 <= len(data):
+            self.rcv_pids.add(data[i] << 8 | data[i + 1])
+            i += 2
+
+    # Saved as: each in-flight packet as a 2 byte length and its bytes,
+    # a zero length, then the 2 byte ids in rcv_pids. Written to a new
+    # file first so a reboot part way through keeps the old one.
+    def _save(self):
+        if not self.persist:
+            return
+        tmp = self.persist + ".tmp"
+        with open(tmp, "wb") as f:
+            for e in self.inflight.values():
+                f.write(struct.pack("!H", len(e[1])))
+                f.write(e[1])
+            f.write(b"\0\0")
+            for pid in self.rcv_pids:
+                f.write(struct.pack("!H", pid))
+        try:
+            os.remove(self.persist)
+        except OSError:
+            pass
+        os.rename(tmp, self.persist)
+
+    # If there's no room to send it (write_timeout=0) the broker sends its
+    # packet again, and it's answered then
+    def _ack(self, op, pid):
+        struct.pack_into("!BBH", self.wbuf, 0, op, 2, pid)
+        try:
+            self._write(self.wbuf, 4)
+        except OSError as e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+
+    # Processes incoming packets, waiting up to timeout ms (-1 forever)
+    # for one but not past the next retransmit
+    def _service(self, timeout):
+        now = ticks_ms()
+        for e in self.inflight.values():
+            due = max(0, self.retransmit_ms - ticks_diff(now, e[0]))
+            if timeout < 0 or due < timeout:
+                timeout = due
+        p = self._next(timeout)
+        while p:
+            self._process(p[0], p[1])
+            p = self._next(0)
+        self.retransmit()
 
     def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
+        pid = self.subscribe_nowait(topic, qos)
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self.sock.read(4)
+                resp = self.resp
                 #print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                assert resp[0] == pid >> 8 and resp[1] == pid & 0xFF
+                if resp[2] == 0x80:
+                    raise MQTTException(resp[2])
                 return
 
-    # Wait for a single incoming MQTT message and process it.
-    # Subscribed messages are delivered to a callback previously
-    # set by .set_callback() method. Other (internal) MQTT
-    # messages processed internally.
-    def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
+    # Sends the SUBSCRIBE and returns its pid without waiting for the
+    # SUBACK, which check_msg() passes over like any other answer
+    def subscribe_nowait(self, topic, qos=0):
+        assert self.cb is not None, "Subscribe callback is not set"
+        topic = _bytes(topic)
+        buf = self._wbuf(7 + len(topic))
+        pid = self._next_pid()
+        struct.pack_into("!BBH", buf, 0, 0x82, 2 + 2 + len(topic) + 1, pid)
+        i = self._put_str(buf, 4, topic)
+        buf[i] = qos
+        self._write(buf, i + 1)
+        return pid
+
+    # Reads whatever has arrived into rbuf, first waiting up to timeout ms
+    # (-1 forever) for something. Returns False if nothing was waiting.
+    def _fill(self, timeout):
+        if self.rlen == len(self.rbuf):
+            if self.rpos:
+                # Move the unprocessed part to the front
+                self.rlen -= self.rpos
+                self.rbuf[:self.rlen] = self.rbuf[self.rpos:self.rpos + self.rlen]
+                self.rpos = 0
+            else:
+                buf = bytearray(2 * len(self.rbuf))
+                buf[:self.rlen] = self.rbuf
+                self.rbuf = buf
+                self.rmv = memoryview(buf)
+        if timeout:
+            self.poll_in.poll(timeout)
+        n = self.sock.readinto(self.rmv[self.rlen:])
+        if n is None:
+            return False
+        if n == 0:
             raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
+        self.rlen += n
+        self.last_rx = ticks_ms()
+        return True
+
+    # Returns where the body of the next packet in rbuf starts and ends,
+    # or None if it hasn't all arrived yet
+    def _parse(self):
+        n = 0
+        sh = 0
+        i = self.rpos + 1
+        while 1:
+            if i >= self.rlen:
+                return None
+            b = self.rbuf[i]
+            n |= (b & 0x7f) << sh
+            i += 1
+            if not b & 0x80:
+                break
+            sh += 7
+        if i + n > self.rlen:
             return None
-        op = res[0]
+        return i, i + n
+
+    def _consume(self, end):
+        self.rpos = end
+        if self.rpos == self.rlen:
+            self.rpos = 0
+            self.rlen = 0
+
+    # True if a whole packet is waiting in rbuf
+    def pending(self):
+        return self._parse() is not None
+
+    def _next(self, timeout):
+        while 1:
+            p = self._parse()
+            if p:
+                return p
+            if not self._fill(timeout):
+                return None
+
+    # Processes the packet in rbuf at start:end.
+    # The body of anything but a PUBLISH is left in self.resp.
+    def _process(self, start, end):
+        op = self.rbuf[self.rpos]
         if op & 0xf0 != 0x30:
+            self.resp = bytes(self.rmv[start:end])
+            self._consume(end)
+            if op == 0xd0:  # PINGRESP
+                return None
+            pid = self.resp[0] << 8 | self.resp[1] if len(self.resp) >= 2 else 0
+            if op == 0x40 or op == 0x70:  # PUBACK, PUBCOMP
+                if self.inflight.pop(pid, None):
+                    self._save()
+            elif op == 0x50:  # PUBREC
+                e = self.inflight.get(pid)
+                if e and e[1][0] & 0xf0 == 0x30:
+                    e[0] = ticks_ms()
+                    e[1] = bytearray(b"\x62\x02\0\0")
+                    e[1][2] = pid >> 8
+                    e[1][3] = pid & 0xFF
+                    self._save()
+                self._ack(0x62, pid)
+            elif op == 0x62:  # PUBREL
+                if pid in self.rcv_pids:
+                    self.rcv_pids.remove(pid)
+                    self._save()
+                self._ack(0x70, pid)
             return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+        i = start + 2 + (self.rbuf[start] << 8 | self.rbuf[start + 1])
+        topic = bytes(self.rmv[start + 2:i])
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
+            pid = self.rbuf[i] << 8 | self.rbuf[i + 1]
+            i += 2
+        msg = bytes(self.rmv[i:end])
+        self._consume(end)
+        if op & 6 == 4:
+            # QoS 2: pass it on only the first time, until it's released
+            if pid not in self.rcv_pids:
+                self.cb(topic, msg)
+                self.rcv_pids.add(pid)
+                self._save()
+            self._ack(0x50, pid)
+            return
         self.cb(topic, msg)
         if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
-
-    # Checks whether a pending message from server is available.
-    # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+            self._ack(0x40, pid)
+
+    # Wait for a single incoming MQTT message and process it.
+    # Subscribed messages are delivered to a callback previously
+    # set by .set_callback() method. Other (internal) MQTT
+    # messages processed internally.
+    # Returns None, like check_msg(), if the socket woke up with nothing to read.
+    def wait_msg(self):
+        p = self._next(-1)
+        if p is None:
+            return None
+        return self._process(p[0], p[1])
+
+    # Processes every message from the server that has arrived.
+    # If there are none, returns immediately with None. Otherwise
+    # returns what wait_msg would for the last one.
+    # Also resends QoS 1 publishes that weren't acknowledged in time.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        op = None
+        while 1:
+            p = self._next(0)
+            if p is None:
+                break
+            op = self._process(p[0], p[1])
+        if self.inflight:
+            self.retransmit()
+        return op
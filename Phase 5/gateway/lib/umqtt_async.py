@@ -0,0 +1,352 @@
+# asyncio (uasyncio) wrapper for umqtt's MQTTClient.
+# Socket reads only start once the broker has sent something, so waiting
+# for MQTT messages doesn't stop other tasks from running.
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+try:
+    import uselect as select
+except ImportError:
+    import select
+try:
+    import uerrno as errno
+except ImportError:
+    import errno
+try:
+    import _thread
+except ImportError:
+    _thread = None
+try:
+    from machine import rng     # 24 random bits
+except ImportError:
+    from random import getrandbits
+    rng = lambda: getrandbits(24)
+from umqtt import ticks_ms, ticks_diff
+from timer_wheel import timerWheel
+
+class MQTTClientAsync:
+
+    # Seconds between checks of the socket while waiting for data
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, client):
+        self.client = client
+        self.poller = None
+        self.poll_sock = None
+
+    # Like MQTTClient.connect(), but other tasks run while the connection
+    # opens. Raises OSError if it takes longer than timeout ms.
+    async def connect(self, clean_session=True, timeout=None):
+        self.client.connect_start(clean_session)
+        start = ticks_ms()
+        while 1:
+            ret = self.client.connect_poll()
+            if ret is not None:
+                return ret
+            if timeout is not None and ticks_diff(ticks_ms(), start) > timeout:
+                raise OSError(errno.ETIMEDOUT)
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def disconnect(self):
+        self.client.disconnect()
+        await asyncio.sleep(0)
+
+    async def _readable(self):
+        # connect() makes a new socket, so follow whichever one is current
+        if self.poll_sock is not self.client.sock:
+            self.poller = select.poll()
+            self.poller.register(self.client.sock, select.POLLIN)
+            self.poll_sock = self.client.sock
+        # A packet may already be waiting in the client's receive buffer
+        while not self.client.pending() and not self.poller.poll(0):
+            self._waiting()
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    # Waits for room in the socket to send something
+    async def _writable(self):
+        while not self.client.poll_out.poll(0):
+            self._waiting()
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    # Called every POLL_INTERVAL while nothing has arrived
+    def _waiting(self):
+        # Nothing may come if a PUBACK was lost, so resend from here too
+        if self.client.inflight:
+            self.client.retransmit()
+
+    async def ping(self):
+        self.client.ping()
+        await asyncio.sleep(0)
+
+    # qos=1 or 2 doesn't wait for the broker's answer (see
+    # MQTTClient.publish_nowait()), only for a free place in the client's
+    # window. Use flush() to wait until everything is acknowledged.
+    # Returns the pid, which stays in client.inflight until it is (0 for qos=0).
+    async def publish(self, topic, msg, retain=False, qos=0):
+        pid = 0
+        if qos > 0:
+            while len(self.client.inflight) >= self.client.window:
+                self.client.check_msg()
+                if len(self.client.inflight) < self.client.window:
+                    break
+                await asyncio.sleep(self.POLL_INTERVAL)
+            await self._writable()
+            try:
+                pid = self.client.publish_nowait(topic, msg, retain, qos)
+            except OSError as e:
+                if e.args[0] != errno.EAGAIN:
+                    raise
+                # Already in inflight (the last pid given out), so it goes
+                # with the next retransmit
+                pid = self.client.pid
+        else:
+            await self._writable()
+            self.client.publish(topic, msg, retain, qos)
+        await asyncio.sleep(0)
+        return pid
+
+    async def flush(self):
+        while self.client.inflight:
+            self.client.check_msg()
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def publish_many(self, msgs, retain=False, qos=0):
+        self.client.publish_many(msgs, retain, qos)
+        await asyncio.sleep(0)
+
+    async def subscribe(self, topic, qos=0):
+        self.client.subscribe(topic, qos)
+        await asyncio.sleep(0)
+
+    # Wait for incoming MQTT messages and process all that have arrived,
+    # see MQTTClient.check_msg()
+    async def wait_msg(self):
+        await self._readable()
+        return self.client.check_msg()
+
+
+# Keeps an MQTTClient connected. run() connects, passes incoming messages
+# on and, whenever the connection is lost, connects again: at once the
+# first time, then waiting longer after each failure (plus a random part,
+# so gateways that lost the broker together don't all return together).
+# A connection is taken as lost when the socket fails, or when nothing
+# arrives for ping_timeout ms after a PINGREQ. A PINGREQ is only sent when
+# the connection has been idle (nothing sent, or nothing received) for
+# ping_interval ms, which also keeps the broker's keepalive happy. The
+# broker's address is looked up in a thread of its own (DNS can take
+# seconds): the first time, and again after RESOLVE_AFTER failed attempts
+# in a row in case it has changed. After
+# connecting it subscribes again unless the broker kept the session, and
+# publishes that weren't acknowledged are sent again. Nothing here waits
+# on the network, so other tasks keep running throughout. Any error from
+# the connection (a bad packet as well as a failed socket) means connecting
+# again, and an error in the client's callback is printed and the message
+# dropped, so run() itself never stops.
+#
+# Example:
+#   aio = MQTTSupervisor(MQTTClient(..., keepalive=60), timers=timers)
+#   await aio.subscribe(topic)      # remembered, and sent if connected
+#   asyncio.create_task(aio.run())
+#   await aio.publish(topic, msg, qos=1)    # OSError while disconnected
+class MQTTSupervisor(MQTTClientAsync):
+
+    # All in milliseconds
+    CONNECT_TIMEOUT = 10000
+    BACKOFF_MIN = 1000
+    BACKOFF_MAX = 60000
+    # Failed connection attempts in a row before looking the address up again
+    RESOLVE_AFTER = 5
+    # Ms before trying a PINGREQ again that there was no room to send
+    PING_RETRY = 1000
+
+    # Parameter: ping_interval
+    #   Idle ms before a PINGREQ. Half the client's keepalive by default,
+    #   or 30 seconds if it has none.
+    # Parameter: timers
+    #   timerWheel for the ping checks, run by the caller (e.g. a
+    #   housekeeping task shared with other timers). Without one the
+    #   supervisor makes its own and runs it itself.
+    def __init__(self, client, clean_session=True, ping_interval=None, ping_timeout=10000, timers=None):
+        MQTTClientAsync.__init__(self, client)
+        self.clean_session = clean_session
+        if ping_interval is None:
+            ping_interval = client.keepalive * 500 if client.keepalive else 30000
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        # A full socket raises OSError(EAGAIN) rather than holding everything
+        # up. publish() waits for room first, letting other tasks run.
+        client.write_timeout = 0
+        self.subscriptions = []
+        self.connected = False
+        self.own_timers = timers is None
+        self.timers = timerWheel() if timers is None else timers
+        # Made now, started once connected
+        self.ping_timer = self.timers.add(ping_interval, self._check_idle)
+        self.pong_timer = self.timers.add(ping_timeout, self._check_pong)
+        self.timers.cancel(self.ping_timer)
+        self.timers.cancel(self.pong_timer)
+        self.pinged = None      # when the last PINGREQ went
+        self.timed_out = False
+        # The client's own callback, called through _deliver()
+        self.callback = None
+        self.deliver = self._deliver
+        # Address lookups, see _resolve()
+        self.resolving = False
+        self.resolved = None
+        # Metrics
+        self.connects = 0
+        self.failed_connects = 0
+        self.lost = 0
+        self.pings = 0
+
+    # Milliseconds to wait before connection attempt number 'attempt'
+    # (0, 1, 2 ...): doubles each time up to BACKOFF_MAX, and anywhere
+    # from half of that to all of it
+    def _backoff(self, attempt):
+        limit = min(self.BACKOFF_MAX, self.BACKOFF_MIN << min(attempt, 16))
+        return limit // 2 + rng() % (limit // 2 + 1)
+
+    # Looks the broker's address up without holding up the event loop, in a
+    # thread if there are threads. Returns None if it can't be found.
+    async def _resolve(self):
+        self.resolving = True
+        self.resolved = None
+        if _thread is None:
+            self._lookup()
+        else:
+            _thread.start_new_thread(self._lookup, ())
+        while self.resolving:
+            await asyncio.sleep(self.POLL_INTERVAL)
+        return self.resolved
+
+    def _lookup(self):
+        try:
+            self.resolved = self.client.lookup()
+        except Exception as e:
+            print("MQTT address lookup failed ({})".format(repr(e)))
+        self.resolving = False
+
+    async def run(self):
+        attempt = 0
+        while True:
+            try:
+                # The address found last time is kept if the lookup fails
+                if self.client.addr is None or (attempt > 0 and attempt % self.RESOLVE_AFTER == 0):
+                    addr = await self._resolve()
+                    if addr is not None:
+                        self.client.addr = addr
+                    elif self.client.addr is None:
+                        raise OSError(errno.EHOSTUNREACH)
+                present = await self.connect(self.clean_session, self.CONNECT_TIMEOUT)
+            except Exception as e:
+                self.client.close()
+                self.failed_connects += 1
+                delay = self._backoff(attempt)
+                attempt += 1
+                print("MQTT connect failed ({}), trying again in {} ms".format(repr(e), delay))
+                await asyncio.sleep(delay / 1000)
+                continue
+            attempt = 0
+            self.connects += 1
+            self.timed_out = False
+            self.connected = True
+            self.timers.restart(self.ping_timer, self.ping_interval)
+            self.timers.cancel(self.pong_timer)
+            print("MQTT connected to {}".format(self.client.server))
+            # Set here, as the callback is usually set after making the supervisor
+            if self.client.cb is not self.deliver:
+                self.callback = self.client.cb
+                self.client.set_callback(self.deliver)
+            try:
+                if not present:
+                    for topic, qos in self.subscriptions:
+                        self.client.subscribe_nowait(topic, qos)
+                while self.connected:
+                    await self.wait_msg()
+                    if self.own_timers:
+                        self.timers.run()
+                raise OSError(errno.ETIMEDOUT if self.timed_out else errno.ENOTCONN)
+            except Exception as e:
+                # OSError, MQTTException, or a packet that couldn't be read
+                # (e.g. AssertionError): the stream can't be trusted any more
+                print("MQTT connection lost ({})".format(repr(e)))
+            self.connected = False
+            self.lost += 1
+            self.timers.cancel(self.ping_timer)
+            self.timers.cancel(self.pong_timer)
+            self.client.close()
+
+    # Passes a message on to the client's callback. If that fails the
+    # message is dropped (it's still acknowledged) rather than ending run().
+    def _deliver(self, topic, msg):
+        try:
+            self.callback(topic, msg)
+        except Exception as e:
+            print("MQTT callback failed on {} {} ({})".format(topic, msg, repr(e)))
+
+    def _waiting(self):
+        if self.own_timers:
+            self.timers.run()
+        if not self.connected:
+            raise OSError(errno.ETIMEDOUT if self.timed_out else errno.ENOTCONN)
+        MQTTClientAsync._waiting(self)
+
+    # Sends a PINGREQ if nothing has been sent, or nothing received, for
+    # ping_interval ms. Otherwise looks again when that will be.
+    def _check_idle(self):
+        c = self.client
+        now = ticks_ms()
+        idle = max(ticks_diff(now, c.last_tx), ticks_diff(now, c.last_rx))
+        if idle < self.ping_interval:
+            self.timers.restart(self.ping_timer, self.ping_interval - idle)
+            return
+        try:
+            c.ping()
+        except OSError as e:
+            if e.args[0] == errno.EAGAIN:
+                self.timers.restart(self.ping_timer, self.PING_RETRY)
+            else:
+                self.connected = False
+            return
+        self.pings += 1
+        self.pinged = now
+        self.timers.restart(self.pong_timer, self.ping_timeout)
+        self.timers.restart(self.ping_timer, self.ping_interval)
+
+    # Nothing at all has arrived since the PINGREQ: the connection is dead
+    def _check_pong(self):
+        if ticks_diff(self.client.last_rx, self.pinged) < 0:
+            self.timed_out = True
+            self.connected = False
+
+    async def subscribe(self, topic, qos=0):
+        self.subscriptions.append((topic, qos))
+        if self.connected:
+            self.client.subscribe_nowait(topic, qos)
+        await asyncio.sleep(0)
+
+    # Raises OSError straight away while disconnected. A publish with
+    # qos=1 or 2 that has been sent is kept until it's acknowledged, even
+    # across connections.
+    async def publish(self, topic, msg, retain=False, qos=0):
+        if not self.connected:
+            raise OSError(errno.ENOTCONN)
+        try:
+            return await MQTTClientAsync.publish(self, topic, msg, retain, qos)
+        except OSError as e:
+            # Tell run() too, it may not have noticed yet. No room in the
+            # socket doesn't mean the connection is lost.
+            if e.args[0] != errno.EAGAIN:
+                self.connected = False
+            raise
+
+    # Waits until the broker has acknowledged every publish in pids (as
+    # publish() returned them). run() reads the acknowledgements, and sends
+    # the publishes again after connecting again, so this keeps waiting
+    # while disconnected rather than failing.
+    async def acked(self, pids):
+        for pid in pids:
+            while pid in self.client.inflight:
+                await asyncio.sleep(self.POLL_INTERVAL)
@@ -1,5 +1,6 @@
 import time
 from machine import I2C
+from i2c_bus import I2CBus
 
 class LTR329ALS01:
     ALS_I2CADDR = const(0x29) # The device's I2C address
@@ -35,18 +36,60 @@ class LTR329ALS01:
     ALS_RATE_1000 = const(0x04)
     ALS_RATE_2000 = const(0x05)
 
-    def __init__(self, pysense = None, sda = 'P22', scl = 'P21', gain = ALS_GAIN_1X, integration = ALS_INT_100, rate = ALS_RATE_500):
+    ALS_STATUS_REG = const(0x8C)
+    ALS_STATUS_NEW_DATA = const(0x04)
+
+    # multipliers for the gain and integration time codes
+    GAIN = {ALS_GAIN_1X: 1, ALS_GAIN_2X: 2, ALS_GAIN_4X: 4, ALS_GAIN_8X: 8, ALS_GAIN_48X: 48, ALS_GAIN_96X: 96}
+    INTEGRATION_MS = {ALS_INT_50: 50, ALS_INT_100: 100, ALS_INT_150: 150, ALS_INT_200: 200,
+                      ALS_INT_250: 250, ALS_INT_300: 300, ALS_INT_350: 350, ALS_INT_400: 400}
+    RATE_MS = {ALS_RATE_50: 50, ALS_RATE_100: 100, ALS_RATE_200: 200, ALS_RATE_500: 500,
+               ALS_RATE_1000: 1000, ALS_RATE_2000: 2000}
+
+    # (gain, integration) settings auto ranging moves between, least sensitive first:
+    # 0.5x to 384x the counts of 1X/100ms, covering the datasheet's 0.01 to 64k lux
+    RANGES = ((ALS_GAIN_1X, ALS_INT_50), (ALS_GAIN_1X, ALS_INT_100), (ALS_GAIN_2X, ALS_INT_100),
+              (ALS_GAIN_4X, ALS_INT_100), (ALS_GAIN_8X, ALS_INT_100), (ALS_GAIN_48X, ALS_INT_100),
+              (ALS_GAIN_96X, ALS_INT_100), (ALS_GAIN_96X, ALS_INT_200), (ALS_GAIN_96X, ALS_INT_400))
+    # counts above SATURATED may be clipped; ranging aims to keep the larger channel below TARGET
+    SATURATED = const(0xFF00)
+    TARGET = const(0x8000)
+
+    def __init__(self, pysense = None, sda = 'P22', scl = 'P21', gain = ALS_GAIN_1X, integration = ALS_INT_100, rate = ALS_RATE_500, auto_range = True):
         if pysense is not None:
             self.i2c = pysense.i2c
+            self.bus = pysense.bus
         else:
             self.i2c = I2C(0, mode=I2C.MASTER, pins=(sda, scl))
+            self.bus = I2CBus(self.i2c)
+        self.byte = bytearray(1)
+        self.data = bytearray(4)    # CH1 low/high, CH0 low/high
+        self.auto_range = auto_range
+        self.measurements = 0
+        self.range_changes = 0
+
+        self.set_gain(gain, integration, rate)
+
+    def set_gain(self, gain, integration, rate = None):
+        """ changing the gain and integration time (ALS_GAIN_*, ALS_INT_*). The measurement rate is
+            kept, or made longer than the integration time if it isn't already """
+        if rate is None:
+            rate = self.rate
+        if self.RATE_MS[rate] < self.INTEGRATION_MS[integration]:
+            rate = ALS_RATE_500
+        self.gain = gain
+        self.integration = integration
+        self.rate = rate
 
         contr = self._getContr(gain)
-        self.i2c.writeto_mem(ALS_I2CADDR, ALS_CONTR_REG, bytearray([contr]))
+        self.byte[0] = contr
+        self.bus.write_mem(ALS_I2CADDR, ALS_CONTR_REG, self.byte)
 
         measrate = self._getMeasRate(integration, rate)
-        self.i2c.writeto_mem(ALS_I2CADDR, ALS_MEAS_RATE_REG, bytearray([measrate]))
+        self.byte[0] = measrate
+        self.bus.write_mem(ALS_I2CADDR, ALS_MEAS_RATE_REG, self.byte)
 
+        self.changed = time.ticks_ms()
         time.sleep(0.01)
 
     def _getContr(self, gain):
@@ -59,12 +102,69 @@ class LTR329ALS01:
         return ((high & 0xFF) << 8) + (low & 0xFF)
 
     def light(self):
-        ch1low = self.i2c.readfrom_mem(ALS_I2CADDR , ALS_DATA_CH1_LOW, 1)
-        ch1high = self.i2c.readfrom_mem(ALS_I2CADDR , ALS_DATA_CH1_HIGH, 1)
-        data1 = int(self._getWord(ch1high[0], ch1low[0]))
-
-        ch0low = self.i2c.readfrom_mem(ALS_I2CADDR , ALS_DATA_CH0_LOW, 1)
-        ch0high = self.i2c.readfrom_mem(ALS_I2CADDR , ALS_DATA_CH0_HIGH, 1)
-        data0 = int(self._getWord(ch0high[0], ch0low[0]))
-
-        return (data0, data1)
+        """ the raw counts (CH0 visible + infrared, CH1 infrared) at the current gain and integration
+            time, read in one transfer """
+        data = self.bus.read_mem(ALS_I2CADDR, ALS_DATA_CH1_LOW, self.data)
+        self.measurements += 1
+        return (self._getWord(data[3], data[2]), self._getWord(data[1], data[0]))
+
+    def _sensitivity(self, gain, integration):
+        return self.GAIN[gain] * self.INTEGRATION_MS[integration]
+
+    def _lux(self, ch0, ch1):
+        """ the datasheet's (appendix A) conversion from counts to lux """
+        if ch0 + ch1 == 0:
+            return 0.0
+        ratio = ch1 / (ch0 + ch1)
+        if ratio < 0.45:
+            lux = 1.7743 * ch0 + 1.1059 * ch1
+        elif ratio < 0.64:
+            lux = 4.2785 * ch0 - 1.9548 * ch1
+        elif ratio < 0.85:
+            lux = 0.5926 * ch0 + 0.1185 * ch1
+        else:
+            lux = 0.0
+        return lux * 100 / self._sensitivity(self.gain, self.integration)
+
+    def _best_range(self, ch0, ch1):
+        """ the (gain, integration) to measure with next: the least sensitive of RANGES if the counts
+            are saturated, otherwise the most sensitive that should keep them below TARGET, or the
+            current one if none is more sensitive """
+        peak = max(ch0, ch1)
+        if peak >= SATURATED:
+            return self.RANGES[0]
+        now = self._sensitivity(self.gain, self.integration)
+        best = (self.gain, self.integration)
+        for gain, integration in self.RANGES:
+            sensitivity = self._sensitivity(gain, integration)
+            if sensitivity > now and peak * sensitivity < TARGET * now:
+                best = (gain, integration)
+        return best
+
+    def wait_for_data(self):
+        """ waiting until a measurement with the current gain and integration time is ready:
+            the integration time, then polls of the status register """
+        left = self.INTEGRATION_MS[self.integration] - time.ticks_diff(time.ticks_ms(), self.changed)
+        if left > 0:
+            time.sleep_ms(left)
+        timeout = self.RATE_MS[self.rate] + self.INTEGRATION_MS[self.integration]
+        while time.ticks_diff(time.ticks_ms(), self.changed) < timeout:
+            status = self.bus.read_mem(ALS_I2CADDR, ALS_STATUS_REG, self.byte)[0]
+            if status & ALS_STATUS_NEW_DATA and (status >> 4) & 0x07 == self.gain:
+                return
+            time.sleep_ms(10)
+
+    def lux(self):
+        """ the ambient light (lux). With auto_range, if the counts are saturated or small the
+            gain and integration time are changed and it's measured again """
+        ch0, ch1 = self.light()
+        if self.auto_range:
+            for i in range(2):
+                gain, integration = self._best_range(ch0, ch1)
+                if gain == self.gain and integration == self.integration:
+                    break
+                self.range_changes += 1
+                self.set_gain(gain, integration)
+                self.wait_for_data()
+                ch0, ch1 = self.light()
+        return self._lux(ch0, ch1)
@@ -1,5 +1,6 @@
 import time
 from machine import I2C
+from i2c_bus import I2CBus, CRCError
 import math
 
 __version__ = '0.0.2'
@@ -14,34 +15,164 @@ class SI7006A20:
 
     TEMP_NOHOLDMASTER = const(0xF3)
     HUMD_NOHOLDMASTER = const(0xF5)
+    TEMP_PREV_RH = const(0xE0)
+
+    # conversion times (ms): typical, then the longest the sensor may take
+    # (an RH measurement converts temperature too)
+    TEMP_CONV_TYP = const(7)
+    HUMD_CONV_TYP = const(17)
+    CONV_TIMEOUT = const(50)
+    # polls while converting wait 1, 2, 4, 4... ms
+    POLL_MAX_WAIT = const(4)
 
     def __init__(self, pysense = None, sda = 'P22', scl = 'P21'):
         if pysense is not None:
             self.i2c = pysense.i2c
+            self.bus = pysense.bus
         else:
             self.i2c = I2C(0, mode=I2C.MASTER, pins=(sda, scl))
+            self.bus = I2CBus(self.i2c)
+        self.command = None
+        self.started = 0
+        self.attempt = 0
+        self.polls = 0
+        self.cmd = bytearray(1)
+        self.data = bytearray(3)    # measurement + CRC
+        self.prev = bytearray(2)    # TEMP_PREV_RH has no CRC...
+        self.check = bytearray(2)   # ...so it's read twice
 
     def _getWord(self, high, low):
         return ((high & 0xFF) << 8) + (low & 0xFF)
 
+    def _temp(self, data):
+        return ((175.72 * data) / 65536.0) - 46.85
+
+    def _humid(self, data):
+        return ((125.0 * data) / 65536.0) - 6.0
+
+    def start(self, command):
+        """ starting a no-hold-master measurement (TEMP_NOHOLDMASTER or HUMD_NOHOLDMASTER)
+            without waiting for it """
+        self._start(command)
+        self.attempt = 0
+
+    def _start(self, command):
+        self.cmd[0] = command
+        self.bus.write(SI7006A20_I2C_ADDR, self.cmd)
+        self.command = command
+        self.started = time.ticks_ms()
+
+    def start_temperature(self):
+        self.start(TEMP_NOHOLDMASTER)
+
+    def start_humidity(self):
+        self.start(HUMD_NOHOLDMASTER)
+
+    def result(self):
+        """ the result of the measurement started last, or None while the sensor is
+            still converting (it NACKs the read). A result that fails its CRC check is measured
+            again. Raises OSError if it takes too long, CRCError if it keeps failing """
+        self.polls += 1
+        try:
+            data = self.bus.poll(SI7006A20_I2C_ADDR, self.data, crc=True)
+        except CRCError:
+            if not self.bus.retry(self.attempt):
+                self.command = None
+                raise
+            self.attempt += 1
+            self._start(self.command)
+            return None
+        if data is None:
+            if time.ticks_diff(time.ticks_ms(), self.started) > CONV_TIMEOUT:
+                self.command = None
+                raise OSError('SI7006A20 timeout')
+            return None
+        data = self._getWord(data[0], data[1])
+        if self.command == HUMD_NOHOLDMASTER:
+            value = self._humid(data)
+        else:
+            value = self._temp(data)
+        self.command = None
+        return value
+
+    def _first_wait(self, command):
+        return HUMD_CONV_TYP if command == HUMD_NOHOLDMASTER else TEMP_CONV_TYP
+
+    def measure(self, command):
+        """ starting a measurement and waiting for the result: the typical conversion time,
+            then polls a few ms apart """
+        self.start(command)
+        time.sleep_ms(self._first_wait(command))
+        wait = 1
+        while True:
+            value = self.result()
+            if value is not None:
+                return value
+            time.sleep_ms(wait)
+            wait = min(wait * 2, POLL_MAX_WAIT)
+
+    async def measure_async(self, command):
+        """ like measure(), letting other (u)asyncio tasks run while the sensor converts """
+        try:
+            import uasyncio as asyncio
+        except ImportError:
+            import asyncio
+        self.start(command)
+        await asyncio.sleep(self._first_wait(command) / 1000)
+        wait = 1
+        while True:
+            value = self.result()
+            if value is not None:
+                return value
+            await asyncio.sleep(wait / 1000)
+            wait = min(wait * 2, POLL_MAX_WAIT)
+
     def temperature(self):
         """ obtaining the temperature(degrees Celsius) measured by sensor """
-        self.i2c.writeto(SI7006A20_I2C_ADDR, bytearray([0xF3]))
-        time.sleep(0.5)
-        data = self.i2c.readfrom(SI7006A20_I2C_ADDR, 3)
-        #print("CRC Raw temp data: " + hex(data[0]*65536 + data[1]*256 + data[2]))
-        data = self._getWord(data[0], data[1])
-        temp = ((175.72 * data) / 65536.0) - 46.85
-        return temp
+        return self.measure(TEMP_NOHOLDMASTER)
 
     def humidity(self):
         """ obtaining the relative humidity(%) measured by sensor """
-        self.i2c.writeto(SI7006A20_I2C_ADDR, bytearray([0xF5]))
-        time.sleep(0.5)
-        data = self.i2c.readfrom(SI7006A20_I2C_ADDR, 2)
-        data = self._getWord(data[0], data[1])
-        humidity = ((125.0 * data) / 65536.0) - 6.0
-        return humidity
+        return self.measure(HUMD_NOHOLDMASTER)
+
+    async def temperature_async(self):
+        return await self.measure_async(TEMP_NOHOLDMASTER)
+
+    async def humidity_async(self):
+        return await self.measure_async(HUMD_NOHOLDMASTER)
+
+    def prev_temperature(self):
+        """ the temperature(degrees Celsius) the last humidity measurement converted, without
+            a new conversion. It has no CRC, so it's read twice and has to match """
+        self.cmd[0] = TEMP_PREV_RH
+        attempt = 0
+        while True:
+            self.bus.write(SI7006A20_I2C_ADDR, self.cmd)
+            self.bus.read(SI7006A20_I2C_ADDR, self.prev)
+            self.bus.write(SI7006A20_I2C_ADDR, self.cmd)
+            data = self.bus.read(SI7006A20_I2C_ADDR, self.check)
+            if data[0] == self.prev[0] and data[1] == self.prev[1]:
+                return self._temp(self._getWord(data[0], data[1]))
+            self.bus.crc_errors += 1
+            if not self.bus.retry(attempt):
+                raise CRCError('SI7006A20 temperature reads differ')
+            attempt += 1
+
+    def _temp_humid(self, humid, t_ambient):
+        temp = self.prev_temperature()
+        dew_p = self.dew_point(temp, humid)
+        if t_ambient is None:
+            t_ambient = temp
+        return (temp, humid, dew_p, self.humid_ambient(t_ambient, dew_p))
+
+    def temp_humid(self, t_ambient = None):
+        """ temperature, relative humidity, dew point and the humidity compensated for
+            t_ambient (the measured temperature if not given), all from one conversion:
+            returns (temp, humid, dew_p, humid_ambient) """
+        return self._temp_humid(self.measure(HUMD_NOHOLDMASTER), t_ambient)
+
+    async def temp_humid_async(self, t_ambient = None):
+        return self._temp_humid(await self.measure_async(HUMD_NOHOLDMASTER), t_ambient)
 
     def read_user_reg(self):
         """ reading the user configuration register """
@@ -87,11 +218,12 @@ class SI7006A20:
         self.i2c.writeto(SI7006A20_I2C_ADDR, bytearray([reg_addr])+bytearray([value]))
         time.sleep(0.1)
 
-    def dew_point(self):
+    def dew_point(self, temp = None, humid = None):
         """ computing the dew pointe temperature (deg C) for the current Temperature and Humidity measured pair
-            at dew-point temperature the relative humidity is 100% """
-        temp = self.temperature()
-        humid = self.humidity()
+            (or the pair given) at dew-point temperature the relative humidity is 100% """
+        if temp is None or humid is None:
+            humid = self.humidity()
+            temp = self.prev_temperature()
         h = (math.log(humid, 10) - 2) / 0.4343 + (17.62 * temp) / (243.12 + temp)
         dew_p = 243.12 * h / (17.62 - h)
         return dew_p
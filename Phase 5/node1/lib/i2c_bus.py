@@ -0,0 +1,133 @@
+import time
+
+__version__ = '0.0.1'
+
+class CRCError(Exception):
+    """ data read from a device didn't match its CRC byte """
+    pass
+
+def crc8(buf, size):
+    """ CRC-8 of the first size bytes of buf, polynomial x^8 + x^5 + x^4 + 1 (0x31), initial value 0,
+        as used by the SI7006-A20 """
+    crc = 0
+    for i in range(size):
+        crc ^= buf[i]
+        for bit in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x31) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return crc
+
+class I2CBus:
+    """ I2C transactions shared by the Pysense drivers: a failed transaction (NACK, bus error,
+        or a CRC mismatch when the device sends one) is tried again after a short wait that doubles
+        each time, up to tries times in all. Reads go into buffers the caller keeps, so nothing is
+        allocated per transaction """
+
+    TRIES = const(3)
+    BACKOFF_MIN_US = const(100)
+    BACKOFF_MAX_US = const(2000)
+
+    def __init__(self, i2c, tries = TRIES):
+        self.i2c = i2c
+        self.tries = tries
+        # metrics
+        self.transactions = 0
+        self.errors = 0         # failed attempts, including CRC mismatches
+        self.crc_errors = 0
+        self.retries = 0
+        self.failures = 0       # transactions given up on
+
+    def retry(self, attempt, tries = None):
+        """ counts a failed attempt (the first is attempt 0); returns True, after waiting,
+            if there are tries left """
+        tries = tries or self.tries
+        self.errors += 1
+        if attempt + 1 >= tries:
+            self.failures += 1
+            return False
+        self.retries += 1
+        time.sleep_us(min(BACKOFF_MIN_US << attempt, BACKOFF_MAX_US))
+        return True
+
+    def write(self, addr, buf, tries = None):
+        """ writing buf to the device. Pass tries=1 for a write that changes something relative to
+            what's there (e.g. toggling bits): if it got through but the ACK was lost, a retry
+            would do it twice """
+        tries = tries or self.tries
+        self.transactions += 1
+        attempt = 0
+        while True:
+            try:
+                self.i2c.writeto(addr, buf)
+                return
+            except OSError:
+                if not self.retry(attempt, tries):
+                    raise
+            attempt += 1
+
+    def read(self, addr, buf, crc = False, tries = None):
+        """ reading len(buf) bytes from the device into buf. With crc=True the last byte is
+            the CRC-8 of the others; raises CRCError if it still doesn't match after retrying """
+        tries = tries or self.tries
+        self.transactions += 1
+        attempt = 0
+        while True:
+            try:
+                self.i2c.readfrom_into(addr, buf)
+                if not crc or crc8(buf, len(buf) - 1) == buf[len(buf) - 1]:
+                    return buf
+                self.crc_errors += 1
+                if not self.retry(attempt, tries):
+                    raise CRCError('CRC mismatch from 0x{:02x}'.format(addr))
+            except OSError:
+                if not self.retry(attempt, tries):
+                    raise
+            attempt += 1
+
+    def poll(self, addr, buf, crc = False):
+        """ one read from a device that NACKs while it's busy (e.g. converting): returns None if it
+            did, which isn't counted as an error, otherwise buf. Raises CRCError on a mismatch,
+            as the caller may have to start again rather than read again """
+        self.transactions += 1
+        try:
+            self.i2c.readfrom_into(addr, buf)
+        except OSError:
+            return None
+        if crc and crc8(buf, len(buf) - 1) != buf[len(buf) - 1]:
+            self.crc_errors += 1
+            raise CRCError('CRC mismatch from 0x{:02x}'.format(addr))
+        return buf
+
+    def write_mem(self, addr, memaddr, buf, tries = None):
+        """ writing buf to the device's registers starting at memaddr """
+        tries = tries or self.tries
+        self.transactions += 1
+        attempt = 0
+        while True:
+            try:
+                self.i2c.writeto_mem(addr, memaddr, buf)
+                return
+            except OSError:
+                if not self.retry(attempt, tries):
+                    raise
+            attempt += 1
+
+    def read_mem(self, addr, memaddr, buf, tries = None):
+        """ reading len(buf) bytes from the device's registers starting at memaddr into buf """
+        tries = tries or self.tries
+        self.transactions += 1
+        attempt = 0
+        while True:
+            try:
+                self.i2c.readfrom_mem_into(addr, memaddr, buf)
+                return buf
+            except OSError:
+                if not self.retry(attempt, tries):
+                    raise
+            attempt += 1
+
+    def metrics(self):
+        return {"transactions": self.transactions, "errors": self.errors, "crc_errors": self.crc_errors,
+                "retries": self.retries, "failures": self.failures}
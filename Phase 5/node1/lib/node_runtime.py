@@ -0,0 +1,210 @@
+# nodeRuntime
+# Core Electronics
+# Runs a battery powered node as short wakes with the Pysense's deep sleep
+# in between, instead of keeping the board and its radio on all the time.
+#
+# Each wake:
+#   1. take a reading and send it (reliably, so the gateway acknowledges it)
+#   2. listen for a moment, for the acknowledgement and for anything the
+#      gateway was holding until it heard from us (see loraAPI.hold_for())
+#   3. save what has to be remembered to flash
+#   4. ask the Pysense to wake us again in 'interval' and go to sleep
+#
+# A wake that only takes a reading for later (see sampleRing) can skip
+# steps 1 and 2 and never turn the radio on.
+#
+# Deep sleep turns the board off, so every wake runs the script from the
+# top again. Sequence numbers, messages still waiting to be acknowledged,
+# recent time on air (for duty cycle limits) and a reading we still owe the
+# gateway are kept in a small JSON file on flash. The Pysense keeps its RTC
+# calibration and clock itself (see Pycoproc.rtc_calibration()).
+# A script can keep more in the same file with keep(), and get it back
+# from saved (e.g. node1.py keeps its reportPolicy).
+#
+# Example (see node1.py):
+#   runtime = nodeRuntime(py, interval=60000)
+#   if time_to_send or runtime.pending:
+#       runtime.run(node, send_measurements, handle_message)
+#   else:
+#       runtime.sleep(temperature)                  # neither returns
+import time
+import json
+import machine
+
+class nodeRuntime:
+
+    # After sending, listen until everything has been acknowledged and nothing
+    # has arrived for RX_GRACE ms, but never longer than RX_WINDOW ms.
+    # Anything still unacknowledged is sent again on the next wake.
+    RX_WINDOW = 1500 # milliseconds
+    RX_GRACE = 300   # milliseconds
+
+    # The Pysense counts sleep in whole seconds
+    SHORTEST_SLEEP = 1 # seconds
+
+    # Parameter: py
+    #   The Pysense object
+    # Parameter: interval
+    #   Milliseconds from one wake to the next
+    # Parameter: path
+    #   File on flash to keep state in between wakes
+    def __init__(self, py, interval=60000, path="/flash/node_state.json"):
+        self.node = None
+        self.size = None        # bytes sample() sends, see run()
+        self.py = py
+        self.interval = interval
+        self.path = path
+        self.started = time.ticks_ms()
+        self.wakes = 0
+        # True when a reading should be sent as soon as the duty cycle allows
+        self.pending = False
+        self.temperature = None
+        # What the last wake that used the radio saved, see load()
+        self.saved = {}
+        # More to save, see keep()
+        self.kept = {}
+
+        # Why we woke up. A timer wake slept for as long as it was asked to,
+        # anything else (e.g. the button) cut the sleep short, and
+        # get_sleep_remaining() takes what was left off py.clock().
+        self.wake_reason = py.get_wake_reason()
+        py.get_sleep_remaining()
+
+        self.load()
+
+    # Pick up where the last wake that used the radio left off
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.saved = json.loads(f.read())
+        except Exception:
+            return  # First time (or the file is damaged), start afresh
+        self.wakes = self.saved.get("wakes", 0)
+        self.pending = self.saved.get("pending", False)
+
+    # Keep everything needed for the next wake. Wakes that don't use the
+    # radio change nothing here, so they don't write to flash.
+    def save(self):
+        if self.node is None:
+            return
+        state = {"wakes": self.wakes, "pending": self.pending, "clock": self.py.clock(),
+                 "lora": self.node.save_state()}
+        for name in self.kept:
+            state[name] = self.kept[name]()
+        with open(self.path, "w") as f:
+            f.write(json.dumps(state))
+
+    # Save something else with the state, each time a wake that used the
+    # radio ends. The next wake gets it back as saved[name].
+    # Parameter: name
+    #   Key for it in the file. Don't use "wakes", "pending", "clock" or "lora".
+    # Parameter: save
+    #   Function returning what to save, as something JSON can save
+    def keep(self, name, save):
+        self.kept[name] = save
+
+    # Ask for a reading to be sent as soon as the duty cycle allows:
+    # in this wake if it can be, otherwise the next
+    def request(self):
+        self.pending = True
+
+    # A wake that uses the radio: send a reading, listen, then sleep.
+    # Parameter: node
+    #   The loraAPI object
+    # Parameter: sample
+    #   Function that sends a reading. It can return the temperature
+    #   (deg C), which tells the Pysense whether its RTC calibration is
+    #   still good.
+    # Parameter: handler
+    #   Optional function to call with (device_id, data) for each message
+    #   (JSON or packed) that arrives while listening
+    # Parameter: size
+    #   Bytes on the air of the package sample() sends (see
+    #   loraAPI.packed_size()), for the duty cycle and dwell time limits.
+    #   The largest package if not given, which may be too long to ever
+    #   send where dwell time is limited.
+    def run(self, node, sample, handler=None, size=None):
+        self.node = node
+        self.size = node.LORA_MAX_PAYLOAD if size is None else size
+        # How long since the last wake that used the radio, for the duty cycle limits
+        elapsed = max(0, self.py.clock() - self.saved.get("clock", 0)) * 1000
+        node.restore_state(self.saved.get("lora", {}), elapsed)
+        self.wakes += 1
+        self.request()
+        self.listen(sample, handler)
+        self.sleep()
+
+    # Send the reading if it's owed and listen until the window closes
+    def listen(self, sample, handler=None):
+        start = time.ticks_ms()
+        last = start
+        while True:
+            # Resends anything unacknowledged (messages the last wake didn't
+            # get acknowledged go first), sends what's queued and puts what
+            # has arrived in the inbox
+            self.node.service()
+
+            # Messages are handled before sending, so a request that arrived
+            # with an acknowledgement doesn't get a second reading.
+            while len(self.node.inbox) > 0:
+                device_id, message = self.node.inbox.pop(0)
+                last = time.ticks_ms()
+                try:
+                    data = json.loads(message)
+                except Exception:
+                    try:
+                        data = self.node.unpack(message)
+                    except Exception:
+                        data = None
+                if data is None:
+                    continue
+                if handler is not None:
+                    handler(device_id, data)
+
+            # The radio can't hear while it's sending, so the reading waits
+            # for earlier messages to be acknowledged, or RX_GRACE if they aren't
+            now = time.ticks_ms()
+            if self.pending and self.node.can_send(self.size) and (
+                    self.node.unacknowledged() == 0 or time.ticks_diff(now, last) >= nodeRuntime.RX_GRACE):
+                self.pending = False
+                self.temperature = sample()
+                last = time.ticks_ms()
+
+            now = time.ticks_ms()
+            if time.ticks_diff(now, start) >= nodeRuntime.RX_WINDOW:
+                return
+            # Done once nothing more is owed that could be sent now
+            owed = self.pending and self.node.can_send(self.size)
+            if not owed and self.node.unacknowledged() == 0 and time.ticks_diff(now, last) >= nodeRuntime.RX_GRACE:
+                return
+            time.sleep_ms(10)
+
+    # Save state and have the Pysense turn us off until the next wake.
+    # Parameter: temperature
+    #   deg C, if known, for the Pysense's RTC calibration
+    def sleep(self, temperature=None):
+        if temperature is not None:
+            self.temperature = temperature
+        awake = time.ticks_diff(time.ticks_ms(), self.started)
+        if self.pending and self.node is not None:
+            # Still owe a reading: wake up again as soon as it can be sent
+            # (rounded up, waking early would be no use)
+            wait = self.node.next_send_time(self.size)
+            ms = self.interval if wait is None else min(wait + 999, self.interval)
+        else:
+            ms = self.interval - awake + 500
+        seconds = max(nodeRuntime.SHORTEST_SLEEP, ms // 1000)
+
+        self.save()
+        if self.node is None:
+            print("Reading taken in {} ms, sleeping for {} s".format(awake, seconds))
+        else:
+            print("Wake {} was {} ms, sleeping for {} s".format(self.wakes, awake, seconds))
+        self.py.setup_sleep(seconds, self.temperature)
+        self.py.go_to_sleep()
+
+        # The Pysense has turned the power off, so this is only reached if
+        # the board is powered some other way. Wait, then start again like
+        # waking up would.
+        time.sleep(seconds)
+        machine.reset()
@@ -1,5 +1,6 @@
 from machine import Pin
 from machine import I2C
+from i2c_bus import I2CBus
 import time
 import pycom
 
@@ -71,16 +72,62 @@ class Pycoproc:
 
     EXP_RTC_PERIOD = const(7000)
 
-    def __init__(self, i2c=None, sda='P22', scl='P21'):
+    # the RTC calibration is measured again when it's older than this (s) or the temperature
+    # has changed by more than this (deg C) since
+    CAL_MAX_AGE = const(21600)
+    CAL_MAX_TEMP_CHANGE = const(5)
+    # NVRAM keys, so the calibration survives deep sleep
+    NVS_CAL_FACTOR = 'pyc_cal_factor'   # factor * 1000000
+    NVS_CAL_TIME = 'pyc_cal_time'       # clock() when it was measured
+    NVS_CLOCK = 'pyc_clock'             # clock() when the sleep set up last ends
+    NVS_CAL_TEMP = 'pyc_cal_temp'       # (temperature + 100) * 100, if given
+
+    # registers the hardware changes by itself, so they are never kept in the shadow
+    VOLATILE = (PORTA_ADDR, PORTC_ADDR, INTCON_ADDR, ADCON0_ADDR, ADRESL_ADDR, ADRESH_ADDR,
+                PCON_ADDR, STATUS_ADDR, WAKE_REASON_ADDR, WAKE_REASON_ADDR + 1,
+                WAKE_REASON_ADDR + 2, WAKE_REASON_ADDR + 3)
+
+    def __init__(self, i2c=None, sda='P22', scl='P21', shadow=False):
         if i2c is not None:
             self.i2c = i2c
         else:
             self.i2c = I2C(0, mode=I2C.MASTER, pins=(sda, scl))
+        # shared with the sensor drivers
+        self.bus = I2CBus(self.i2c)
+        # command and answer buffers, with a view of each length so nothing is allocated per command
+        self.cmd = bytearray(6)
+        mv = memoryview(self.cmd)
+        self.cmds = [mv[:n] for n in range(7)]
+        self.answer = bytearray(3)      # status byte, then up to 2 bytes of result
+        mv = memoryview(self.answer)
+        self.answers = [mv[:n + 1] for n in range(3)]
+        self.results = [mv[1:n + 1] for n in range(3)]
+
+        # with shadow, the values of the registers the driver writes are remembered, and bit
+        # operations in a batch are combined per register and sent by flush() as one poke
+        # (or one MAGIC if the value isn't known yet). Pokes that change nothing are skipped
+        self.shadow = shadow
+        self.known = {}         # addr: value
+        self.pending = []       # addrs with operations waiting, in order
+        self.ops = {}           # addr: [bits kept, then XORed with]
+        self.batching = False
 
         self.sda = sda
         self.scl = scl
         self.clk_cal_factor = 1
-        self.reg = bytearray(6)
+        self.cal_time = None
+        self.cal_temp = None
+        self.calibrations = 0
+        # deep sleep turns the module off, so time.time() starts again on every wake;
+        # clock() counts on from where the last sleep ended instead
+        try:
+            self.clock_base = pycom.nvs_get(self.NVS_CLOCK)
+        except Exception:
+            self.clock_base = 0
+        self.clock_ticks = time.ticks_ms()
+        self.woke_early = False
+        self.wake_reason = None     # from get_wake_reason(), it doesn't change until the next sleep
+        self._load_calibration()
         self.wake_int = False
         self.wake_int_pin = False
         self.wake_int_pin_rising_edge = True
@@ -88,10 +135,11 @@ class Pycoproc:
         # Make sure we are inserted into the
         # correct board and can talk to the PIC
         try:
-            self.read_fw_version()
+            fw_version = self.read_fw_version()
         except Exception as e:
             raise Exception('Board not detected: {}'.format(e))
 
+        self.batch()
         # init the ADC for the battery measurements
         self.poke_memory(ANSELC_ADDR, 1 << 2)
         self.poke_memory(ADCON0_ADDR, (0x06 << _ADCON0_CHS_POSN) | _ADCON0_ADON_MASK)
@@ -103,95 +151,200 @@ class Pycoproc:
         # set RC6 and RC7 as outputs and enable power to the sensors and the GPS
         self.mask_bits_in_memory(TRISC_ADDR, ~(1 << 6))
         self.mask_bits_in_memory(TRISC_ADDR, ~(1 << 7))
+        self.flush()
 
-        if self.read_fw_version() < 6:
+        if fw_version < 6:
             raise ValueError('Firmware out of date')
 
 
-    def _write(self, data, wait=True):
-        self.i2c.writeto(I2C_SLAVE_ADDR, data)
+    def _write(self, size, wait=True, result=0, tries=None):
+        """ sending the first size bytes of self.cmd and, if wait, waiting for the PIC to finish;
+            returns the first result bytes of its answer. tries=1 for a command that mustn't be
+            sent twice """
+        self.bus.write(I2C_SLAVE_ADDR, self.cmds[size], tries)
         if wait:
-            self._wait()
-
-    def _read(self, size):
-        return self.i2c.readfrom(I2C_SLAVE_ADDR, size + 1)[1:(size + 1)]
+            return self._wait(result)
 
-    def _wait(self):
+    def _wait(self, result=0):
+        """ polling the status byte until the PIC is ready. Its answer follows the status byte,
+            so it's read in the same transfer """
         count = 0
+        answer = self.answers[result]
         time.sleep_us(10)
-        while self.i2c.readfrom(I2C_SLAVE_ADDR, 1)[0] != 0xFF:
+        while self.bus.read(I2C_SLAVE_ADDR, answer)[0] != 0xFF:
             time.sleep_us(100)
             count += 1
             if (count > 500):  # timeout after 50ms
                 raise Exception('Board timeout')
+        return self.results[result]
 
-    def _send_cmd(self, cmd):
-        self._write(bytes([cmd]))
+    def _set_cmd(self, cmd, addr):
+        self.cmd[0] = cmd
+        self.cmd[1] = addr & 0xFF
+        self.cmd[2] = (addr >> 8) & 0xFF
+
+    def _send_cmd(self, cmd, result=0):
+        self.cmd[0] = cmd
+        return self._write(1, result=result)
 
     def read_hw_version(self):
-        self._send_cmd(CMD_HW_VER)
-        d = self._read(2)
+        d = self._send_cmd(CMD_HW_VER, 2)
         return (d[1] << 8) + d[0]
 
     def read_fw_version(self):
-        self._send_cmd(CMD_FW_VER)
-        d = self._read(2)
+        d = self._send_cmd(CMD_FW_VER, 2)
         return (d[1] << 8) + d[0]
 
     def read_product_id(self):
-        self._send_cmd(CMD_PROD_ID)
-        d = self._read(2)
+        d = self._send_cmd(CMD_PROD_ID, 2)
         return (d[1] << 8) + d[0]
 
     def peek_memory(self, addr):
-        self._write(bytes([CMD_PEEK, addr & 0xFF, (addr >> 8) & 0xFF]))
-        return self._read(1)[0]
+        if self.shadow:
+            self._send()
+            value = self.known.get(addr)
+            if value is not None:
+                return value
+        self._set_cmd(CMD_PEEK, addr)
+        value = self._write(3, result=1)[0]
+        self._remember(addr, value)
+        return value
 
     def poke_memory(self, addr, value):
-        self._write(bytes([CMD_POKE, addr & 0xFF, (addr >> 8) & 0xFF, value & 0xFF]))
+        if self.shadow:
+            self._modify(addr, 0, value, 0)
+        else:
+            self._poke(addr, value)
+
+    def _poke(self, addr, value):
+        self._set_cmd(CMD_POKE, addr)
+        self.cmd[3] = value & 0xFF
+        self._write(4)
 
     def magic_write_read(self, addr, _and=0xFF, _or=0, _xor=0):
-        self._write(bytes([CMD_MAGIC, addr & 0xFF, (addr >> 8) & 0xFF, _and & 0xFF, _or & 0xFF, _xor & 0xFF]))
-        return self._read(1)[0]
+        """ value = ((value & _and) | _or) ^ _xor, done by the PIC; returns the new value """
+        if self.shadow:
+            self._send()
+        value = self._magic(addr, _and, _or, _xor)
+        self._remember(addr, value)
+        return value
+
+    def _magic(self, addr, _and, _or, _xor):
+        self._set_cmd(CMD_MAGIC, addr)
+        self.cmd[3] = _and & 0xFF
+        self.cmd[4] = _or & 0xFF
+        self.cmd[5] = _xor & 0xFF
+        # a retry after a write that got through but wasn't acknowledged would do it twice,
+        # which toggles back any bits XORed that AND and OR leave alone
+        tries = 1 if _xor & _and & ~_or & 0xFF else None
+        return self._write(6, result=1, tries=tries)[0]
 
     def toggle_bits_in_memory(self, addr, bits):
-        self.magic_write_read(addr, _xor=bits)
+        self._modify(addr, 0xFF, 0, bits)
 
     def mask_bits_in_memory(self, addr, mask):
-        self.magic_write_read(addr, _and=mask)
+        self._modify(addr, mask, 0, 0)
 
     def set_bits_in_memory(self, addr, bits):
-        self.magic_write_read(addr, _or=bits)
+        self._modify(addr, 0xFF, bits, 0)
+
+    def _remember(self, addr, value):
+        if self.shadow and addr not in self.VOLATILE:
+            self.known[addr] = value
+
+    def _modify(self, addr, _and, _or, _xor):
+        if not self.shadow:
+            self._magic(addr, _and, _or, _xor)
+            return
+        # ((value & _and) | _or) ^ _xor is (value & keep) ^ xor, and two of those in a row
+        # are one: (value & keep1 & keep2) ^ ((xor1 & keep2) ^ xor2)
+        keep = _and & ~_or & 0xFF
+        xor = (_or ^ _xor) & 0xFF
+        op = self.ops.get(addr)
+        if op is None:
+            self.ops[addr] = [keep, xor]
+            self.pending.append(addr)
+        else:
+            op[1] = (op[1] & keep) ^ xor
+            op[0] &= keep
+        if not self.batching:
+            self.flush()
+
+    def batch(self):
+        """ with shadow, holds back bit operations and pokes until flush() """
+        self.batching = True
+
+    def flush(self):
+        """ sends the operations held back and ends the batch """
+        self.batching = False
+        self._send()
+
+    def _send(self):
+        """ one poke or MAGIC per register at most """
+        if not self.pending:
+            return
+        for addr in self.pending:
+            keep, xor = self.ops[addr]
+            value = self.known.get(addr)
+            if keep == 0 or value is not None:
+                new = ((value or 0) & keep) ^ xor
+                if new != value:
+                    self._poke(addr, new)
+                    self._remember(addr, new)
+            else:
+                self._remember(addr, self._magic(addr, keep, 0, xor))
+        self.pending = []
+        self.ops = {}
+
+    def invalidate(self, addr=None):
+        """ forgets the shadow's value of addr, or all of them (e.g. if the PIC may have been reset) """
+        if addr is None:
+            self.known = {}
+        elif addr in self.known:
+            del self.known[addr]
 
     def get_wake_reason(self):
         """ returns the wakeup reason, a value out of constants WAKE_REASON_* """
-        return self.peek_memory(WAKE_REASON_ADDR)
+        self.wake_reason = self.peek_memory(WAKE_REASON_ADDR)
+        return self.wake_reason
 
-    def get_sleep_remaining(self):
+    def get_sleep_remaining(self, temperature=None):
         """ returns the remaining time from sleep, as an interrupt (wakeup source) might have triggered """
+        # a timer wake slept for all of it, so there's nothing to read
+        reason = self.wake_reason if self.wake_reason is not None else self.get_wake_reason()
+        if reason == WAKE_REASON_TIMER:
+            return 0
         c3 = self.peek_memory(WAKE_REASON_ADDR + 3)
         c2 = self.peek_memory(WAKE_REASON_ADDR + 2)
         c1 = self.peek_memory(WAKE_REASON_ADDR + 1)
         time_device_s = (c3 << 16) + (c2 << 8) + c1
         # this time is from PIC internal oscilator, so it needs to be adjusted with the calibration value
-        try:
-            self.calibrate_rtc()
-        except Exception:
-            pass
+        self.rtc_calibration(temperature)
         time_s = int((time_device_s / self.clk_cal_factor) + 0.5) # 0.5 used for round
+        if time_s > 0 and not self.woke_early:
+            # the sleep was cut short, so it ended earlier than clock() took it to
+            self.clock_base -= time_s
+            self.woke_early = True
         return time_s
 
-    def setup_sleep(self, time_s):
+    def setup_sleep(self, time_s, temperature=None):
+        """ temperature (deg C, if known) tells whether the RTC calibration is still good """
+        self.rtc_calibration(temperature)
         try:
-            self.calibrate_rtc()
+            pycom.nvs_set(self.NVS_CLOCK, self.clock() + int(time_s))
         except Exception:
             pass
         time_s = int((time_s * self.clk_cal_factor) + 0.5)  # round to the nearest integer
         if time_s >= 2**(8*3):
             time_s = 2**(8*3)-1
-        self._write(bytes([CMD_SETUP_SLEEP, time_s & 0xFF, (time_s >> 8) & 0xFF, (time_s >> 16) & 0xFF]))
+        self.cmd[0] = CMD_SETUP_SLEEP
+        self.cmd[1] = time_s & 0xFF
+        self.cmd[2] = (time_s >> 8) & 0xFF
+        self.cmd[3] = (time_s >> 16) & 0xFF
+        self._write(4)
 
     def go_to_sleep(self, gps=True):
+        self.batch()
         # enable or disable back-up power to the GPS receiver
         if gps:
             self.set_bits_in_memory(PORTC_ADDR, 1 << 7)
@@ -222,7 +375,9 @@ class Pycoproc:
             self.mask_bits_in_memory(INTCON_ADDR, ~(1 << 1)) # clear INTF
             self.set_bits_in_memory(INTCON_ADDR, 1 << 4) # enable interrupt; set INTE)
 
-        self._write(bytes([CMD_GO_SLEEP]), wait=False)
+        self.flush()
+        self.cmd[0] = CMD_GO_SLEEP
+        self._write(1, wait=False)
         # kill the run pin
         Pin('P3', mode=Pin.OUT, value=0)
 
@@ -231,7 +386,8 @@ class Pycoproc:
         # WDT has a frequency divider to generate 1 ms
         # and then there is a binary prescaler, e.g., 1, 2, 4 ... 512, 1024 ms
         # hence the need for the constant
-        self._write(bytes([CMD_CALIBRATE]), wait=False)
+        self.cmd[0] = CMD_CALIBRATE
+        self._write(1, wait=False)
         self.i2c.deinit()
         Pin('P21', mode=Pin.IN)
         pulses = pycom.pulses_get('P21', 100)
@@ -249,6 +405,67 @@ class Pycoproc:
             self.clk_cal_factor = (EXP_RTC_PERIOD / period) * (1000 / 1024)
         if self.clk_cal_factor > 1.25 or self.clk_cal_factor < 0.75:
             self.clk_cal_factor = 1
+            return False
+        return period > 0
+
+    def clock(self):
+        """ seconds counted across deep sleep: the time awake since each wake, plus the sleeps set
+            up with setup_sleep() (less what get_sleep_remaining() says was left of the last one).
+            Only goes forward; time with the power off isn't counted """
+        return self.clock_base + time.ticks_diff(time.ticks_ms(), self.clock_ticks) // 1000
+
+    def rtc_calibration(self, temperature=None):
+        """ returns the RTC calibration factor, measuring it with calibrate_rtc() only if there is
+            none saved, it's older than CAL_MAX_AGE, or temperature is more than CAL_MAX_TEMP_CHANGE
+            from the temperature it was measured at """
+        now = self.clock()
+        stale = self.cal_time is None or now - self.cal_time > CAL_MAX_AGE or now < self.cal_time
+        if not stale and temperature is not None:
+            if self.cal_temp is None:
+                # measured without a temperature (e.g. on waking, before a reading):
+                # take it to be this one
+                self.cal_temp = temperature
+                self._save_calibration()
+            stale = abs(temperature - self.cal_temp) > CAL_MAX_TEMP_CHANGE
+        if stale:
+            try:
+                measured = self.calibrate_rtc()
+            except Exception:
+                measured = False
+            self.calibrations += 1
+            if measured:
+                self.cal_time = now
+                self.cal_temp = temperature
+                self._save_calibration()
+        return self.clk_cal_factor
+
+    def _load_calibration(self):
+        try:
+            factor = pycom.nvs_get(self.NVS_CAL_FACTOR)
+            cal_time = pycom.nvs_get(self.NVS_CAL_TIME)
+        except Exception:
+            return
+        if factor is None or cal_time is None:
+            return
+        self.clk_cal_factor = factor / 1000000
+        self.cal_time = cal_time
+        try:
+            temp = pycom.nvs_get(self.NVS_CAL_TEMP)
+        except Exception:
+            temp = None
+        if temp is not None:
+            self.cal_temp = temp / 100 - 100
+
+    def _save_calibration(self):
+        try:
+            pycom.nvs_set(self.NVS_CAL_FACTOR, int(self.clk_cal_factor * 1000000))
+            pycom.nvs_set(self.NVS_CAL_TIME, self.cal_time)
+            if self.cal_temp is None:
+                pycom.nvs_erase(self.NVS_CAL_TEMP)
+            else:
+                pycom.nvs_set(self.NVS_CAL_TEMP, int((self.cal_temp + 100) * 100))
+        except Exception:
+            pass
 
     def button_pressed(self):
         button = self.peek_memory(PORTA_ADDR) & (1 << 3)
@@ -264,6 +481,7 @@ class Pycoproc:
 
     def setup_int_wake_up(self, rising, falling):
         """ rising is for activity detection, falling for inactivity """
+        self.batch()
         wake_int = False
         if rising:
             self.set_bits_in_memory(IOCAP_ADDR, 1 << 5)
@@ -276,6 +494,7 @@ class Pycoproc:
             wake_int = True
         else:
             self.mask_bits_in_memory(IOCAN_ADDR, ~(1 << 5))
+        self.flush()
         self.wake_int = wake_int
 
     def setup_int_pin_wake_up(self, rising_edge = True):
@@ -4,5 +4,5 @@ __version__ = '1.4.0'
 
 class Pysense(Pycoproc):
 
-    def __init__(self, i2c=None, sda='P22', scl='P21'):
-        Pycoproc.__init__(self, i2c, sda, scl)
+    def __init__(self, i2c=None, sda='P22', scl='P21', shadow=False):
+        Pycoproc.__init__(self, i2c, sda, scl, shadow)
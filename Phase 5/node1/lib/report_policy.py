@@ -0,0 +1,163 @@
+# reportPolicy
+# Core Electronics
+# Decides when a node should send a reading (report by exception), instead
+# of sending one every time. Most of the time temperature and humidity
+# hardly change, and every package sent costs battery and time on air.
+#
+# A reading is sent when:
+#   - a value has moved more than its "delta" since the last one sent
+#     (the deadband). What the gateway shows is then never further than
+#     delta from the real value.
+#   - a value goes above its "high" or below its "low" limit, and again when
+#     it's back. To be back it has to pass the limit by "hysteresis", so a
+#     value wobbling around the limit doesn't send a reading every time.
+#   - nothing has been sent for "heartbeat" seconds, so the gateway knows
+#     the node is still there.
+#
+# The gateway can change any of these with a "thresholds" message, e.g.
+#   {"thresholds": {"temperature": {"delta": 0.5, "high": 30, "hysteresis": 1}, "heartbeat": 1800}}
+#
+# Example (see node1.py):
+#   policy = reportPolicy({"temperature": {"delta": 0.25}, "humidity": {"delta": 2}}, heartbeat=1800)
+#   reason = policy.check(now, {"temperature": 21.3, "humidity": 55.0})
+#   if reason is not None:
+#       send(...)
+#       policy.reported(now, {"temperature": 21.3, "humidity": 55.0})
+
+# What each field's thresholds can have
+THRESHOLD_KEYS = ("delta", "low", "high", "hysteresis")
+# The ones that can't be below 0
+POSITIVE_KEYS = ("delta", "hysteresis")
+
+# True if value is a number (True and False don't count), at least minimum if given
+def is_number(value, minimum=None):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    return minimum is None or value >= minimum
+
+class reportPolicy:
+
+    # Parameter: thresholds
+    #   {field: {"delta": ..., "low": ..., "high": ..., "hysteresis": ...}, ...}
+    #   Any of them can be left out. Fields that aren't here are never checked.
+    # Parameter: heartbeat
+    #   Longest time (seconds) to go without sending, or None for no limit
+    def __init__(self, thresholds, heartbeat=3600):
+        self.thresholds = {}
+        for field in thresholds:
+            self.thresholds[field] = dict(thresholds[field])
+        self.heartbeat = heartbeat
+        # The values last sent, and when (seconds, see check())
+        self.last = {}
+        self.last_time = None
+        # "high" or "low" for each field past its limit, as last sent
+        self.alarms = {}
+
+    # Should these values be sent?
+    # Parameter: now
+    #   Time in seconds. It has to keep counting over deep sleep,
+    #   e.g. Pycoproc.clock().
+    # Parameter: values
+    #   {field: value, ...}
+    # Returns why they should be sent, e.g. "temperature high" or "heartbeat",
+    # or None if they don't need to be. Nothing changes until reported(), so
+    # if the values don't get through the next check() sends them again.
+    def check(self, now, values):
+        reason = None
+        for field in self.thresholds:
+            if field not in values or values[field] is None:
+                continue
+            value = values[field]
+            threshold = self.thresholds[field]
+
+            # Limits come first: an alarm changing is sent even inside the deadband
+            alarm = self._alarm(field, value, threshold)
+            if alarm != self.alarms.get(field):
+                reason = reason or "{} {}".format(field, alarm or "normal")
+
+            delta = threshold.get("delta")
+            if field not in self.last:
+                reason = reason or "first"
+            elif delta is not None and abs(value - self.last[field]) >= delta:
+                reason = reason or "{} changed".format(field)
+
+        if reason is None and self.heartbeat is not None and (self.last_time is None or now - self.last_time >= self.heartbeat):
+            reason = "heartbeat"
+        return reason
+
+    # Where value is against the field's limits: "high", "low" or None.
+    # Once past a limit it stays there until it's back by hysteresis.
+    def _alarm(self, field, value, threshold):
+        alarm = self.alarms.get(field)
+        hysteresis = threshold.get("hysteresis") or 0
+        high = threshold.get("high")
+        low = threshold.get("low")
+        if high is not None and (value > high or (alarm == "high" and value > high - hysteresis)):
+            return "high"
+        if low is not None and (value < low or (alarm == "low" and value < low + hysteresis)):
+            return "low"
+        return None
+
+    # The values have been sent, so the deadband starts from them, and the
+    # gateway now knows which limits they're past
+    def reported(self, now, values):
+        for field in values:
+            if values[field] is not None:
+                self.last[field] = values[field]
+                if field in self.thresholds:
+                    alarm = self._alarm(field, values[field], self.thresholds[field])
+                    if alarm is None:
+                        self.alarms.pop(field, None)
+                    else:
+                        self.alarms[field] = alarm
+        self.last_time = now
+
+    # Change thresholds, from a "thresholds" message.
+    # Only what's in the message changes. null (None) removes a threshold.
+    # Anything that isn't a number (or is below 0, for heartbeat, delta and
+    # hysteresis) is ignored, as it would stop check() working on every wake
+    # from then on. Returns False if the message has nothing we can use.
+    def update(self, settings):
+        if not isinstance(settings, dict):
+            return False
+        changed = False
+        if "heartbeat" in settings:
+            heartbeat = settings["heartbeat"]
+            if heartbeat is None or is_number(heartbeat, 0):
+                self.heartbeat = heartbeat
+                changed = True
+        for field in settings:
+            if field == "heartbeat" or not isinstance(settings[field], dict):
+                continue
+            for key in settings[field]:
+                value = settings[field][key]
+                if key not in THRESHOLD_KEYS:
+                    continue
+                if value is None:
+                    self.thresholds.get(field, {}).pop(key, None)
+                elif is_number(value, 0 if key in POSITIVE_KEYS else None):
+                    self.thresholds.setdefault(field, {})[key] = value
+                else:
+                    continue
+                changed = True
+        return changed
+
+    # Everything to keep over deep sleep, as something JSON can save
+    def save(self):
+        return {"thresholds": self.thresholds, "heartbeat": self.heartbeat,
+                "last": self.last, "last_time": self.last_time, "alarms": self.alarms}
+
+    # Carry on from what save() gave. Thresholds the gateway sent are kept
+    # over the ones the node started with. They go through update(), in
+    # case something that isn't a number was saved before it checked.
+    def restore(self, saved):
+        if not saved:
+            return
+        if isinstance(saved.get("thresholds"), dict):
+            self.thresholds = {}
+            self.update(saved["thresholds"])
+        if "heartbeat" in saved:
+            self.update({"heartbeat": saved["heartbeat"]})
+        self.last = saved.get("last", {})
+        self.last_time = saved.get("last_time")
+        self.alarms = saved.get("alarms", {})
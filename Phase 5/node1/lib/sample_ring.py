@@ -0,0 +1,169 @@
+# sampleRing
+# Core Electronics
+# Keeps the last 'size' readings of a few values (e.g. temperature and
+# humidity) and, for the readings since the last summary was sent (the
+# window), their mean, lowest, highest and standard deviation.
+#
+# Everything is kept in arrays made once, so adding a reading takes the
+# same short time however many there are, and keeps nothing new in memory.
+# The statistics are updated as each reading comes in (Welford's method),
+# so a summary doesn't have to go back over the readings. Welford's method
+# also stays accurate with the board's single precision floats, where
+# adding up squares loses the small differences between readings.
+#
+# Deep sleep turns the board off, so save() writes the arrays to flash and
+# the next wake's sampleRing reads them back.
+#
+# Example:
+#   readings = sampleRing(("temperature", "humidity"), size=60, path="/flash/readings.bin")
+#   readings.add(temperature, humidity)
+#   if readings.count() >= 6:
+#       send(readings.summary())  # {"count": 6, "temperature": [mean, lowest, highest, sd], ...}
+#       readings.sent()           # the next reading starts a new window
+#   readings.save()
+import math
+from array import array
+
+# What self.state holds
+_HEAD = 0       # where the next reading goes in the ring
+_STORED = 1     # readings in the ring
+_WINDOW = 2     # readings in the window
+_SENT = 3       # 1 once the window's summary has been sent
+_SIZE = 4       # size and number of fields, to check a saved ring matches
+_FIELDS = 5
+
+# The statistics kept for each field in self.stats
+_MEAN = 0
+_M2 = 1         # sum of squared differences from the mean
+_LOW = 2
+_HIGH = 3
+_STATS = 4
+
+class sampleRing:
+
+    # Parameter: fields
+    #   Names of the values in each reading, e.g. ("temperature", "humidity")
+    # Parameter: size
+    #   Number of readings kept, for samples()
+    # Parameter: path
+    #   File on flash for save() and to load from. None keeps them in RAM only.
+    def __init__(self, fields, size=60, path=None):
+        self.fields = fields
+        self.size = size
+        self.path = path
+        # One row of len(fields) values per reading
+        self.ring = array("f", [0] * (size * len(fields)))
+        self.state = array("i", [0, 0, 0, 0, size, len(fields)])
+        self.stats = array("f", [0] * (_STATS * len(fields)))
+        if path:
+            self.load()
+
+    # Add a reading, one value for each field
+    def add(self, *values):
+        state = self.state
+        stats = self.stats
+        if state[_SENT]:
+            state[_WINDOW] = 0
+            state[_SENT] = 0
+        n = state[_WINDOW] + 1
+        state[_WINDOW] = n
+        row = state[_HEAD] * len(self.fields)
+        for i in range(len(self.fields)):
+            value = values[i]
+            self.ring[row + i] = value
+            s = i * _STATS
+            if n == 1:
+                stats[s + _MEAN] = value
+                stats[s + _M2] = 0
+                stats[s + _LOW] = value
+                stats[s + _HIGH] = value
+                continue
+            delta = value - stats[s + _MEAN]
+            mean = stats[s + _MEAN] + delta / n
+            stats[s + _MEAN] = mean
+            stats[s + _M2] += delta * (value - mean)
+            if value < stats[s + _LOW]:
+                stats[s + _LOW] = value
+            if value > stats[s + _HIGH]:
+                stats[s + _HIGH] = value
+        state[_HEAD] = (state[_HEAD] + 1) % self.size
+        if state[_STORED] < self.size:
+            state[_STORED] += 1
+
+    # Number of readings in the window
+    def count(self):
+        return 0 if self.state[_SENT] else self.state[_WINDOW]
+
+    # The window as {"count": n, field: [mean, lowest, highest, standard deviation], ...}
+    # This is what loraAPI.send_packed() sends as a "summaries" message.
+    def summary(self):
+        n = self.state[_WINDOW]
+        summary = {"count": min(n, 255)}
+        if n == 0:
+            return summary
+        for i in range(len(self.fields)):
+            s = i * _STATS
+            summary[self.fields[i]] = [self.stats[s + _MEAN], self.stats[s + _LOW], self.stats[s + _HIGH],
+                                       math.sqrt(max(0, self.stats[s + _M2]) / n)]
+        return summary
+
+    # The window's summary has been sent, so the next reading starts a new one.
+    # Until then summary() still gives this one.
+    def sent(self):
+        self.state[_SENT] = 1
+
+    # Readings kept in the ring as {field: [value, ...], ...}, oldest first.
+    # Parameter: start
+    #   How many of the oldest to skip
+    # Parameter: count
+    #   How many to give, or None for the rest
+    def samples(self, start=0, count=None):
+        stored = self.state[_STORED]
+        if count is None or start + count > stored:
+            count = max(0, stored - start)
+        oldest = (self.state[_HEAD] - stored) % self.size
+        samples = {}
+        for i in range(len(self.fields)):
+            values = []
+            for j in range(start, start + count):
+                values.append(self.ring[((oldest + j) % self.size) * len(self.fields) + i])
+            samples[self.fields[i]] = values
+        return samples
+
+    # Number of readings kept in the ring
+    def stored(self):
+        return self.state[_STORED]
+
+    # Write everything to flash
+    def save(self):
+        with open(self.path, "wb") as f:
+            f.write(self.state)
+            f.write(self.stats)
+            f.write(self.ring)
+
+    # Read back what save() wrote. Starts afresh if there's nothing saved or
+    # it was saved with a different size or fields.
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                if (f.readinto(self.state) == len(self.state) * 4 and self.state[_SIZE] == self.size
+                        and self.state[_FIELDS] == len(self.fields)
+                        and f.readinto(self.stats) == len(self.stats) * 4
+                        and f.readinto(self.ring) == len(self.ring) * 4):
+                    return
+        except Exception:
+            pass
+        self.clear()
+
+    # Forget every reading
+    def clear(self):
+        for i in range(len(self.ring)):
+            self.ring[i] = 0
+        for i in range(len(self.stats)):
+            self.stats[i] = 0
+        self.state[_HEAD] = 0
+        self.state[_STORED] = 0
+        self.state[_WINDOW] = 0
+        self.state[_SENT] = 0
+        self.state[_SIZE] = self.size
+        self.state[_FIELDS] = len(self.fields)
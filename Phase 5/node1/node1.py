@@ -1,57 +1,162 @@
-import time
 from lora_api import loraAPI
 from pysense import Pysense
+from pycoproc import WAKE_REASON_TIMER
 from SI7006A20 import SI7006A20
 from LTR329ALS01 import LTR329ALS01
+from node_runtime import nodeRuntime
+from sample_ring import sampleRing
+from report_policy import reportPolicy
 
-UPDATE_INTERVAL = 10000 # milliseconds
+SAMPLE_INTERVAL = 10000 # milliseconds between readings
+SAMPLES_PER_UPLINK = 6  # readings summed up in each message sent to the gateway
+RING_SIZE = 48          # readings kept to send if the gateway asks for them.
+                        # Up to 58 fit in one LoRa package.
 
-# Set myself up for connection to the LoRa network
-node = loraAPI(device_id=1, device_name="Node1", device_colour="red", device_colour_code=0xFF0000)
+# Report by exception: instead of a summary every SAMPLES_PER_UPLINK readings,
+# send a reading only when it has changed by more than THRESHOLDS allow
+# (see report_policy.py), or nothing has been sent for HEARTBEAT seconds.
+# The gateway can change them with a "thresholds" message.
+REPORT_BY_EXCEPTION = False
+THRESHOLDS = {"temperature": {"delta": 0.25}, "humidity": {"delta": 2.0}}
+HEARTBEAT = 1800        # seconds
+
+# This node runs on a battery, so it doesn't stay on all the time.
+# It wakes up, takes a reading and then the Pysense turns it off (deep sleep)
+# until the next reading is due. Waking up starts this script again from the top.
+# Sending takes far more power than reading, so readings are collected and
+# only every SAMPLES_PER_UPLINK'th wake turns the radio on, to send a summary
+# of them: the mean, lowest, highest and standard deviation.
+# nodeRuntime does the waking and sleeping, and remembers what it needs to
+# between wakes. sampleRing keeps the readings.
+# With REPORT_BY_EXCEPTION, reportPolicy decides which readings to send instead.
 
 # Set up the Pysense so we can read sensors
-py = Pysense()
+# shadow=True saves the PIC from being told what it already knows
+# each time we set up the sleep
+py = Pysense(shadow=True)
 si = SI7006A20(py)
 lt = LTR329ALS01(py)
 
-def send_measurements():
+# Picks up what was saved by the last wake
+runtime = nodeRuntime(py, SAMPLE_INTERVAL)
+readings = sampleRing(("temperature", "humidity"), RING_SIZE, "/flash/readings.bin")
+
+# Read temperature and humidity from Pysense.
+# One humidity measurement gives us everything: the temperature it was
+# measured at, the humidity, the dew point, and the humidity worked out
+# for the temperature we measured.
+temperature, humid, dew_point, humidity = si.temp_humid()
+readings.add(temperature, humidity)
+readings.save()
+
+# The thresholds the gateway sent and the last reading sent are kept by nodeRuntime
+policy = reportPolicy(THRESHOLDS, HEARTBEAT)
+policy.restore(runtime.saved.get("report"))
+
+# The reading send_reading() sent this wake, and when: (time, values)
+sent_reading = None
+
+# nodeRuntime calls this as the wake ends, to save the policy.
+# The reading only counts as reported once the gateway has acknowledged it.
+# If it hasn't, the next wake's check() still sees the change and sends it again.
+def save_report():
+    if sent_reading is not None and node.unacknowledged() == 0:
+        policy.reported(sent_reading[0], sent_reading[1])
+    return policy.save()
+
+runtime.keep("report", save_report)
+
+def send_summary():
+
+    # Asked again (a request) after this window's summary has gone, with no
+    # reading since: send the latest reading instead. The same summary under
+    # a new sequence number would be published by the gateway a second time.
+    if readings.count() == 0:
+        node.send_packed({"submits": {"temperature": temperature, "humidity": humidity}}, reliable=True)
+        return temperature
+
+    # Send the summary to the gateway.
+    # This data structure is a dictonary: {"summaries": thing_to_be_submitted}
+    # And thing_to_be_submitted is another dictionary, like
+    # {"count": 6, "temperature": [mean, lowest, highest, standard deviation], "humidity": [...]}
+    # send_packed() turns it into 19 bytes of binary data instead of JSON text,
+    # so it's on the air for less time.
+    # reliable=True means the gateway acknowledges it and we resend it if needed
+    node.send_packed({"summaries": readings.summary()}, reliable=True)
+    readings.sent()
+    readings.save()
+
+    # The Pysense uses the temperature to decide if its clock needs checking
+    return temperature
+
+# Send this reading, for report by exception
+# This is {"submits": {"temperature": ..., "humidity": ...}}, packed into 6 bytes
+def send_reading():
+    global sent_reading     # This makes the function use the variable called 'sent_reading'
+                            # that is declared outside of this function.
+
+    values = {"temperature": temperature, "humidity": humidity}
+    node.send_packed({"submits": values}, reliable=True)
+    sent_reading = (py.clock(), values)
+    return temperature
+
+# Send every reading we have kept, oldest first, as {"samples": {"temperature": [...], "humidity": [...]}}
+# Only if the duty cycle limits allow a package that long now.
+def send_samples():
+
+    samples = {"samples": readings.samples()}
+    if node.can_send(loraAPI.packed_size(samples, reliable=True)):
+        node.send_packed(samples, reliable=True)
 
-    # Read temperature and humidity from Pysense
-    temperature = si.temperature()
-    humidity = si.humid_ambient(temperature)
+# nodeRuntime calls this for each message that arrives while we're listening.
+# The gateway holds messages for us until we've sent it something, so they
+# arrive just after our summary.
+def handle_message(device_id, data):
 
-    # Send the data to the gateway.
-    # This data structure is a dictonary: {"submits": thing_to_be_submitted}
-    # And thing_to_be_submitted is another dictionary.
-    # We use dictionaries and lists because they convert nicely into JSON (a plain text format)
-    node.send_as_json({"submits": {"temperature": temperature, "humidity": humidity}})
+    if "requests" in data:
+        # A request for temperature and humidity gets the latest summary
+        # (or this reading, if that has been sent or for report by exception).
+        # It's sent straight away if the duty cycle limits allow, otherwise next time we wake.
+        if "temperature" in data["requests"] and "humidity" in data["requests"]:
+            runtime.request()
+        # A request for samples gets the readings themselves
+        if "samples" in data["requests"]:
+            send_samples()
 
-# This function can be called repeatedly at a high rate. It does nothing
-# if no new LoRa message has been received since it last ran.
-def check_lora_messages():
+    # New thresholds for report by exception.
+    # They're kept with the rest of what nodeRuntime saves.
+    if "thresholds" in data:
+        if policy.update(data["thresholds"]):
+            print("Thresholds now {}, heartbeat {} s".format(policy.thresholds, policy.heartbeat))
 
-    # Get the last LoRa package containing data in JSON format
-    device_id, data = node.receive_json()
+# Turn the radio on once there are enough readings for a summary (or the
+# reading has changed enough to send, for report by exception), or if we
+# still owe the gateway one. Powering up or pressing the button (anything
+# but the timer waking us) sends one straight away too.
+# size is how many bytes that is on the air, for the duty cycle limits.
+if REPORT_BY_EXCEPTION:
+    reason = policy.check(py.clock(), {"temperature": temperature, "humidity": humidity})
+    send = send_reading
+    size = loraAPI.packed_size({"submits": {"temperature": temperature, "humidity": humidity}}, reliable=True)
+else:
+    reason = "summary" if readings.count() >= SAMPLES_PER_UPLINK else None
+    send = send_summary
+    size = loraAPI.packed_size({"summaries": readings.summary()}, reliable=True)
 
-    # If there was a message and both device_id and data (from JSON text) was understood...
-    if device_id and data:
-        # Look inside the data dictionary for a key of "requests" which has inside it
-        # a list containing both the words "temperature" and "humidity"
-        if "requests" in data and "temperature" in data["requests"] and "humidity" in data["requests"]:
-            # If all that succeeds, it's a request to update the gateway with the sensor data
-            send_measurements()
+if reason is not None or runtime.pending or runtime.wake_reason != WAKE_REASON_TIMER:
 
-# last_update_time needs to be set before the while(True) loop
-# so UPDATE_INTERVAL can be correctly observed
-last_update_time = time.ticks_ms()
+    # Set myself up for connection to the LoRa network
+    node = loraAPI(device_id=1, device_name="Node1", device_colour="red", device_colour_code=0xFF0000)
 
-# Do this forever
-while(True):
+    # Let the radio tell us as soon as a package arrives
+    node.listen()
 
-    # If anything came in on the LoRa network, handle that message now
-    check_lora_messages()
+    # Send, listen, then sleep until SAMPLE_INTERVAL after we woke up.
+    # This doesn't return: the Pysense turns the power off.
+    if reason is not None:
+        print("Sending: {}".format(reason))
+    runtime.run(node, send, handle_message, size)
 
-    # Send updates to the gateway on a fixed interval without using time.sleep()
-    if (time.ticks_ms() - last_update_time) > UPDATE_INTERVAL:
-        send_measurements()
-        last_update_time = time.ticks_ms()
+else:
+    # Straight back to sleep without turning the radio on
+    runtime.sleep(temperature)
@@ -0,0 +1,143 @@
+# loraAirtime
+# Core Electronics
+# Works out how long LoRa packages take to send ("time on air") and keeps
+# track of it so a device stays inside its region's duty cycle limits.
+# Nothing here talks to the radio, so it also runs on a computer for planning.
+#
+# Formula from Semtech's SX1272/73 datasheet, section 4.1.1.7 "Time on air".
+
+# Time on air in milliseconds for a package of 'length' bytes.
+# Parameter: sf
+#   Spreading factor, 7 to 12
+# Parameter: bandwidth
+#   In Hz, e.g. 125000
+# Parameter: coding_rate
+#   1 to 4, meaning 4/5 to 4/8
+# Parameter: preamble
+#   Number of preamble symbols (8 unless it has been changed)
+def time_on_air(length, sf=7, bandwidth=125000, coding_rate=1, preamble=8):
+    symbol, preamble_time, bits, divisor, per_block = _constants(sf, bandwidth, coding_rate, preamble)
+    return preamble_time + _payload_symbols(length, bits, divisor, per_block) * symbol
+
+# Time on air (ms) for every package length from 0 to 255 bytes with the
+# same radio settings. Looking up a list is far quicker than time_on_air()
+# when working through thousands of packages.
+def airtime_table(sf=7, bandwidth=125000, coding_rate=1, preamble=8):
+    symbol, preamble_time, bits, divisor, per_block = _constants(sf, bandwidth, coding_rate, preamble)
+    return [preamble_time + _payload_symbols(length, bits, divisor, per_block) * symbol for length in range(256)]
+
+# Time on air (ms) for each length in 'lengths', for capacity planning
+def time_on_air_batch(lengths, sf=7, bandwidth=125000, coding_rate=1, preamble=8):
+    table = airtime_table(sf, bandwidth, coding_rate, preamble)
+    return [table[length] for length in lengths]
+
+# The parts of the formula that only depend on the radio settings
+def _constants(sf, bandwidth, coding_rate, preamble):
+    symbol = (1 << sf) * 1000 / bandwidth   # ms
+    # Low data rate optimisation is required when symbols are longer than 16 ms
+    low_data_rate = 1 if symbol > 16 else 0
+    # Explicit header and CRC are always on (LoRa.LORA mode)
+    bits = -4 * sf + 28 + 16
+    divisor = 4 * (sf - 2 * low_data_rate)
+    return symbol, (preamble + 4.25) * symbol, bits, divisor, coding_rate + 4
+
+def _payload_symbols(length, bits, divisor, per_block):
+    blocks = -(-(8 * length + bits) // divisor)     # Round up
+    return 8 + max(blocks * per_block, 0)
+
+# About DutyCycle
+# Remembers how much time on air has been used in each sub-band over the
+# last 'window' milliseconds, and says whether another package would go
+# over the limit.
+# Parameter: bands
+#   List of (lowest frequency Hz, highest frequency Hz, duty cycle) where
+#   duty cycle 0.01 means 1% of the time. Frequencies not in the list have
+#   no limit.
+# Parameter: max_dwell
+#   Longest a single package may be on air (ms), or None
+# Parameter: diff
+#   Function giving the difference between two times. Pass time.ticks_diff
+#   when using time.ticks_ms(), which wraps around.
+# All times are in milliseconds.
+class DutyCycle:
+
+    def __init__(self, bands, max_dwell=None, window=3600000, diff=None):
+        self.bands = bands
+        self.max_dwell = max_dwell
+        self.window = window
+        self.diff = diff if diff is not None else _diff
+        # One list of [time sent, airtime] per band
+        self.ledger = [[] for band in bands]
+        self.used = [0.0 for band in bands]
+
+    # Which band a frequency is in, or None
+    def band(self, frequency):
+        for i, (low, high, duty) in enumerate(self.bands):
+            if low <= frequency <= high:
+                return i
+        return None
+
+    # Note that a package took 'airtime' ms, sent at time 'now' on 'frequency'
+    def record(self, now, frequency, airtime):
+        i = self.band(frequency)
+        if i is None:
+            return
+        self._expire(i, now)
+        self.ledger[i].append((now, airtime))
+        self.used[i] += airtime
+
+    # Would sending 'airtime' ms on 'frequency' at time 'now' be allowed?
+    def allowed(self, now, frequency, airtime):
+        return self.wait(now, frequency, airtime) == 0
+
+    # How long (ms) from 'now' until 'airtime' ms can be sent on 'frequency'.
+    # Returns None if it never can (longer than max_dwell).
+    def wait(self, now, frequency, airtime):
+        if self.max_dwell is not None and airtime > self.max_dwell:
+            return None
+        i = self.band(frequency)
+        if i is None:
+            return 0
+        self._expire(i, now)
+        allowance = self.bands[i][2] * self.window
+        if airtime > allowance:
+            return None
+        used = self.used[i]
+        if used + airtime <= allowance:
+            return 0
+        # Wait for the oldest packages to fall out of the window
+        # until there is room
+        for sent, old_airtime in self.ledger[i]:
+            used -= old_airtime
+            if used + airtime <= allowance:
+                return max(0, self.diff(sent, now) + self.window)
+        return 0
+
+    # Fraction of each band's allowance used so far
+    def usage(self, now):
+        for i in range(len(self.bands)):
+            self._expire(i, now)
+        return [self.used[i] / (self.bands[i][2] * self.window) for i in range(len(self.bands))]
+
+    # The ledger as [[how long ago (ms), airtime], ...] for each band, which
+    # still means something after a restart, when the clock starts again
+    def save(self, now):
+        for i in range(len(self.bands)):
+            self._expire(i, now)
+        return [[[self.diff(now, sent), airtime] for sent, airtime in ledger] for ledger in self.ledger]
+
+    # Put back a ledger from save(). 'elapsed' is how long (ms) it's been
+    # since save() was called, e.g. time spent asleep.
+    def restore(self, saved, now, elapsed=0):
+        for i in range(min(len(saved), len(self.bands))):
+            self.ledger[i] = [(now - ago - elapsed, airtime) for ago, airtime in saved[i]]
+            self.used[i] = sum([airtime for sent, airtime in self.ledger[i]])
+            self._expire(i, now)
+
+    def _expire(self, i, now):
+        ledger = self.ledger[i]
+        while len(ledger) > 0 and self.diff(now, ledger[0][0]) >= self.window:
+            self.used[i] -= ledger.pop(0)[1]
+
+def _diff(new, old):
+    return new - old
@@ -8,6 +8,9 @@ from pyb_gpio_lcd import GpioLcd
 # Set myself up for connection to the LoRa network
 node = loraAPI(device_id=2, device_name="Node2", device_colour="green", device_colour_code=0x00FF00)
 
+# Let the radio tell us as soon as a package arrives
+node.listen()
+
 # Need to look at the pinout diagram for the Pycom microcontroller
 # to make sure all these pins are available.
 lcd = GpioLcd(rs_pin=Pin('P2'), enable_pin=Pin('P3'), d4_pin=Pin('P4'), d5_pin=Pin('P8'), d6_pin=Pin('P9'), d7_pin=Pin('P10'), num_lines=2, num_columns=16)
@@ -0,0 +1,169 @@
+# node1's sampleRing (node1/lib/sample_ring.py): the cost of each reading
+# and what aggregating readings into summaries saves on the air.
+#
+# Times add(), summary(), samples() and a save()/load() round trip through
+# a temporary folder standing in for flash, for a few ring sizes. Checks
+# that add() keeps nothing new in memory (tracemalloc), and compares the
+# summary's mean and standard deviation with a two pass calculation in
+# double precision, and with adding up squares in single precision like
+# the board would. Then works out packages, bytes and time on air per day
+# by readings per summary (SAMPLES_PER_UPLINK in node1.py), against
+# sending every reading as a JSON submit.
+import os
+import sys
+import math
+import time
+import random
+import shutil
+import tempfile
+import tracemalloc
+from array import array
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+from lora_api import loraAPI
+from lora_airtime import time_on_air
+from sample_ring import sampleRing
+
+FIELDS = ("temperature", "humidity")
+ROUNDS = 20000
+SIZES = (48, 240, 1000)
+SAMPLE_INTERVAL = 10            # seconds, as in node1.py
+RATIOS = (1, 6, 30, 58)         # readings per summary
+ACCURACY_READINGS = 1000
+RELIABLE_HEADER = 2             # RELIABLE_DATA and the sequence number
+ACK_BYTES = 2 + 3               # package header and the acknowledgement
+
+
+def reading(i):
+    # A slow daily swing with some noise, like a room
+    return (21.0 + 3.0 * math.sin(i / 500.0) + random.gauss(0, 0.2),
+            55.0 + 8.0 * math.cos(i / 700.0) + random.gauss(0, 0.5))
+
+
+def timing():
+    readings = [reading(i) for i in range(ROUNDS)]
+    folder = tempfile.mkdtemp()
+    print("{:>6} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "size", "bytes", "add us", "summary us", "samples us", "save+load us"))
+    try:
+        for size in SIZES:
+            ring = sampleRing(FIELDS, size, os.path.join(folder, "ring{}.bin".format(size)))
+            start = time.perf_counter()
+            for temperature, humidity in readings:
+                ring.add(temperature, humidity)
+            add_us = (time.perf_counter() - start) * 1e6 / ROUNDS
+
+            start = time.perf_counter()
+            for i in range(1000):
+                ring.summary()
+            summary_us = (time.perf_counter() - start) * 1e6 / 1000
+
+            start = time.perf_counter()
+            for i in range(100):
+                ring.samples()
+            samples_us = (time.perf_counter() - start) * 1e6 / 100
+
+            start = time.perf_counter()
+            for i in range(100):
+                ring.save()
+                ring.load()
+            save_us = (time.perf_counter() - start) * 1e6 / 100
+
+            arrays = (ring.ring, ring.state, ring.stats)
+            size_bytes = sum([len(a) * a.itemsize for a in arrays])
+            print("{:>6} {:>8} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.1f}".format(
+                size, size_bytes, add_us, summary_us, samples_us, save_us))
+    finally:
+        shutil.rmtree(folder)
+
+
+def memory():
+    ring = sampleRing(FIELDS, 48)
+    readings = [reading(i) for i in range(ROUNDS)]
+    ring.add(*readings[0])
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for temperature, humidity in readings:
+        ring.add(temperature, humidity)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    kept = sum([stat.size_diff for stat in after.compare_to(before, "filename")
+                if stat.traceback[0].filename.endswith("sample_ring.py")])
+    print("memory kept by {} add() calls: {} bytes".format(ROUNDS, kept))
+
+
+# Mean and standard deviation by adding up values and squares in single
+# precision, the way a board without Welford's method would
+def single_sums(values):
+    total = array("f", [0, 0])
+    for value in values:
+        total[0] += value
+        total[1] += value * value
+    n = len(values)
+    mean = total[0] / n
+    return mean, math.sqrt(max(0.0, total[1] / n - mean * mean))
+
+
+def accuracy():
+    # Readings are rounded through single precision, as the ring keeps them
+    values = array("f", [reading(i)[0] for i in range(ACCURACY_READINGS)])
+    ring = sampleRing(("temperature",), ACCURACY_READINGS)
+    for value in values:
+        ring.add(value)
+    mean, low, high, sd = ring.summary()["temperature"]
+
+    n = len(values)
+    exact_mean = sum(values) / n
+    exact_sd = math.sqrt(sum([(value - exact_mean) ** 2 for value in values]) / n)
+    sums_mean, sums_sd = single_sums(values)
+    print("summary of {} readings vs two pass (double precision):".format(n))
+    print("  {:<28} mean error {:.2e}, sd error {:.2e}".format("sampleRing (Welford)", abs(mean - exact_mean), abs(sd - exact_sd)))
+    print("  {:<28} mean error {:.2e}, sd error {:.2e}".format("sums of squares (single)", abs(sums_mean - exact_mean), abs(sums_sd - exact_sd)))
+    print("  low/high match: {}".format(low == min(values) and high == max(values)))
+
+
+def airtime():
+    readings_per_day = 86400 // SAMPLE_INTERVAL
+    submit = loraAPI.pack({"submits": {"temperature": 21.234567, "humidity": 55.123456}})
+    json_bytes = 2 + RELIABLE_HEADER + len('{"submits": {"temperature": 21.234567890123456, "humidity": 55.12345678901234}}')
+
+    # What a request for samples sends, with the most readings that fit
+    ring = sampleRing(FIELDS, max(RATIOS))
+    for i in range(max(RATIOS)):
+        ring.add(*reading(i))
+    samples = loraAPI.pack({"samples": ring.samples()})
+
+    print("reading every {} s, {} a day, each sent reliably (acknowledged):".format(SAMPLE_INTERVAL, readings_per_day))
+    print("packages and bytes per day include the acknowledgements")
+    print("{:<24} {:>8} {:>8} {:>10} {:>10} {:>8}".format("", "bytes", "packages", "bytes/day", "air s/day", "vs JSON"))
+    rows = [("JSON submit each", json_bytes, 1), ("packed submit each", 2 + RELIABLE_HEADER + len(submit), 1)]
+    for ratio in RATIOS:
+        ring = sampleRing(FIELDS, ratio)
+        for i in range(ratio):
+            ring.add(*reading(i))
+        summary = loraAPI.pack({"summaries": ring.summary()})
+        rows.append(("summary of {}".format(ratio), 2 + RELIABLE_HEADER + len(summary), ratio))
+    json_air = None
+    for label, size, ratio in rows:
+        packages = readings_per_day // ratio
+        air = packages * (time_on_air(size) + time_on_air(ACK_BYTES)) / 1000
+        if json_air is None:
+            json_air = air
+        print("{:<24} {:>8} {:>8} {:>10} {:>10.1f} {:>7.1f}x".format(
+            label, size, packages * 2, packages * (size + ACK_BYTES), air, json_air / air))
+    print("samples burst of {} readings: {} bytes, {:.0f} ms on air".format(
+        max(RATIOS), 2 + RELIABLE_HEADER + len(samples), time_on_air(2 + RELIABLE_HEADER + len(samples))))
+
+
+random.seed(1)
+timing()
+print()
+memory()
+print()
+accuracy()
+print()
+airtime()
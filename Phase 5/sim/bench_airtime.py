@@ -0,0 +1,52 @@
+# Time on air and duty cycle planning with lora_airtime.
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+from lora_airtime import time_on_air, time_on_air_batch, DutyCycle
+
+PAYLOADS = 100000
+
+print("Time on air (ms), 125 kHz, coding rate 4/5, 8 symbol preamble")
+print("{:>6} {:>10} {:>10} {:>10}".format("SF", "10 B", "60 B", "242 B"))
+for sf in range(7, 13):
+    print("{:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format(sf, time_on_air(10, sf), time_on_air(60, sf), time_on_air(242, sf)))
+
+lengths = [random.randint(2, 242) for i in range(PAYLOADS)]
+start = time.perf_counter()
+one_by_one = [time_on_air(length, 10) for length in lengths]
+single = time.perf_counter() - start
+start = time.perf_counter()
+batch = time_on_air_batch(lengths, 10)
+batched = time.perf_counter() - start
+assert batch == one_by_one
+print("\n{} random payloads at SF10: time_on_air() {:.1f} ms, time_on_air_batch() {:.1f} ms".format(
+    PAYLOADS, single * 1000, batched * 1000))
+print("total airtime {:.0f} s, {:.1f} nodes' worth of 1% duty cycle for an hour".format(
+    sum(batch) / 1000, sum(batch) / (0.01 * 3600000)))
+
+# How many 60 byte JSON or 8 byte packed messages fit in an hour at 1% (EU868 g1)
+print("\nMessages per hour within 1% duty cycle (EU868 868.1 MHz)")
+print("{:>6} {:>12} {:>12}".format("SF", "JSON 60 B", "packed 8 B"))
+for sf in range(7, 13):
+    counts = []
+    for size in (60, 8):
+        ledger = DutyCycle([(868000000, 868600000, 0.01)])
+        airtime = time_on_air(size, sf)
+        now = 0
+        sent = 0
+        while now < 3600000:
+            wait = ledger.wait(now, 868100000, airtime)
+            if wait:
+                now += wait
+                continue
+            if now >= 3600000:
+                break
+            ledger.record(now, 868100000, airtime)
+            sent += 1
+            now += 1000
+        counts.append(sent)
+    print("{:>6} {:>12} {:>12}".format(sf, counts[0], counts[1]))
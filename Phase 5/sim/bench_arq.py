@@ -0,0 +1,85 @@
+# Goodput of loraAPI.send_reliable() over a simulated lossy link, with a
+# window of 1 (stop-and-wait, like Phase 2's acknowledge()) and larger windows.
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import network
+from lora_api import loraAPI
+
+MESSAGES = 40
+AIRTIME = 0.015     # seconds each package takes on the air
+LATENCY = 0.05      # seconds for the radio to turn around and the receiver to react
+loraAPI.RELIABLE_RETRANSMIT_TIMEOUT = 400   # milliseconds
+loraAPI.RELIABLE_MAX_RETRIES = 20
+
+
+# Packages between two loraAPI objects take AIRTIME on a shared channel,
+# arrive LATENCY after that and are lost with probability 'loss'.
+class LossyLink:
+
+    def __init__(self, loss):
+        self.loss = loss
+        self.busy_until = 0
+        self.lock = threading.Lock()
+        self.packages = 0
+
+    def connect(self, a, b):
+        self._wire(a.sock, b.sock)
+        self._wire(b.sock, a.sock)
+
+    def _wire(self, sock, other):
+        def send(package):
+            with self.lock:
+                now = time.perf_counter()
+                self.busy_until = max(now, self.busy_until) + AIRTIME
+                delay = self.busy_until - now
+                self.packages += 1
+            if random.random() >= self.loss:
+                threading.Timer(delay + LATENCY, other.inject, [package]).start()
+            return len(package)
+        sock.send = send
+
+
+def run(window, loss):
+    loraAPI.RELIABLE_WINDOW = window
+    gateway = loraAPI(device_name="Gateway", is_gateway=True)
+    node = loraAPI(device_id=1, device_name="Node1")
+    link = LossyLink(loss)
+    link.connect(node, gateway)
+
+    delivered = []
+    gateway.listen(lambda device_id, message: delivered.append(message))
+    node.listen()
+
+    start = time.perf_counter()
+    i = 0
+    while i < MESSAGES or node.unacknowledged():
+        if i < MESSAGES and node.send_reliable(str(i)):
+            i += 1
+        else:
+            node.service()
+            gateway.service()
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.5)    # Let the last acknowledgements land
+    gateway.service()
+    return len(set(delivered)) / elapsed, len(delivered) - len(set(delivered)), link.packages, len(set(delivered))
+
+
+random.seed(1)
+stdout = sys.stdout
+sys.stdout = open(os.devnull, "w")
+results = []
+for loss in (0.0, 0.1, 0.3):
+    for window in (1, 4, 8):
+        results.append((loss, window, run(window, loss)))
+sys.stdout = stdout
+
+print("{:>5} {:>7} {:>12} {:>10} {:>9} {:>10}".format("loss", "window", "goodput/s", "delivered", "packages", "dupes out"))
+for loss, window, (goodput, dupes, packages, delivered) in results:
+    print("{:>5.1f} {:>7} {:>12.1f} {:>7}/{:<3} {:>8} {:>10}".format(loss, window, goodput, delivered, MESSAGES, packages, dupes))
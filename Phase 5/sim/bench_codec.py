@@ -0,0 +1,47 @@
+# Compares the bytes on the air and the encode/decode time of
+# loraAPI.send_as_json() against loraAPI.send_packed().
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+from lora_api import loraAPI
+
+ROUNDS = 20000
+
+MESSAGES = [
+    {"submits": {"temperature": 23.4123, "humidity": 55.12}},
+    {"requests": ["temperature", "humidity"]},
+    {"responses": {"temperature": 23.4123, "humidity": 55.12}},
+    {"responses": {"temperature": None, "humidity": None}},
+]
+
+
+def measure(encode, decode, dictionary):
+    message = encode(dictionary)
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        encode(dictionary)
+    encode_us = (time.perf_counter() - start) * 1e6 / ROUNDS
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        decode(message)
+    decode_us = (time.perf_counter() - start) * 1e6 / ROUNDS
+    return len(message), encode_us, decode_us
+
+
+def json_encode(dictionary):
+    return json.dumps(dictionary).encode()
+
+
+print("{:<58} {:>6} {:>9} {:>9}".format("message", "bytes", "enc us", "dec us"))
+for dictionary in MESSAGES:
+    for label, encode, decode in (("json", json_encode, json.loads),
+                                  ("packed", loraAPI.pack, loraAPI.unpack)):
+        size, encode_us, decode_us = measure(encode, decode, dictionary)
+        # Every package also carries the 2 byte device_id/length header
+        print("{:<58} {:>6} {:>9.2f} {:>9.2f}".format(
+            "{} {}".format(label, json.dumps(dictionary))[:58], size + 2, encode_us, decode_us))
+    print("  round trip: {}".format(loraAPI.unpack(loraAPI.pack(dictionary))))
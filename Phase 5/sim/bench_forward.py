@@ -0,0 +1,130 @@
+# Forward latency under concurrent LoRa and MQTT load, comparing the old
+# single while loop gateway with the asyncio tasks gateway.
+#
+# LoRa: a "submits" package arrives every LORA_INTERVAL seconds and the
+#       time until its temperature reaches the broker is measured.
+# MQTT: the broker sends a control message every MQTT_INTERVAL seconds and
+#       the time until the gateway's callback sees it is measured.
+import os
+import sys
+import time
+import json
+import asyncio
+import threading
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+import network
+from broker import Broker
+from lora_api import loraAPI
+from lora_async import loraAsync
+from umqtt import MQTTClient
+from umqtt_async import MQTTClientAsync
+
+DURATION = 8        # seconds per gateway
+LORA_INTERVAL = 0.3
+MQTT_INTERVAL = 0.1
+CONTROL_FEED = "control"
+TEMP_FEED = "temp"
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return float("nan"), float("nan"), 0
+    return values[len(values) // 2] * 1000, values[int(len(values) * 0.99)] * 1000, len(values)
+
+
+def run(gateway):
+    broker = Broker()
+    sent_lora = {}
+    sent_mqtt = {}
+    mqtt_latency = []
+
+    def sub_cb(topic, msg):
+        mqtt_latency.append(time.perf_counter() - sent_mqtt[msg])
+
+    client = MQTTClient(b"bench", "127.0.0.1", broker.port)
+    client.set_callback(sub_cb)
+    client.connect()
+    client.subscribe(CONTROL_FEED)
+    api = loraAPI(device_name="Gateway", is_gateway=True)
+    gateway_loop = gateway(api, client)
+    stop = time.perf_counter() + DURATION
+
+    def traffic():
+        i = 0
+        next_lora = next_mqtt = time.perf_counter()
+        while time.perf_counter() < stop:
+            now = time.perf_counter()
+            if now >= next_lora:
+                message = json.dumps({"submits": {"temperature": i}}).encode()
+                sent_lora[str(i)] = time.perf_counter()
+                api.sock.inject(bytes([1, len(message)]) + message)
+                next_lora += LORA_INTERVAL
+                i += 1
+            if now >= next_mqtt:
+                msg = str(i).encode() + b"-" + str(now).encode()
+                sent_mqtt[msg] = time.perf_counter()
+                broker.publish(CONTROL_FEED, msg)
+                next_mqtt += MQTT_INTERVAL
+            time.sleep(0.001)
+
+    threading.Thread(target=traffic, daemon=True).start()
+    gateway_loop(stop)
+    time.sleep(0.2)
+    broker.close()
+
+    lora_latency = [t - sent_lora[msg.decode()] for t, topic, msg, qos in broker.published if topic == TEMP_FEED]
+    return percentiles(lora_latency), percentiles(mqtt_latency), len(sent_lora), len(sent_mqtt)
+
+
+# Phase 5's original gateway loop
+def while_loop_gateway(api, client):
+
+    def loop(stop):
+        while time.perf_counter() < stop:
+            client.check_msg()
+            device_id, data = api.receive_json()
+            if device_id and data and "submits" in data:
+                client.publish(TEMP_FEED, str(data["submits"]["temperature"]))
+
+    return loop
+
+
+# The same work split into tasks, as in gateway.py
+def asyncio_gateway(api, client):
+    radio = loraAsync(api)
+    aio = MQTTClientAsync(client)
+
+    async def lora_task():
+        while True:
+            device_id, data = await radio.recv_json()
+            if device_id and data and "submits" in data:
+                await aio.publish(TEMP_FEED, str(data["submits"]["temperature"]))
+
+    async def mqtt_task():
+        while True:
+            await aio.wait_msg()
+
+    async def main(stop):
+        tasks = [asyncio.create_task(lora_task()), asyncio.create_task(mqtt_task())]
+        await asyncio.sleep(stop - time.perf_counter())
+        for task in tasks:
+            task.cancel()
+
+    return lambda stop: asyncio.run(main(stop))
+
+
+stdout = sys.stdout
+sys.stdout = open(os.devnull, "w")
+results = [("while loop", run(while_loop_gateway)), ("asyncio tasks", run(asyncio_gateway))]
+sys.stdout = stdout
+
+print("{:<14} {:>22} {:>22}".format("gateway", "LoRa->MQTT p50/p99 ms", "MQTT->cb p50/p99 ms"))
+for label, (lora, mqtt, lora_sent, mqtt_sent) in results:
+    print("{:<14} {:>9.1f} {:>7.1f} {:>4}/{:<4} {:>7.1f} {:>7.1f} {:>4}/{:<4}".format(
+        label, lora[0], lora[1], lora[2], lora_sent, mqtt[0], mqtt[1], mqtt[2], mqtt_sent))
+print("(the last columns are packages/messages handled out of those sent)")
@@ -0,0 +1,55 @@
+# Several nodes ask the gateway for data at once. Compares replying with
+# one package per node with queue()/flush() frames, for JSON and packed messages.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import network
+from lora_api import loraAPI
+
+RESPONSE = {"responses": {"temperature": 23.4123, "humidity": 55.12}}
+
+
+def run(requesters, queue, send_as):
+    gateway = loraAPI(device_name="Gateway", is_gateway=True)
+    nodes = [loraAPI(device_id=2 + i, device_name="Node") for i in range(requesters)]
+    received = []
+    for node in nodes:
+        node.listen(lambda device_id, message: received.append(device_id))
+
+    # Everything the gateway sends reaches every node
+    sizes = []
+    send = gateway.sock.send
+
+    def broadcast(package):
+        sizes.append(len(package))
+        for node in nodes:
+            node.sock.inject(package)
+            node.collect()
+        return send(package)
+
+    gateway.sock.send = broadcast
+
+    for node in nodes:
+        send_as(gateway, RESPONSE, node.device_id, queue=queue)
+    gateway.flush()
+
+    assert sorted(received) == [node.device_id for node in nodes]
+    return len(sizes), sum(sizes), gateway.frame_stats
+
+
+stdout = sys.stdout
+sys.stdout = open(os.devnull, "w")
+results = []
+for label, send_as in (("json", loraAPI.send_as_json), ("packed", loraAPI.send_packed)):
+    for requesters in (1, 2, 4, 8, 16):
+        results.append((label, requesters, run(requesters, False, send_as), run(requesters, True, send_as)))
+sys.stdout = stdout
+
+print("{:<7} {:>10} {:>22} {:>22} {:>14} {:>14}".format(
+    "format", "requesters", "separate: packages/B", "frames: packages/B", "records/frame", "airtime saved"))
+for label, requesters, (packages, size, stats), (frames, frame_size, frame_stats) in results:
+    print("{:<7} {:>10} {:>14} {:>7} {:>14} {:>7} {:>14.1f} {:>11.1f} ms".format(
+        label, requesters, packages, size, frames, frame_size, frame_stats["records"] / frame_stats["frames"],
+        frame_stats["airtime_saved_ms"]))
@@ -0,0 +1,231 @@
+# Benchmark of the whole gateway pipeline: LoRa package in, JSON decoded,
+# "submits" handled, temperature published to MQTT.
+#
+# ../gateway/gateway.py runs unchanged on a simulated board (board.py). Its
+# WiFi, radio and Adafruit IO connection are the stand-ins in this folder and
+# the local broker (broker.py). Synthetic node1 "submits" packages are fed to
+# its LoRa socket at several rates. For each rate it reports:
+#   - throughput: temperatures that reached the broker per second
+#   - forward latency (p50/p99): package arriving to broker receiving it
+#   - time per packet in each stage of the pipeline:
+#       receive_json  unpacking the package (radio callback) + JSON decoding
+#       submits       handle_package() for the "submits" message
+#       send_to_aio   publishing one value over MQTT
+#   - allocations per packet: bytes of heap used by those stages (one
+#     extra run with tracemalloc, as it slows everything down)
+#
+# Results are saved as JSON (default bench_gateway.json) so runs before and
+# after a change can be diffed:
+#
+#   python bench_gateway.py [results.json]
+import os
+import sys
+import json
+import time
+import struct
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import board
+import usocket
+from broker import Broker
+
+RATES = (50, 200, 800, 1600, 3200)  # packages per second
+PACKAGES = 400                      # per rate
+ALLOC_PACKAGES = 100
+NODE_ID = 1
+STAGES = ("receive_json", "submits", "send_to_aio")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# Throws away what the gateway prints, so printing to a terminal isn't
+# what gets measured
+class Quiet:
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        if board.current() is board.default:
+            return self.stream.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+# Wraps the gateway's pipeline stages to time them and, when tracemalloc is
+# running, to measure the heap they use
+class Probe:
+
+    def __init__(self, gateway):
+        self.times = dict((stage, 0.0) for stage in STAGES)
+        self.allocated = dict((stage, 0) for stage in STAGES)
+        self.received = 0.0
+        ns = gateway.namespace
+        api = ns["gateway"]
+        radio = ns["radio"]
+
+        collect = api._collect
+        recv = radio.recv
+        recv_json = radio.recv_json
+        handle_package = ns["handle_package"]
+        send_to_aio = ns["send_to_aio"]
+        probe = self
+
+        def timed_collect(package):
+            start = probe._start()
+            collect(package)
+            probe._stop("receive_json", start)
+
+        async def timed_recv():
+            result = await recv()
+            probe.received = probe._start()
+            return result
+
+        async def timed_recv_json():
+            result = await recv_json()
+            probe._stop("receive_json", probe.received)
+            return result
+
+        def timed_handle_package(device_id, data):
+            start = probe._start()
+            handle_package(device_id, data)
+            if "submits" in data:
+                probe._stop("submits", start)
+
+        async def timed_send_to_aio(feed, value):
+            start = probe._start()
+            result = await send_to_aio(feed, value)
+            probe._stop("send_to_aio", start)
+            return result
+
+        # Instance attributes are found before the class's methods, and the
+        # script looks its functions up in its globals each time
+        api._collect = timed_collect
+        radio.recv = timed_recv
+        radio.recv_json = timed_recv_json
+        ns["handle_package"] = timed_handle_package
+        ns["send_to_aio"] = timed_send_to_aio
+
+    def _start(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self.heap = tracemalloc.get_traced_memory()[0]
+        return time.perf_counter()
+
+    def _stop(self, stage, start):
+        self.times[stage] += time.perf_counter() - start
+        if tracemalloc.is_tracing():
+            self.allocated[stage] += tracemalloc.get_traced_memory()[1] - self.heap
+
+    def reset(self):
+        for stage in STAGES:
+            self.times[stage] = 0.0
+            self.allocated[stage] = 0
+
+
+def package(temperature):
+    message = json.dumps({"submits": {"temperature": temperature, "humidity": 50.0}}).encode()
+    return struct.pack("BB%ds" % len(message), NODE_ID, len(message), message)
+
+
+# Feed 'count' packages to the gateway at 'rate' per second and wait for them
+# to be published. Temperatures are unique so each can be matched up.
+def drive(gateway, broker, probe, rate, count, first):
+    socket = gateway.lora.socket
+    feed = gateway.namespace["AIO_TEMP_FEED"]
+    sent = {}
+    probe.reset()
+    published_before = len(broker.published)
+    start = time.perf_counter()
+    for i in range(count):
+        due = start + i / rate
+        while time.perf_counter() < due:
+            time.sleep(0)
+        temperature = first + i + 0.5
+        sent[str(temperature)] = time.perf_counter()
+        # The radio callback runs as the gateway, like on the board
+        gateway.activate()
+        socket.inject(package(temperature))
+        board.default.activate()
+
+    # Wait until the broker has stopped hearing new values
+    last, seen = time.perf_counter(), published_before
+    while time.perf_counter() - last < 0.5:
+        time.sleep(0.05)
+        if len(broker.published) != seen:
+            seen, last = len(broker.published), time.perf_counter()
+
+    latencies = []
+    finished = start
+    for when, topic, msg, qos in broker.published[published_before:]:
+        if topic == feed and msg.decode() in sent:
+            latencies.append(when - sent[msg.decode()])
+            finished = max(finished, when)
+    forwarded = len(latencies)
+    per_packet = max(forwarded, 1)
+    return {
+        "rate": rate,
+        "sent": count,
+        "forwarded": forwarded,
+        "throughput": forwarded / (finished - start) if forwarded else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "stage_us": dict((stage, probe.times[stage] / per_packet * 1e6) for stage in STAGES),
+    }
+
+
+def main(path):
+    broker = Broker()
+    usocket.redirect["io.adafruit.com"] = ("127.0.0.1", broker.port)
+    sys.stdout = Quiet(sys.stdout)
+    gateway = board.Board("gateway")
+    gateway.start(os.path.join(HERE, "..", "gateway", "gateway.py"))
+    while gateway.namespace is None or "radio" not in gateway.namespace or gateway.error:
+        if gateway.error:
+            raise gateway.error
+        time.sleep(0.05)
+    time.sleep(0.2)
+    probe = Probe(gateway)
+
+    results = {"packages_per_rate": PACKAGES, "rates": []}
+    print("{:>6} {:>10} {:>11} {:>8} {:>8} {:>13} {:>9} {:>12}".format(
+        "rate/s", "forwarded", "throughput", "p50 ms", "p99 ms", "receive_json", "submits", "send_to_aio"))
+    first = 0
+    for rate in RATES:
+        r = drive(gateway, broker, probe, rate, PACKAGES, first)
+        first += PACKAGES
+        results["rates"].append(r)
+        print("{:6} {:>10} {:11.1f} {:>8} {:>8} {:10.1f} us {:6.1f} us {:9.1f} us".format(
+            rate, "{}/{}".format(r["forwarded"], r["sent"]), r["throughput"],
+            "{:.1f}".format(r["latency_p50_ms"]) if r["latency_p50_ms"] is not None else "-",
+            "{:.1f}".format(r["latency_p99_ms"]) if r["latency_p99_ms"] is not None else "-",
+            r["stage_us"]["receive_json"], r["stage_us"]["submits"], r["stage_us"]["send_to_aio"]))
+
+    tracemalloc.start()
+    r = drive(gateway, broker, probe, RATES[0], ALLOC_PACKAGES, first)
+    tracemalloc.stop()
+    per_packet = max(r["forwarded"], 1)
+    results["alloc_bytes_per_packet"] = dict((stage, probe.allocated[stage] / per_packet) for stage in STAGES)
+    results["alloc_bytes_per_packet"]["total"] = sum(probe.allocated.values()) / per_packet
+    print()
+    print("heap bytes used per packet: " + ", ".join(
+        "{} {:.0f}".format(stage, results["alloc_bytes_per_packet"][stage]) for stage in STAGES + ("total",)))
+
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results saved to {}".format(path))
+    board.erase_flash(gateway)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(HERE, "bench_gateway.json"))
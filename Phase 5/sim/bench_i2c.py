@@ -0,0 +1,114 @@
+# I2C errors on the simulated Pysense: the sensor drivers through I2CBus
+# (node1/lib/i2c_bus.py) against plain transfers as they were before.
+#
+# Each reading is what node1 takes: temperature and humidity from the
+# SI7006A20, light from the LTR329ALS01 and the wake reason from the PIC.
+# The bus fails ERROR_RATE of transfers and the SI7006A20 flips a bit in
+# CORRUPT of its results. Counts readings that were right, wrong (a value
+# off by more than the sensor's rounding, which node1 would have sent)
+# or failed (an exception node1 would have had to deal with), the I2C
+# transfers per reading and the bus metrics.
+import os
+import sys
+import time
+import random
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+import board
+import devices
+from pysense import Pysense
+from SI7006A20 import SI7006A20
+from LTR329ALS01 import LTR329ALS01
+
+READINGS = 200
+ERROR_RATES = (0.0, 0.01, 0.05, 0.2)
+CORRUPT = 0.05
+TEMPERATURE = 21.5
+HUMIDITY = 48.0
+LUX = 300.0
+
+
+# The transfers the drivers made without I2CBus: no CRC check, and an
+# error on anything but a poll of the SI7006A20 is passed on
+def old_reading(py, si, lt):
+    i2c = py.i2c
+    i2c.writeto(0x40, bytearray([0xF5]))
+    time.sleep(0.017)
+    start = time.ticks_ms()
+    while True:
+        try:
+            data = i2c.readfrom(0x40, 3)
+            break
+        except OSError:
+            if time.ticks_diff(time.ticks_ms(), start) > 50:
+                raise
+            time.sleep(0.001)
+    humid = si._humid(si._getWord(data[0], data[1]))
+    i2c.writeto(0x40, bytearray([0xE0]))
+    data = i2c.readfrom(0x40, 2)
+    temp = si._temp(si._getWord(data[0], data[1]))
+    light = []
+    for reg in (0x88, 0x89, 0x8A, 0x8B):
+        light.append(i2c.readfrom_mem(0x29, reg, 1)[0])
+    i2c.writeto(0x08, bytes([0x00, 0x4C, 0x06]))
+    while i2c.readfrom(0x08, 1)[0] != 0xFF:
+        time.sleep(0.0001)
+    i2c.readfrom(0x08, 2)
+    return temp, humid, (light[3] << 8) + light[2]
+
+
+def new_reading(py, si, lt):
+    temp, humid, dew_p, humid_ambient = si.temp_humid()
+    ch0, ch1 = lt.light()
+    py.get_wake_reason()
+    return temp, humid, ch0
+
+
+def run(read, error_rate):
+    random.seed(1)
+    pysense = devices.pysense_devices(lambda: TEMPERATURE, lambda: HUMIDITY, lambda: LUX)
+    board.Board("node1", devices=pysense).activate()
+    py = Pysense()
+    si = SI7006A20(py)
+    lt = LTR329ALS01(py)
+    expected = (TEMPERATURE, HUMIDITY, lt.light()[0])
+    py.i2c.error_rate = error_rate
+    pysense[0x40].corrupt_rate = CORRUPT
+    transfers = len(py.i2c.transactions)
+    py.bus.__init__(py.i2c)     # metrics from here on
+    right = wrong = failed = 0
+    for i in range(READINGS):
+        try:
+            temp, humid, ch0 = read(py, si, lt)
+        except Exception:
+            failed += 1
+            continue
+        if abs(temp - expected[0]) > 0.1 or abs(humid - expected[1]) > 0.1 or ch0 != expected[2]:
+            wrong += 1
+        else:
+            right += 1
+    transfers = (len(py.i2c.transactions) - transfers) / READINGS
+    return right, wrong, failed, transfers, py.bus.metrics()
+
+
+def main():
+    print("{} readings, SI7006A20 results corrupted {:.0f}% of the time".format(READINGS, CORRUPT * 100))
+    print("{:>8} {:<10} {:>6} {:>6} {:>7} {:>9} {:>7} {:>7} {:>8}".format(
+        "bus", "", "right", "wrong", "failed", "transfers", "errors", "CRC", "retries"))
+    print("{:>8} {:<10} {:>6} {:>6} {:>7} {:>9} {:>7} {:>7} {:>8}".format(
+        "errors", "", "", "", "", "/reading", "", "errors", ""))
+    for error_rate in ERROR_RATES:
+        for name, read in (("old", old_reading), ("I2CBus", new_reading)):
+            right, wrong, failed, transfers, metrics = run(read, error_rate)
+            if read is old_reading:
+                errors = crc = retries = "-"
+            else:
+                errors, crc, retries = metrics["errors"], metrics["crc_errors"], metrics["retries"]
+            print("{:>7.0f}% {:<10} {:6} {:6} {:7} {:9.1f} {:>7} {:>7} {:>8}".format(
+                error_rate * 100, name, right, wrong, failed, transfers, errors, crc, retries))
+
+
+main()
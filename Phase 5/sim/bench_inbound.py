@@ -0,0 +1,88 @@
+# Inbound MQTT messages per second and socket calls per message, comparing
+# the original umqtt reader (sock.read() for each byte of the length, then
+# each field, switching blocking on and off every call) with the buffered
+# reader that parses every complete packet in one check_msg() pass.
+import os
+import sys
+import time
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+from broker import Broker
+from umqtt import MQTTClient
+
+MESSAGES = 20000
+BURST = 2000        # messages already waiting when the client starts reading
+TOPIC = "CoreChris/feeds/control"
+
+
+# umqtt's check_msg() before the receive buffer, for comparison
+def old_check_msg(client):
+    client.sock.setblocking(False)
+    res = client.sock.read(1)
+    client.sock.setblocking(True)
+    if res is None:
+        return None
+    if res == b"":
+        raise OSError(-1)
+    if res == b"\xd0":  # PINGRESP
+        sz = client.sock.read(1)[0]
+        assert sz == 0
+        return None
+    op = res[0]
+    if op & 0xf0 != 0x30:
+        return op
+    n = 0
+    sh = 0
+    while 1:
+        b = client.sock.read(1)[0]
+        n |= (b & 0x7f) << sh
+        if not b & 0x80:
+            break
+        sh += 7
+    topic_len = client.sock.read(2)
+    topic_len = (topic_len[0] << 8) | topic_len[1]
+    topic = client.sock.read(topic_len)
+    n -= topic_len + 2
+    msg = client.sock.read(n)
+    client.cb(topic, msg)
+
+
+def run(name, check_msg, messages, burst):
+    broker = Broker()
+    client = MQTTClient(b"bench", "127.0.0.1", broker.port)
+    received = []
+    client.set_callback(lambda topic, msg: received.append(msg))
+    client.connect()
+    client.subscribe(TOPIC)
+    reads = client.sock.reads
+    mode_changes = client.sock.mode_changes
+    checks = 0
+
+    sender = threading.Thread(target=lambda: [broker.publish(TOPIC, str(i)) for i in range(messages)])
+    sender.start()
+    if burst:
+        sender.join()
+        time.sleep(0.2)
+    start = time.perf_counter()
+    while len(received) < messages:
+        check_msg(client)
+        checks += 1
+    elapsed = time.perf_counter() - start
+    sender.join()
+    assert received[-1] == str(messages - 1).encode()
+    print("{:<8} {:<22} {:10.0f} {:9.2f} {:10.2f} {:10.2f}".format(
+        "burst" if burst else "stream", name, messages / elapsed, (client.sock.reads - reads) / messages,
+        (client.sock.mode_changes - mode_changes) / messages, messages / checks))
+    client.disconnect()
+    broker.close()
+
+
+print("{:<8} {:<22} {:>10} {:>9} {:>10} {:>10}".format("traffic", "reader", "msgs/s", "reads", "setblock", "msgs per"))
+print("{:<8} {:<22} {:>10} {:>9} {:>10} {:>10}".format("", "", "", "/msg", "/msg", "check_msg"))
+for messages, burst in ((MESSAGES, False), (BURST, True)):
+    run("byte at a time (old)", old_check_msg, messages, burst)
+    run("buffered", lambda client: client.check_msg(), messages, burst)
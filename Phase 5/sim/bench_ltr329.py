@@ -0,0 +1,111 @@
+# LTR329ALS01 light readings on the simulated Pysense.
+#
+# 1. Cost per light() call: the old driver's four 1 byte register reads
+#    against one 4 byte burst into the driver's own buffer. I2C
+#    transactions, bytes on the bus, result buffers the I2C calls had to
+#    allocate (readfrom_mem makes a new bytes object each time,
+#    readfrom_mem_into doesn't) and time.
+# 2. lux() from darkness to sunlight with a fixed gain (1X and 96X, both
+#    100 ms) and with auto ranging: the error against the light the sensor
+#    model was given, and how many measurements auto ranging took. 96X
+#    saturates in daylight, 1X reads nothing in the dark.
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+import board
+import devices
+from machine import I2C
+from i2c_bus import I2CBus
+from LTR329ALS01 import LTR329ALS01
+
+CALLS = 2000
+LUX = (0.05, 1, 20, 300, 1500, 10000, 60000)
+
+
+class CountingI2C(I2C):
+    """ counts the result buffers I2C calls allocate """
+
+    allocations = 0
+
+    def readfrom(self, addr, nbytes, stop=True):
+        self.allocations += 1
+        return I2C.readfrom(self, addr, nbytes, stop)
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        self.allocations += 1
+        return I2C.readfrom_mem(self, addr, memaddr, nbytes, addrsize)
+
+
+class FakePysense:
+
+    def __init__(self, lux=300.0):
+        self.sensor = devices.LTR329ALS01(lambda: self.lux)
+        self.lux = lux
+        board.Board("node1", devices={0x29: self.sensor}).activate()
+        self.i2c = CountingI2C(0)
+        self.bus = I2CBus(self.i2c)
+
+
+# LTR329ALS01.light() before the burst read, for comparison
+def old_light(lt):
+    ch1low = lt.i2c.readfrom_mem(0x29, 0x88, 1)
+    ch1high = lt.i2c.readfrom_mem(0x29, 0x89, 1)
+    data1 = int(lt._getWord(ch1high[0], ch1low[0]))
+    ch0low = lt.i2c.readfrom_mem(0x29, 0x8A, 1)
+    ch0high = lt.i2c.readfrom_mem(0x29, 0x8B, 1)
+    data0 = int(lt._getWord(ch0high[0], ch0low[0]))
+    return (data0, data1)
+
+
+def per_call():
+    print("{:<14} {:>12} {:>12} {:>12} {:>12}".format("per call", "transactions", "bus bytes", "allocations", "us"))
+    for name, read in (("old light()", old_light), ("light()", lambda lt: lt.light())):
+        pysense = FakePysense()
+        lt = LTR329ALS01(pysense)
+        i2c = pysense.i2c
+        transactions = len(i2c.transactions)
+        allocations = i2c.allocations
+        start = time.perf_counter()
+        for i in range(CALLS):
+            counts = read(lt)
+        elapsed = (time.perf_counter() - start) / CALLS
+        print("{:<14} {:12.1f} {:12.1f} {:12.1f} {:12.1f}".format(
+            name, (len(i2c.transactions) - transactions) / CALLS,
+            sum(t[2] for t in i2c.transactions[transactions:]) / CALLS,
+            (i2c.allocations - allocations) / CALLS, elapsed * 1000000))
+    print("counts: {}".format(counts))
+
+
+def ranging():
+    print("{:>8} {:>12} {:>12} {:>12} {:>12} {:>12}".format("", "1X 100ms", "96X 100ms", "auto", "auto", "auto"))
+    print("{:>8} {:>12} {:>12} {:>12} {:>12} {:>12}".format("lux", "error", "error", "error", "readings", "gain, ms"))
+    fixed = {}
+    for gain in (LTR329ALS01.ALS_GAIN_1X, LTR329ALS01.ALS_GAIN_96X):
+        pysense = FakePysense()
+        lt = LTR329ALS01(pysense, gain=gain, auto_range=False)
+        lt.wait_for_data()
+        fixed[gain] = (pysense, lt)
+    pysense = FakePysense()
+    auto = LTR329ALS01(pysense)
+    auto.wait_for_data()
+    for lux in LUX:
+        errors = []
+        for gain in (LTR329ALS01.ALS_GAIN_1X, LTR329ALS01.ALS_GAIN_96X):
+            fixed[gain][0].lux = lux
+            errors.append(fixed[gain][1].lux() / lux - 1)
+        pysense.lux = lux
+        measurements = auto.measurements
+        errors.append(auto.lux() / lux - 1)
+        print("{:8} {:>12} {:>12} {:>12} {:12} {:>12}".format(
+            lux, *["{:+.1%}".format(e) for e in errors], auto.measurements - measurements,
+            "{}X {}".format(auto.GAIN[auto.gain], auto.INTEGRATION_MS[auto.integration])))
+
+
+per_call()
+print()
+ranging()
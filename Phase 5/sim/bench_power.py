@@ -0,0 +1,130 @@
+# Power use of node1 (node1.py run unchanged on a simulated board and
+# channel, with a gateway acknowledging its readings), as deep sleep wakes
+# with nodeRuntime against the loop it had before, which kept the board
+# and radio on all the time.
+#
+# The simulation gives the time each wake keeps the board on, the time the
+# radio is on (only every SAMPLES_PER_UPLINK'th wake sets it up), the time
+# on air and the time asleep; WAKES wakes are run, with deep sleep shortened
+# by SLEEP_SCALE so it doesn't take long. mAh per day then comes from the
+# current figures below. They are assumptions, typical datasheet values
+# for a LoPy4 on a Pysense, not measurements: measure your own board to
+# be sure. Boot time isn't simulated, so BOOT_MS is added to every wake.
+#
+# Also checks that the summaries all reach the gateway: a wake starts from
+# scratch, so without the state nodeRuntime saves (sequence numbers, etc.)
+# the gateway takes every message after the first for one it already has.
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+import board
+import devices
+import lorasim
+from lora_api import loraAPI
+from lora_airtime import time_on_air
+from node_runtime import nodeRuntime
+
+WAKES = 19
+REQUEST_AT = 4          # the gateway gets a request for node1 after this wake
+SLEEP_SCALE = 0.02
+NODE1 = os.path.join(HERE, "..", "node1", "node1.py")
+SAMPLE_INTERVAL = 10    # seconds, as in node1.py
+SAMPLES_PER_UPLINK = 6  # as in node1.py
+
+# Assumed currents (mA)
+CPU_MA = 35.0           # ESP32 running
+RX_MA = 11.0            # SX1276 receiving, on top of the CPU
+TX_MA = 45.0            # SX1276 sending at 14 dBm, instead of receiving
+SLEEP_MA = 0.02         # Pysense with the module off, sensors idle
+BOOT_MS = 1000          # firmware boot after deep sleep, before node1.py runs
+BATTERY_MAH = 2000
+
+# The loop before sent every reading as JSON text, reliably
+LOOP_AIRTIME_MS = time_on_air(2 + 2 + len('{"submits": {"temperature": 21.234567890123456, "humidity": 55.12345678901234}}'))
+
+
+def run(keep_state):
+    channel = lorasim.Channel()
+    gateway_board = board.Board("gateway", (0.0, 0.0), channel)
+    gateway_board.activate()
+    gateway = loraAPI(device_name="Gateway", is_gateway=True)
+    received = []
+    gateway.listen(lambda device_id, message: received.append(message))
+    gateway.hold_for(1)
+
+    node = board.Board("node1", (30.0, 0.0), channel, devices.pysense_devices())
+    node.sleep_scale = SLEEP_SCALE
+    load = nodeRuntime.load
+    if not keep_state:
+        nodeRuntime.load = lambda self: None
+    node.start(NODE1)
+    requested = False
+    while node.wakes < WAKES:
+        if not requested and node.wakes >= REQUEST_AT:
+            gateway_board.activate()
+            gateway.send_as_json({"requests": ["temperature", "humidity"]}, 1, queue=True)
+            requested = True
+        # Acknowledges node1 and passes its messages on
+        gateway.service()
+        time.sleep(0.01)
+    result = {"awake": node.awake, "radio": node.radio, "asleep": node.asleep, "airtime": node.airtime,
+              "sent": sum([1 for package in gateway_board.lora.socket.sent if package[2] == loraAPI.RELIABLE_ACK]),
+              "received": len(received)}
+    nodeRuntime.load = load
+    board.erase_flash(node)
+    return result
+
+
+# mAh per day for a reading every 'interval' seconds, each wake keeping the
+# board on for awake_ms, the radio for radio_ms and transmitting for airtime_ms
+def sleeping_mah(interval, awake_ms, radio_ms, airtime_ms):
+    wakes = 86400.0 / interval
+    on = (BOOT_MS + awake_ms) / 3600000.0
+    radio = radio_ms / 3600000.0
+    tx = airtime_ms / 3600000.0
+    asleep = max(0.0, 24.0 - wakes * on)
+    return wakes * (on * CPU_MA + radio * RX_MA + tx * (TX_MA - RX_MA)) + asleep * SLEEP_MA
+
+
+# mAh per day for the loop before: board and radio on all the time
+def loop_mah(interval, airtime_ms):
+    wakes = 86400.0 / interval
+    return 24.0 * (CPU_MA + RX_MA) + wakes * airtime_ms / 3600000.0 * (TX_MA - RX_MA)
+
+
+def main():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    with_state = run(True)
+    without_state = run(False)
+    sys.stdout = stdout
+
+    awake_ms = with_state["awake"] / WAKES * 1000
+    radio_ms = with_state["radio"] / WAKES * 1000
+    airtime_ms = with_state["airtime"] / WAKES
+    print("{} wakes of node1 in the simulation:".format(WAKES))
+    print("  awake {:.0f} ms, radio on {:.0f} ms, on air {:.0f} ms, asleep {:.1f} s per wake (+{} ms boot assumed)".format(
+        awake_ms, radio_ms, airtime_ms, with_state["asleep"] / WAKES, BOOT_MS))
+    print("  messages the gateway passed on: {} with saved state, {} without (it heard {})".format(
+        with_state["received"], without_state["received"], without_state["sent"]))
+    print()
+    print("Assumed: CPU {} mA, RX +{} mA, TX {} mA, deep sleep {} mA, {} mAh battery".format(
+        CPU_MA, RX_MA, TX_MA, SLEEP_MA, BATTERY_MAH))
+    print("Reading every 'interval' s. The loop sent each one ({:.0f} ms on air), deep sleep".format(LOOP_AIRTIME_MS))
+    print("sends a summary of every {} as above.".format(SAMPLES_PER_UPLINK))
+    print("{:>10} {:>12} {:>12} {:>8} {:>12} {:>12}".format("interval", "loop", "deep sleep", "ratio", "loop", "deep sleep"))
+    print("{:>10} {:>12} {:>12} {:>8} {:>12} {:>12}".format("s", "mAh/day", "mAh/day", "", "days", "days"))
+    for interval in (SAMPLE_INTERVAL, 60, 300, 900):
+        loop = loop_mah(interval, LOOP_AIRTIME_MS)
+        sleeping = sleeping_mah(interval, awake_ms, radio_ms, airtime_ms)
+        print("{:10} {:12.1f} {:12.2f} {:8.1f} {:12.1f} {:12.1f}".format(
+            interval, loop, sleeping, loop / sleeping, BATTERY_MAH / loop, BATTERY_MAH / sleeping))
+
+
+main()
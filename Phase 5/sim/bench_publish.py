@@ -0,0 +1,89 @@
+# Socket writes, bytes and TCP segments per MQTT publish, comparing the
+# original umqtt publish (a write for each part of the packet) with the
+# packet built in one buffer, and with publish_many() sending a batch.
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+import ustruct as struct
+from broker import Broker
+from umqtt import MQTTClient
+
+MESSAGES = 2000
+BATCH = 2           # gateway.py publishes temperature and humidity together
+TOPIC = "CoreChris/feeds/temp"
+
+
+# umqtt's publish before it used one buffer, for comparison
+def split_publish(client, topic, msg, retain=False, qos=0):
+    pkt = bytearray(b"\x30\0\0\0")
+    pkt[0] |= qos << 1 | retain
+    sz = 2 + len(topic) + len(msg)
+    if qos > 0:
+        sz += 2
+    i = 1
+    while sz > 0x7f:
+        pkt[i] = (sz & 0x7f) | 0x80
+        sz >>= 7
+        i += 1
+    pkt[i] = sz
+    client.sock.write(pkt, i + 1)
+    client.sock.write(struct.pack("!H", len(topic)))
+    client.sock.write(topic)
+    if qos > 0:
+        pid = client._next_pid()
+        struct.pack_into("!H", pkt, 0, pid)
+        client.sock.write(pkt, 2)
+    client.sock.write(msg)
+    if qos == 1:
+        while client.wait_msg() != 0x40:    # PUBACK
+            pass
+
+
+def run(name, qos, send):
+    broker = Broker()
+    client = MQTTClient(b"bench", "127.0.0.1", broker.port)
+    client.connect()
+    writes_before = len(client.sock.writes)
+    bytes_before = sum(client.sock.writes)
+    segments_before = broker.segments
+    messages = [(TOPIC, "{:.2f}".format(20 + i / 100)) for i in range(MESSAGES)]
+    start = time.perf_counter()
+    send(client, messages, qos)
+    elapsed = time.perf_counter() - start
+    while len(broker.published) < MESSAGES:
+        time.sleep(0.01)
+    writes = len(client.sock.writes) - writes_before
+    sent = sum(client.sock.writes) - bytes_before
+    print("{:<24} {:3} {:9.2f} {:9.1f} {:10.2f} {:9.1f}".format(
+        name, qos, writes / MESSAGES, sent / MESSAGES, (broker.segments - segments_before) / MESSAGES,
+        elapsed * 1e6 / MESSAGES))
+    client.disconnect()
+    broker.close()
+
+
+def send_split(client, messages, qos):
+    for topic, msg in messages:
+        split_publish(client, topic, msg, qos=qos)
+
+
+def send_one(client, messages, qos):
+    for topic, msg in messages:
+        client.publish(topic, msg, qos=qos)
+
+
+def send_many(client, messages, qos):
+    for i in range(0, len(messages), BATCH):
+        client.publish_many(messages[i:i + BATCH], qos=qos)
+
+
+print("{:<24} {:>3} {:>9} {:>9} {:>10} {:>9}".format("publish", "qos", "writes", "bytes", "segments", "us"))
+print("{:<24} {:>3} {:>9} {:>9} {:>10} {:>9}".format("", "", "/msg", "/msg", "/msg", "/msg"))
+for qos in (0, 1):
+    run("write per part (old)", qos, send_split)
+    run("one buffer", qos, send_one)
+    run("publish_many({})".format(BATCH), qos, send_many)
@@ -0,0 +1,172 @@
+# The Pycoproc command layer (node1/lib/pycoproc.py) on the simulated
+# Pysense: the old one, which built a bytes object for every command,
+# polled the status byte and then read the answer separately, against
+# the preallocated buffers and views, with the answer read along with the
+# status byte that says it's ready.
+#
+# For each operation: I2C transactions, bytes on the bus, transfer buffers
+# allocated (bytes objects written, and results of readfrom(), which
+# allocates where readfrom_into() doesn't) and time. The PIC model
+# answers "busy" to the first status poll after each command, as the real
+# one usually does.
+#
+# Then the sleep-entry sequence with and without the register shadow
+# (Pycoproc(shadow=True)): PIC commands and I2C transactions for
+# __init__, go_to_sleep(), go_to_sleep() with interrupt and INT pin
+# wake-up set up, and a second go_to_sleep(), checking the PIC's
+# registers end up the same either way.
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+import board
+import devices
+from machine import I2C
+from pysense import Pysense
+
+REPEAT = 500
+
+
+class CountingI2C(I2C):
+    """ counts the transfer buffers allocated around I2C calls """
+
+    allocations = 0
+
+    def writeto(self, addr, buf, stop=True):
+        if isinstance(buf, bytes):
+            self.allocations += 1
+        return I2C.writeto(self, addr, buf, stop)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        self.allocations += 1
+        return I2C.readfrom(self, addr, nbytes, stop)
+
+
+# The command layer before, on the plain I2C object
+class Old:
+
+    def __init__(self, i2c):
+        self.i2c = i2c
+
+    def _write(self, data, wait=True):
+        self.i2c.writeto(8, data)
+        if wait:
+            self._wait()
+
+    def _read(self, size):
+        return self.i2c.readfrom(8, size + 1)[1:(size + 1)]
+
+    def _wait(self):
+        time.sleep_us(10)
+        while self.i2c.readfrom(8, 1)[0] != 0xFF:
+            time.sleep_us(100)
+
+    def read_fw_version(self):
+        self._write(bytes([0x11]))
+        d = self._read(2)
+        return (d[1] << 8) + d[0]
+
+    def peek_memory(self, addr):
+        self._write(bytes([0x00, addr & 0xFF, (addr >> 8) & 0xFF]))
+        return self._read(1)[0]
+
+    def poke_memory(self, addr, value):
+        self._write(bytes([0x01, addr & 0xFF, (addr >> 8) & 0xFF, value & 0xFF]))
+
+    def magic_write_read(self, addr, _and=0xFF, _or=0, _xor=0):
+        self._write(bytes([0x02, addr & 0xFF, (addr >> 8) & 0xFF, _and & 0xFF, _or & 0xFF, _xor & 0xFF]))
+        return self._read(1)[0]
+
+    def init(self):
+        # Pycoproc.__init__()
+        self.read_fw_version()
+        self.poke_memory(0x18E, 1 << 2)
+        self.poke_memory(0x9D, (0x06 << 2) | 0x01)
+        self.poke_memory(0x9E, (0x06 << 4))
+        self.poke_memory(0x20C, (1 << 3))
+        self.magic_write_read(0x08E, _or=1 << 5)
+        self.magic_write_read(0x08E, _and=~(1 << 6))
+        self.magic_write_read(0x08E, _and=~(1 << 7))
+        self.read_fw_version()
+
+
+def new_board():
+    board.Board("node1", devices={0x08: devices.PIC()}).activate()
+    return CountingI2C(0)
+
+
+def measure(name, operation, i2c, repeat=REPEAT):
+    transactions = len(i2c.transactions)
+    allocations = i2c.allocations
+    start = time.perf_counter()
+    for i in range(repeat):
+        operation()
+    elapsed = (time.perf_counter() - start) / repeat
+    done = i2c.transactions[transactions:]
+    print("{:<28} {:12.1f} {:10.1f} {:12.1f} {:10.1f}".format(
+        name, len(done) / repeat, sum(t[2] for t in done) / repeat,
+        (i2c.allocations - allocations) / repeat, elapsed * 1000000))
+
+
+def sleep_entry(shadow):
+    pic = devices.PIC()
+    board.Board("node1", devices={0x08: pic}).activate()
+    i2c = CountingI2C(0)
+    rows = []
+
+    def step(name, operation):
+        commands = pic.commands
+        transactions = len(i2c.transactions)
+        operation()
+        rows.append((name, pic.commands - commands, len(i2c.transactions) - transactions))
+
+    py = None
+
+    def init():
+        nonlocal py
+        py = Pysense(i2c, shadow=shadow)
+
+    def wake_ups():
+        py.setup_int_wake_up(True, False)
+        py.setup_int_pin_wake_up(False)
+        py.go_to_sleep()
+
+    step("__init__", init)
+    step("go_to_sleep()", py.go_to_sleep)
+    step("wake-ups set, go_to_sleep()", wake_ups)
+    step("go_to_sleep() again", py.go_to_sleep)
+    return rows, dict(pic.memory)
+
+
+def sleeping():
+    print("{:<28} {:>10} {:>12} {:>10} {:>12}".format("", "commands", "transactions", "commands", "transactions"))
+    print("{:<28} {:>10} {:>12} {:>10} {:>12}".format("", "", "", "shadow", "shadow"))
+    rows, memory = sleep_entry(False)
+    shadow_rows, shadow_memory = sleep_entry(True)
+    for (name, commands, transactions), (name, shadow_commands, shadow_transactions) in zip(rows, shadow_rows):
+        print("{:<28} {:10} {:12} {:10} {:12}".format(name, commands, transactions, shadow_commands, shadow_transactions))
+    print("PIC registers the same: {}".format("yes" if memory == shadow_memory else "NO"))
+
+
+def main():
+    print("{:<28} {:>12} {:>10} {:>12} {:>10}".format("", "transactions", "bus bytes", "allocations", "us"))
+    i2c = new_board()
+    old = Old(i2c)
+    py = Pysense(i2c)
+    for name, before, after in (
+            ("init (Pycoproc.__init__)", old.init, lambda: Pysense(i2c)),
+            ("read_fw_version()", old.read_fw_version, py.read_fw_version),
+            ("peek_memory()", lambda: old.peek_memory(0x0C), lambda: py.peek_memory(0x0C)),
+            ("poke_memory()", lambda: old.poke_memory(0x9D, 0), lambda: py.poke_memory(0x9D, 0)),
+            ("set_bits_in_memory()", lambda: old.magic_write_read(0x0E, _or=0x80), lambda: py.set_bits_in_memory(0x0E, 0x80))):
+        measure("old " + name, before, i2c)
+        measure("new " + name, after, i2c)
+
+
+main()
+print()
+sleeping()
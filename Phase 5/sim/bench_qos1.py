@@ -0,0 +1,50 @@
+# QoS 1 publish throughput over a link with a round trip of LATENCY,
+# comparing publish(qos=1), which waits for each PUBACK, with
+# publish_nowait() keeping up to 'window' publishes unacknowledged.
+# The last rows lose some PUBACKs so publishes are resent with DUP set.
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+from broker import Broker
+from umqtt import MQTTClient
+
+MESSAGES = 200
+LATENCY = 0.02          # seconds
+RETRANSMIT_MS = 200
+TOPIC = "CoreChris/feeds/temp"
+
+
+def run(name, window, loss=0.0):
+    broker = Broker(latency=LATENCY, drop_acks=loss)
+    client = MQTTClient(b"bench", "127.0.0.1", broker.port)
+    client.connect()
+    client.retransmit_ms = RETRANSMIT_MS
+    start = time.perf_counter()
+    if window is None:
+        for i in range(MESSAGES):
+            client.publish(TOPIC, str(i), qos=1)
+    else:
+        client.window = window
+        for i in range(MESSAGES):
+            client.publish_nowait(TOPIC, str(i))
+        client.flush()
+    elapsed = time.perf_counter() - start
+    delivered = len(set(msg for when, topic, msg, qos in broker.published))
+    print("{:<22} {:5.0%} {:10.1f} {:>9} {:11}".format(
+        name, loss, MESSAGES / elapsed, "{}/{}".format(delivered, MESSAGES), broker.duplicates))
+    client.disconnect()
+    broker.close()
+
+
+print("round trip {:.0f} ms, {} publishes".format(LATENCY * 1000, MESSAGES))
+print("{:<22} {:>5} {:>10} {:>9} {:>11}".format("publish", "loss", "msgs/s", "delivered", "resent(DUP)"))
+run("publish(qos=1)", None)
+for window in (1, 4, 8, 16):
+    run("window {}".format(window), window)
+run("publish(qos=1)", None, 0.1)
+run("window 8", 8, 0.1)
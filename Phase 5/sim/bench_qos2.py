@@ -0,0 +1,112 @@
+# QoS 2 (exactly once) publishing with umqtt against the broker stand-in.
+#
+# Throughput of publish(qos=2), which waits for PUBREC and PUBCOMP, and of
+# publish_nowait(qos=2) with a window of unfinished publishes, then checks
+# that every message reaches the broker exactly once when:
+#   - PUBRECs and PUBCOMPs are lost and have to be resent for
+#   - the client "reboots" part way through and a new client carries on
+#     from the in-flight table it saved (set_persist())
+#   - the broker sends the client a QoS 2 message twice
+import os
+import sys
+import time
+import tempfile
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+from broker import Broker
+from umqtt import MQTTClient
+
+MESSAGES = 100
+LATENCY = 0.02          # seconds
+RETRANSMIT_MS = 200
+TOPIC = "CoreChris/feeds/meter"
+
+
+def client(broker, persist=None):
+    c = MQTTClient(b"meter", "127.0.0.1", broker.port)
+    c.retransmit_ms = RETRANSMIT_MS
+    if persist:
+        c.set_persist(persist)
+    c.connect(clean_session=persist is None)
+    return c
+
+
+def exactly_once(broker, count):
+    seen = Counter(msg for when, topic, msg, qos in broker.published)
+    return all(seen[str(i).encode()] == 1 for i in range(count)) and len(seen) == count
+
+
+def report(name, broker, elapsed, ok):
+    print("{:<30} {:10.1f} {:>12} {:12}".format(name, MESSAGES / elapsed, "yes" if ok else "NO", broker.duplicates))
+
+
+def throughput(name, window, loss=0.0):
+    broker = Broker(latency=LATENCY, drop_acks=loss)
+    c = client(broker)
+    start = time.perf_counter()
+    if window is None:
+        for i in range(MESSAGES):
+            c.publish(TOPIC, str(i), qos=2)
+    else:
+        c.window = window
+        for i in range(MESSAGES):
+            c.publish_nowait(TOPIC, str(i), qos=2)
+        c.flush()
+    report(name, broker, time.perf_counter() - start, exactly_once(broker, MESSAGES))
+    c.disconnect()
+    broker.close()
+
+
+def reboot(window=16):
+    broker = Broker(latency=LATENCY)
+    path = os.path.join(tempfile.mkdtemp(), "mqtt_inflight")
+    start = time.perf_counter()
+    first = client(broker, path)
+    first.window = window
+    for i in range(MESSAGES // 2):
+        first.publish_nowait(TOPIC, str(i), qos=2)
+    # Power goes off: no DISCONNECT, nothing more is processed
+    unfinished = len(first.inflight)
+    first.sock.close()
+
+    second = client(broker, path)
+    second.window = window
+    for i in range(MESSAGES // 2, MESSAGES):
+        second.publish_nowait(TOPIC, str(i), qos=2)
+    second.flush()
+    ok = exactly_once(broker, MESSAGES) and not second.inflight
+    report("reboot ({} unfinished)".format(unfinished), broker, time.perf_counter() - start, ok)
+    second.disconnect()
+    broker.close()
+
+
+def inbound():
+    broker = Broker()
+    received = []
+    c = client(broker)
+    c.set_callback(lambda topic, msg: received.append(msg))
+    c.subscribe(TOPIC)
+    broker.publish(TOPIC, "reading", qos=2, pid=7)
+    broker.publish(TOPIC, "reading", qos=2, pid=7, dup=True)
+    deadline = time.perf_counter() + 1
+    while time.perf_counter() < deadline:
+        c.check_msg()
+        time.sleep(0.01)
+    ok = received == [b"reading"] and not c.rcv_pids
+    print("{:<30} {:>10} {:>12}".format("inbound sent twice", "", "yes" if ok else "NO"))
+    c.disconnect()
+    broker.close()
+
+
+print("round trip {:.0f} ms, {} publishes".format(LATENCY * 1000, MESSAGES))
+print("{:<30} {:>10} {:>12} {:>12}".format("", "msgs/s", "exactly once", "resent(DUP)"))
+throughput("publish(qos=2)", None)
+for window in (4, 8, 16):
+    throughput("window {}".format(window), window)
+throughput("window 8, 10% acks lost", 8, 0.1)
+reboot()
+inbound()
@@ -0,0 +1,50 @@
+# Measures how long a package waits between arriving at the radio and being
+# returned by loraAPI.receive(), with the 0.1 s polling loop and with listen().
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import network
+from lora_api import loraAPI
+
+PACKAGES = 40
+
+
+def run(listen):
+    gateway = loraAPI(device_name="Gateway", is_gateway=True)
+    if listen:
+        gateway.listen()
+
+    arrived = {}
+
+    def radio():
+        for i in range(PACKAGES):
+            time.sleep(random.uniform(0.02, 0.25))
+            message = str(i).encode()
+            arrived[message] = time.perf_counter()
+            gateway.sock.inject(bytes([1, len(message)]) + message)
+
+    threading.Thread(target=radio, daemon=True).start()
+
+    latencies = []
+    while len(latencies) < PACKAGES:
+        device_id, message = gateway.receive()
+        if message is not None:
+            latencies.append((time.perf_counter() - arrived[message]) * 1000)
+
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], latencies[-1]
+
+
+stdout = sys.stdout
+sys.stdout = open(os.devnull, "w")
+results = [("poll (sleep 0.1 s)", run(False)), ("listen() callback", run(True))]
+sys.stdout = stdout
+
+print("{:<20} {:>8} {:>8} {:>8}".format("receive mode", "p50 ms", "p99 ms", "max ms"))
+for label, (p50, p99, worst) in results:
+    print("{:<20} {:>8.2f} {:>8.2f} {:>8.2f}".format(label, p50, p99, worst))
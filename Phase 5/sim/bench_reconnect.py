@@ -0,0 +1,154 @@
+# Fault injection for MQTTSupervisor (gateway/lib/umqtt_async.py).
+#
+# A publisher task sends a QoS 1 message every INTERVAL seconds while a
+# stand-in for the LoRa loop wakes every 5 ms, and the broker stand-in
+# fails part way through:
+#   closes       the broker closes the connection
+#   restarts     the broker closes the connection and refuses new ones
+#                for FAULT seconds
+#   goes silent  the broker stops answering without closing anything, so
+#                only the missing PINGRESP shows the connection is dead
+# For each it reports how long the supervisor took to notice, how long it
+# was disconnected, whether every message arrived, whether the control
+# feed still reaches the callback afterwards (re-subscribed, or kept by
+# the broker's session with clean_session=False) and the longest the
+# LoRa loop was kept waiting.
+import os
+import sys
+import time
+import asyncio
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+import machine      # adds time.ticks_ms() and friends
+from broker import Broker
+from umqtt import MQTTClient
+from umqtt_async import MQTTSupervisor
+
+MESSAGES = 150
+INTERVAL = 0.02     # seconds between publishes
+FAULT_AT = 1.0      # seconds after starting
+FAULT = 2.0         # seconds the broker is down or silent
+PING_INTERVAL = 500     # ms
+PING_TIMEOUT = 500      # ms
+TOPIC = "CoreChris/feeds/temp"
+CONTROL = "CoreChris/feeds/control"
+
+
+class Faults:
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def closes(self):
+        self.broker.drop_clients()
+
+    def restarts(self):
+        self.broker.refuse = True
+        self.broker.drop_clients()
+
+    def silent(self):
+        self.broker.silent = True
+
+    def clear(self):
+        self.broker.refuse = False
+        self.broker.silent = False
+
+
+async def lora_loop(stats):
+    last = time.perf_counter()
+    while True:
+        await asyncio.sleep(0.005)
+        now = time.perf_counter()
+        stats["max_gap"] = max(stats["max_gap"], now - last)
+        last = now
+
+
+# Like publish_task() in gateway.py: a message that couldn't be sent is
+# tried again
+async def publisher(aio):
+    i = 0
+    while i < MESSAGES:
+        try:
+            await aio.publish(TOPIC, str(i), qos=1)
+            i += 1
+        except OSError:
+            pass
+        await asyncio.sleep(INTERVAL)
+
+
+async def watch(aio, stats, start):
+    was = False
+    while True:
+        if aio.connected != was:
+            was = aio.connected
+            stats["changes"].append((time.perf_counter() - start, was))
+        await asyncio.sleep(0.001)
+
+
+async def scenario(name, fault, clean_session=True):
+    broker = Broker()
+    faults = Faults(broker)
+    received = []
+    client = MQTTClient(b"gateway", "127.0.0.1", broker.port)
+    client.retransmit_ms = 300
+    client.set_callback(lambda topic, msg: received.append(msg))
+    aio = MQTTSupervisor(client, clean_session, PING_INTERVAL, PING_TIMEOUT)
+    aio.CONNECT_TIMEOUT = 500
+    aio.BACKOFF_MIN = 100
+    aio.BACKOFF_MAX = 1600
+    await aio.subscribe(CONTROL)
+
+    stats = {"max_gap": 0.0, "changes": []}
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(t) for t in (aio.run(), lora_loop(stats), watch(aio, stats, start))]
+    sending = asyncio.create_task(publisher(aio))
+
+    await asyncio.sleep(FAULT_AT)
+    getattr(faults, fault)()
+    await asyncio.sleep(FAULT)
+    faults.clear()
+    await sending
+    deadline = time.perf_counter() + 10
+    while (not aio.connected or client.inflight) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    broker.publish(CONTROL, "1")
+    await asyncio.sleep(0.2)
+
+    for t in tasks:
+        t.cancel()
+    delivered = len(set(msg for when, topic, msg, qos in broker.published))
+    lost = [t for t, up in stats["changes"] if not up and t >= FAULT_AT]
+    back = [t for t, up in stats["changes"] if up and t >= FAULT_AT]
+    print("{:<34} {:>8} {:>8} {:>10} {:>5} {:>8} {:>8} {:8.1f}".format(
+        name,
+        "{:.0f}".format((lost[0] - FAULT_AT) * 1000) if lost else "-",
+        "{:.0f}".format((back[-1] - lost[0]) * 1000) if back and lost else "-",
+        "{}/{}".format(delivered, MESSAGES), broker.duplicates, aio.failed_connects,
+        "yes" if received == [b"1"] else "NO", stats["max_gap"] * 1000))
+    client.close()
+    broker.close()
+
+
+async def main():
+    print("{} QoS 1 messages every {:.0f} ms, fault at {:.0f} ms lasting {:.0f} ms, ping after {} ms idle".format(
+        MESSAGES, INTERVAL * 1000, FAULT_AT * 1000, FAULT * 1000, PING_INTERVAL))
+    print("{:<34} {:>8} {:>8} {:>10} {:>5} {:>8} {:>8} {:>8}".format(
+        "", "noticed", "down", "delivered", "DUP", "failed", "control", "LoRa gap"))
+    print("{:<34} {:>8} {:>8} {:>10} {:>5} {:>8} {:>8} {:>8}".format(
+        "fault", "ms", "ms", "", "", "connects", "feed", "max ms"))
+    await scenario("broker closes the connection", "closes")
+    await scenario("broker restarts", "restarts")
+    await scenario("broker goes silent", "silent")
+    await scenario("broker goes silent, kept session", "silent", clean_session=False)
+
+    aio = MQTTSupervisor(MQTTClient(b"gateway", "127.0.0.1"))
+    print()
+    print("Waits between connection attempts with the default settings (ms):")
+    for attempt in range(8):
+        print("  attempt {}: {}".format(attempt + 1, ", ".join(str(aio._backoff(attempt)) for i in range(5))))
+
+
+asyncio.run(main())
@@ -0,0 +1,295 @@
+# Report by exception (node1/lib/report_policy.py) over sensor traces.
+#
+# For each trace, runs reportPolicy over every reading (one each
+# SAMPLE_INTERVAL) with a few deadbands, and reports how many readings it
+# sends, how many fewer than sending every one (the reduction ratio), the
+# time on air, and the reconstruction error: the difference between each
+# reading and what the gateway is showing at the time (the last one sent).
+# Summaries of SAMPLES_PER_UPLINK readings (what node1 does without
+# REPORT_BY_EXCEPTION) are there to compare. Then counts the limit alarms
+# sent for a value cycling around its limit, with and without hysteresis.
+#
+# The traces are made up: a room with the heating on in the day, a
+# greenhouse, and a cold room with its compressor cycling and the door
+# opened now and then, rounded like the SI7006A20 rounds. Give a CSV file
+# of real readings (a header row with "temperature" and/or "humidity"
+# columns, or Adafruit IO's feed download with a "value" column, taken as
+# temperature) to run it over those instead, one reading per row:
+#
+#   python bench_report.py readings.csv
+#
+# Last, node1.py is run on a simulated board with REPORT_BY_EXCEPTION on,
+# reading the cold room trace (a minute of it each wake), with the gateway
+# sending it new thresholds over LoRa part way through: it checks they
+# arrive, are acknowledged and are kept over deep sleep, and counts the
+# wakes that used the radio.
+import os
+import sys
+import csv
+import json
+import math
+import time
+import random
+import shutil
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+from lora_airtime import time_on_air
+from report_policy import reportPolicy
+
+SAMPLE_INTERVAL = 10        # seconds, as in node1.py
+SAMPLES_PER_UPLINK = 6      # as in node1.py
+DAYS = 2
+HEARTBEAT = 1800            # seconds
+# Deadbands tried: (temperature, humidity)
+DELTAS = ((0.1, 0.5), (0.25, 2.0), (0.5, 3.0), (1.0, 5.0))
+# Bytes on the air, each acknowledged: packed submits and summaries with the
+# package header and RELIABLE_DATA header, and the acknowledgement
+READING_BYTES = 2 + 2 + 6
+SUMMARY_BYTES = 2 + 2 + 19
+ACK_BYTES = 2 + 3
+
+# For the end to end run
+NODE1 = os.path.join(HERE, "..", "node1", "node1.py")
+WAKES = 60
+TRACE_STEP = 6              # readings of the trace per wake, so it covers an hour
+THRESHOLDS_AT = 10          # the gateway gets new thresholds after this wake
+SLEEP_SCALE = 0.02
+
+
+def sensor(temperature, humidity, rng):
+    # SI7006A20 noise and the size of its steps
+    temperature += rng.gauss(0, 0.02)
+    humidity += rng.gauss(0, 0.2)
+    return round(temperature / 0.01) * 0.01, round(max(0.0, min(100.0, humidity)) / 0.03) * 0.03
+
+
+# Heating on from 7:00 to 18:00, off overnight, people in the day
+def room(rng):
+    readings = []
+    temperature = 17.0
+    for i in range(DAYS * 86400 // SAMPLE_INTERVAL):
+        hour = (i * SAMPLE_INTERVAL / 3600.0) % 24
+        heating = 7 <= hour < 18
+        target = 21.5 if heating else 16.0
+        temperature += (target - temperature) * SAMPLE_INTERVAL / 3600.0
+        people = 0.4 if 9 <= hour < 17 else 0.0
+        humidity = 62.0 - 1.8 * (temperature - 16.0) + people * 5
+        readings.append(sensor(temperature + people, humidity, rng))
+    return readings
+
+
+# Sun in the day, clouds passing, cold at night
+def greenhouse(rng):
+    readings = []
+    clouds = 0.0
+    for i in range(DAYS * 86400 // SAMPLE_INTERVAL):
+        hour = (i * SAMPLE_INTERVAL / 3600.0) % 24
+        clouds = max(0.0, min(1.0, clouds + rng.gauss(0, 0.01)))
+        sun = max(0.0, math.sin((hour - 6) / 12.0 * math.pi))
+        temperature = 11.0 + 16.0 * sun * (1.0 - 0.6 * clouds)
+        humidity = 92.0 - 2.2 * (temperature - 11.0)
+        readings.append(sensor(temperature, humidity, rng))
+    return readings
+
+
+# Compressor on below 5 C until 3 C, now and then the door is left open
+def cold_room(rng):
+    readings = []
+    temperature = 4.0
+    cooling = False
+    for i in range(DAYS * 86400 // SAMPLE_INTERVAL):
+        if temperature > 5.0:
+            cooling = True
+        elif temperature < 3.0:
+            cooling = False
+        temperature += (-0.05 if cooling else 0.02) * SAMPLE_INTERVAL / 60.0
+        if rng.random() < 0.0005:
+            temperature += rng.uniform(1.0, 3.0)
+        humidity = 85.0 - 3.0 * (temperature - 4.0)
+        readings.append(sensor(temperature, humidity, rng))
+    return readings
+
+
+# Readings from a CSV file, see the top of this file
+def load_csv(path):
+    readings = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            temperature = row.get("temperature", row.get("value"))
+            humidity = row.get("humidity")
+            readings.append((float(temperature) if temperature else None, float(humidity) if humidity else None))
+    return readings
+
+
+# Root mean square and largest of the differences between each reading and
+# the value the gateway was showing for it
+def errors(readings, shown, index):
+    squares = 0.0
+    largest = 0.0
+    n = 0
+    for reading, value in zip(readings, shown):
+        if reading[index] is None or value is None or value[index] is None:
+            continue
+        difference = abs(reading[index] - value[index])
+        squares += difference * difference
+        largest = max(largest, difference)
+        n += 1
+    return math.sqrt(squares / n) if n else 0.0, largest
+
+
+def by_exception(readings, delta_temperature, delta_humidity):
+    policy = reportPolicy({"temperature": {"delta": delta_temperature}, "humidity": {"delta": delta_humidity}}, HEARTBEAT)
+    shown = []
+    value = None
+    sent = 0
+    heartbeats = 0
+    for i, (temperature, humidity) in enumerate(readings):
+        now = i * SAMPLE_INTERVAL
+        values = {"temperature": temperature, "humidity": humidity}
+        reason = policy.check(now, values)
+        if reason is not None:
+            policy.reported(now, values)
+            value = (temperature, humidity)
+            sent += 1
+            heartbeats += reason == "heartbeat"
+        shown.append(value)
+    return sent, heartbeats, shown
+
+
+# The gateway shows the mean of the last SAMPLES_PER_UPLINK readings
+def summaries(readings):
+    shown = []
+    value = None
+    sent = 0
+    for i in range(len(readings)):
+        if (i + 1) % SAMPLES_PER_UPLINK == 0:
+            window = readings[i + 1 - SAMPLES_PER_UPLINK:i + 1]
+            value = tuple([mean([reading[j] for reading in window]) for j in (0, 1)])
+            sent += 1
+        shown.append(value)
+    return sent, shown
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def air_per_day(sent, days, package_bytes):
+    return sent / days * (time_on_air(package_bytes) + time_on_air(ACK_BYTES)) / 1000
+
+
+def report(name, readings):
+    days = len(readings) * SAMPLE_INTERVAL / 86400.0
+    print("{}: {} readings, one every {} s ({:.1f} days)".format(name, len(readings), SAMPLE_INTERVAL, days))
+    print("  {:<22} {:>8} {:>7} {:>9} {:>15} {:>15}".format(
+        "", "sent/day", "fewer", "air s/day", "temp rms/max C", "humi rms/max %"))
+    rows = [("every reading", len(readings), readings, READING_BYTES, "")]
+    sent, shown = summaries(readings)
+    rows.append(("summary of {}".format(SAMPLES_PER_UPLINK), sent, shown, SUMMARY_BYTES, ""))
+    for delta_temperature, delta_humidity in DELTAS:
+        sent, heartbeats, shown = by_exception(readings, delta_temperature, delta_humidity)
+        rows.append(("deadband {} C, {} %".format(delta_temperature, delta_humidity), sent, shown, READING_BYTES,
+                     "  {} heartbeats".format(heartbeats)))
+    for label, sent, shown, package_bytes, note in rows:
+        temperature = errors(readings, shown, 0)
+        humidity = errors(readings, shown, 1)
+        print("  {:<22} {:>8.0f} {:>6.1f}x {:>9.1f} {:>7.3f}/{:<7.2f} {:>7.3f}/{:<7.2f}{}".format(
+            label, sent / days, len(readings) / max(1, sent), air_per_day(sent, days, package_bytes),
+            temperature[0], temperature[1], humidity[0], humidity[1], note))
+    print()
+
+
+# Limit alarms sent for the cold room cycling up to its 5 C thermostat
+def hysteresis(readings):
+    print("cold room, high limit 5.0 C: alarm changes sent (\"temperature high\" and back to normal)")
+    for amount in (0, 0.1, 0.3):
+        policy = reportPolicy({"temperature": {"delta": 1.0, "high": 5.0, "hysteresis": amount}}, HEARTBEAT)
+        changes = 0
+        sent = 0
+        for i, (temperature, humidity) in enumerate(readings):
+            reason = policy.check(i * SAMPLE_INTERVAL, {"temperature": temperature})
+            if reason is not None:
+                before = policy.alarms.get("temperature")
+                policy.reported(i * SAMPLE_INTERVAL, {"temperature": temperature})
+                changes += policy.alarms.get("temperature") != before
+                sent += 1
+        print("  hysteresis {:<4} C: {:>5} alarm changes, {:>5} readings sent".format(amount, changes, sent))
+    print()
+
+
+# node1.py on a simulated board, see the top of this file
+def end_to_end(readings):
+    import board
+    import devices
+    import lorasim
+    from lora_api import loraAPI
+
+    folder = tempfile.mkdtemp()
+    with open(NODE1) as f:
+        source = f.read()
+    script = os.path.join(folder, "node1.py")
+    with open(script, "w") as f:
+        f.write(source.replace("REPORT_BY_EXCEPTION = False", "REPORT_BY_EXCEPTION = True"))
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    channel = lorasim.Channel()
+    gateway_board = board.Board("gateway", (0.0, 0.0), channel)
+    gateway_board.activate()
+    gateway = loraAPI(device_name="Gateway", is_gateway=True)
+    received = []
+    gateway.listen(lambda device_id, message: received.append(message))
+    gateway.hold_for(1)
+
+    node = board.Board("node1", (30.0, 0.0), channel, devices.pysense_devices(
+        temperature=lambda: readings[node.wakes * TRACE_STEP % len(readings)][0],
+        humidity=lambda: readings[node.wakes * TRACE_STEP % len(readings)][1]))
+    node.sleep_scale = SLEEP_SCALE
+    thresholds = {"temperature": {"delta": 0.5, "high": 6.0, "hysteresis": 0.3}, "heartbeat": 600}
+    node.start(script)
+    sent = False
+    while node.wakes < WAKES:
+        if not sent and node.wakes >= THRESHOLDS_AT:
+            gateway_board.activate()
+            gateway.send_as_json({"thresholds": thresholds}, 1, reliable=True, queue=True)
+            sent = True
+        # Acknowledges node1 and passes its readings on
+        gateway.service()
+        time.sleep(0.01)
+    sys.stdout = stdout
+
+    with open(os.path.join(node.flash, "node_state.json")) as f:
+        saved = json.loads(f.read())
+    radio_wakes = saved["wakes"]
+    print("node1.py with REPORT_BY_EXCEPTION over {} wakes, {} minutes of the cold room trace:".format(
+        WAKES, WAKES * TRACE_STEP * SAMPLE_INTERVAL // 60))
+    print("  wakes that used the radio: {} ({} readings sent, {:.1f}x fewer)".format(
+        radio_wakes, len(received), WAKES / max(1, len(received))))
+    kept = saved.get("report", {})
+    print("  thresholds sent after wake {}: acknowledged {}, kept over deep sleep {}".format(
+        THRESHOLDS_AT, gateway.unacknowledged(1) == 0,
+        kept.get("thresholds", {}).get("temperature") == thresholds["temperature"] and kept.get("heartbeat") == thresholds["heartbeat"]))
+    board.erase_flash(node)
+    shutil.rmtree(folder)
+
+
+def main():
+    rng = random.Random(1)
+    if len(sys.argv) > 1:
+        report(os.path.basename(sys.argv[1]), load_csv(sys.argv[1]))
+        return
+    cold = cold_room(rng)
+    report("room", room(rng))
+    report("greenhouse", greenhouse(rng))
+    report("cold room", cold)
+    hysteresis(cold)
+    end_to_end(cold)
+
+
+main()
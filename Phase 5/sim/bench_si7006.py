@@ -0,0 +1,154 @@
+# SI7006A20 temperature and humidity readings on the simulated Pysense.
+#
+# The sensor model (devices.py) NACKs reads until its conversion has
+# finished, taking CONVERSION seconds. For each conversion time this
+# compares the old driver (command, sleep 0.5 s, read) with measure(),
+# which waits the typical conversion time and then polls with a short
+# backoff: time per reading and I2C reads per reading. Then runs
+# readings with humidity_async() next to another task that wakes every
+# millisecond, to show that task isn't held up. Last, the reading node1
+# sends, with the sensor's own conversion times: temperature() then
+# humid_ambient(temperature) as it was (a temperature conversion, then
+# dew_point() doing two more) against temp_humid(), one humidity
+# conversion plus the temperature from it.
+import os
+import sys
+import time
+import asyncio
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+import board
+import devices
+from machine import I2C
+from i2c_bus import I2CBus
+from SI7006A20 import SI7006A20
+
+CONVERSIONS = (0.005, 0.010, 0.020, 0.040)     # seconds
+READINGS = 20
+OLD_READINGS = 2
+
+
+class FakePysense:
+
+    def __init__(self, conversion):
+        self.sensor = devices.SI7006A20()
+        self.sensor.RH_CONVERSION = conversion
+        self.sensor.TEMP_CONVERSION = conversion
+        board.Board("node1", devices={0x40: self.sensor}).activate()
+        self.i2c = I2C(0)
+        self.bus = I2CBus(self.i2c)
+
+
+# SI7006A20.temperature() and humidity() before measure(), for comparison
+def old_temperature(si):
+    si.i2c.writeto(0x40, bytearray([0xF3]))
+    time.sleep(0.5)
+    data = si.i2c.readfrom(0x40, 3)
+    return ((175.72 * si._getWord(data[0], data[1])) / 65536.0) - 46.85
+
+
+def old_humidity(si):
+    si.i2c.writeto(0x40, bytearray([0xF5]))
+    time.sleep(0.5)
+    data = si.i2c.readfrom(0x40, 2)
+    return ((125.0 * si._getWord(data[0], data[1])) / 65536.0) - 6.0
+
+
+def timed(read, si, n):
+    reads = len([t for t in si.i2c.transactions if t[0] == "read"])
+    start = time.perf_counter()
+    for i in range(n):
+        read()
+    elapsed = (time.perf_counter() - start) / n
+    return elapsed * 1000, (len([t for t in si.i2c.transactions if t[0] == "read"]) - reads) / n
+
+
+def blocking():
+    print("{:>10} {:<22} {:>12} {:>12}".format("conversion", "", "ms", "I2C reads"))
+    for conversion in CONVERSIONS:
+        si = SI7006A20(FakePysense(conversion))
+        rows = (
+            ("old temperature()", lambda: old_temperature(si), OLD_READINGS),
+            ("old humidity()", lambda: old_humidity(si), OLD_READINGS),
+            ("temperature()", si.temperature, READINGS),
+            ("humidity()", si.humidity, READINGS),
+        )
+        for name, read, n in rows:
+            ms, reads = timed(read, si, n)
+            print("{:>8.0f}ms {:<22} {:12.1f} {:12.1f}".format(conversion * 1000, name, ms, reads))
+    # A sensor that never finishes: measure() gives up
+    si = SI7006A20(FakePysense(1.0))
+    start = time.perf_counter()
+    try:
+        si.humidity()
+        result = "no error"
+    except OSError:
+        result = "OSError"
+    print("{:>10} {:<22} {:12.1f} {:>12}".format("stuck", "humidity()", (time.perf_counter() - start) * 1000, result))
+
+
+# node1.send_measurements() before temp_humid(), for comparison
+def old_reading(si):
+    temperature = si.temperature()
+    temp = si.temperature()
+    humid = si.humidity()
+    return temperature, si.humid_ambient(temperature, si.dew_point(temp, humid))
+
+
+def node1_reading():
+    sensor = devices.SI7006A20()
+    print("{:<22} {:>12} {:>12} {:>12} {:>12}".format("node1 reading", "ms", "conversions", "I2C", "bytes"))
+    for name, read in (("old (3 conversions)", old_reading), ("temp_humid()", lambda si: si.temp_humid()[::3])):
+        pysense = FakePysense(sensor.RH_CONVERSION)
+        pysense.sensor.TEMP_CONVERSION = sensor.TEMP_CONVERSION
+        si = SI7006A20(pysense)
+        start = time.perf_counter()
+        for i in range(READINGS):
+            temperature, humidity = read(si)
+        elapsed = (time.perf_counter() - start) / READINGS
+        transactions = si.i2c.transactions
+        print("{:<22} {:12.1f} {:12.1f} {:12.1f} {:12.1f}".format(
+            name, elapsed * 1000, pysense.sensor.conversions / READINGS, len(transactions) / READINGS,
+            sum(t[2] for t in transactions) / READINGS))
+    print("last: {:.2f} C, {:.2f} %RH".format(temperature, humidity))
+
+
+async def ticker(stats):
+    last = time.perf_counter()
+    while stats["running"]:
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        stats["max_gap"] = max(stats["max_gap"], now - last)
+        stats["ticks"] += 1
+        last = now
+
+
+async def concurrent(conversion):
+    si = SI7006A20(FakePysense(conversion))
+    stats = {"running": True, "max_gap": 0.0, "ticks": 0}
+    task = asyncio.create_task(ticker(stats))
+    start = time.perf_counter()
+    for i in range(READINGS):
+        await si.humidity_async()
+    elapsed = (time.perf_counter() - start) / READINGS
+    stats["running"] = False
+    await task
+    print("{:>8.0f}ms {:<22} {:12.1f} {:>12} {:12.1f}".format(
+        conversion * 1000, "humidity_async()", elapsed * 1000, stats["ticks"], stats["max_gap"] * 1000))
+
+
+async def asynchronous():
+    print("{:>10} {:<22} {:>12} {:>12} {:>12}".format("conversion", "", "ms", "other task", "longest"))
+    print("{:>10} {:<22} {:>12} {:>12} {:>12}".format("", "", "", "ran", "wait ms"))
+    for conversion in CONVERSIONS:
+        await concurrent(conversion)
+
+
+blocking()
+print()
+asyncio.run(asynchronous())
+print()
+node1_reading()
@@ -0,0 +1,121 @@
+# The gateway's store-and-forward queue (gateway/lib/store_forward.py)
+# through an Adafruit IO outage.
+#
+# Readings arrive every INTERVAL seconds of simulated time. Publishing
+# fails for OUTAGE seconds, then works again at DRAIN_RATE readings per
+# second in batches like publish_task() in gateway.py. For each eviction
+# policy it reports the deepest the queue got, how many readings went to
+# the flash log, how many were lost, the largest the log file got, the
+# drain rate the queue measured and whether what arrived was in order. A log file in a temporary folder
+# stands in for flash. Then checks the log survives a reboot and times
+# put() with and without spilling.
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+import machine      # adds time.ticks_ms() and friends
+import store_forward
+from store_forward import storeForward
+
+INTERVAL = 10       # seconds between readings (temperature and humidity)
+OUTAGE = 6 * 3600   # seconds
+AFTER = 3600        # seconds of normal running after the outage
+DRAIN_RATE = 2      # readings per second when publishing works
+BATCH = 8
+RAM_SIZE = 32
+LOG_SIZE = 1000
+
+
+# Simulated clock for the queue's drain rate
+class Clock:
+    now = 0.0
+
+
+time.ticks_ms = lambda: int(Clock.now * 1000)
+
+
+def run(policy, log_size=LOG_SIZE, use_log=True):
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "aio_queue.log") if use_log else None
+    queue = storeForward(RAM_SIZE, path, log_size, policy)
+    published = []
+    deepest = 0
+    largest = 0
+    Clock.now = 0.0
+    next_reading = 0.0
+    reading = 0
+    while Clock.now < OUTAGE + AFTER:
+        if Clock.now >= next_reading:
+            queue.put("CoreChris/feeds/temp", reading)
+            queue.put("CoreChris/feeds/humi", reading)
+            reading += 1
+            next_reading += INTERVAL
+        deepest = max(deepest, queue.depth())
+        if path and os.path.exists(path):
+            largest = max(largest, os.path.getsize(path))
+        if Clock.now >= OUTAGE and queue.depth():
+            batch = queue.peek(BATCH)
+            published.extend(value for seq, feed, value in batch)
+            queue.commit(batch[-1][0])
+            Clock.now += len(batch) / DRAIN_RATE
+        else:
+            Clock.now += 1
+    m = queue.metrics()
+    values = [int(v) for v in published]
+    in_order = all(a <= b for a, b in zip(values, values[1:]))
+    print("{:<12} {:>5} {:7} {:8} {:8} {:8} {:>8} {:9.1f} {:>8}".format(
+        policy, "flash" if use_log else "RAM", m["enqueued"], deepest, m["spilled"], m["dropped"],
+        "{:.1f}".format(largest / 1024) if use_log else "-", m["drain_rate"], "yes" if in_order else "NO"))
+    shutil.rmtree(folder)
+
+
+# Readings in the log are still there after a reboot, and ones already
+# sent aren't sent again
+def reboot():
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "aio_queue.log")
+    queue = storeForward(RAM_SIZE, path, LOG_SIZE)
+    for i in range(100):
+        queue.put("CoreChris/feeds/temp", i)
+    queue.commit(queue.peek(BATCH)[-1][0])
+    # Power goes off: what was only in RAM is lost
+    queue = storeForward(RAM_SIZE, path, LOG_SIZE)
+    values = []
+    while queue.depth():
+        batch = queue.peek(BATCH)
+        values.extend(int(value) for seq, feed, value in batch)
+        queue.commit(batch[-1][0])
+    ok = values == list(range(BATCH, 100 - RAM_SIZE)) and not os.path.exists(path)
+    print("reboot: {} readings from the log, {} lost from RAM, in order: {}".format(
+        len(values), RAM_SIZE, "yes" if ok else "NO"))
+    shutil.rmtree(folder)
+
+
+def time_puts(use_log, n=2000):
+    folder = tempfile.mkdtemp()
+    queue = storeForward(RAM_SIZE, os.path.join(folder, "q.log") if use_log else None, n)
+    start = time.perf_counter()
+    for i in range(n):
+        queue.put("CoreChris/feeds/temp", i)
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(folder)
+    return elapsed * 1e6 / n
+
+
+print("{} h outage, a reading every {} s, RAM {} + flash log {} readings".format(
+    OUTAGE // 3600, INTERVAL, RAM_SIZE, LOG_SIZE))
+print("{:<12} {:>5} {:>7} {:>8} {:>8} {:>8} {:>8} {:>9} {:>8}".format(
+    "policy", "store", "queued", "deepest", "spilled", "dropped", "log KB", "drain/s", "in order"))
+run(store_forward.DROP_OLDEST, use_log=False)
+for policy in (store_forward.DROP_OLDEST, store_forward.DROP_NEWEST, store_forward.DOWNSAMPLE):
+    run(policy)
+run(store_forward.DROP_OLDEST, log_size=5000)
+print()
+reboot()
+print("put(): {:.1f} us in RAM, {:.1f} us when spilling to the log".format(time_puts(False), time_puts(True)))
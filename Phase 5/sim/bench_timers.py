@@ -0,0 +1,207 @@
+# timerWheel (api/timer_wheel.py) and the MQTT keepalive built on it.
+#
+# 1. Deadlines like LoRa retransmit timeouts: TIMERS timers due 1 to 30 s
+#    ahead, most cancelled (acknowledged) or pushed back before they're
+#    due, checked every 5 ms like the MQTT tasks poll. Compares the wheel with
+#    going through every deadline on each check, as loraAPI.service()
+#    does, in simulated time. Also checks no timer fired early or more
+#    than one resolution late.
+# 2. MQTTSupervisor keepalive against the broker stand-in, with a
+#    keepalive of KEEPALIVE seconds and the timers run by a shared task
+#    like timer_task() in gateway.py: PINGREQs sent, connections the
+#    broker closed for silence, connections the gateway gave up on, and
+#    how quickly a silent broker is noticed.
+import os
+import sys
+import time
+import random
+import asyncio
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "gateway", "lib"))
+
+import machine      # adds time.ticks_ms() and friends
+from broker import Broker
+from umqtt import MQTTClient
+from umqtt_async import MQTTClientAsync, MQTTSupervisor
+from timer_wheel import timerWheel
+
+TIMERS = (100, 1000, 10000)
+SIMULATED = 60      # seconds
+POLL = 5            # ms between checks
+RESOLUTION = 100    # ms
+KEEPALIVE = 2       # seconds
+PING_TIMEOUT = 500  # ms
+RUN = 6             # seconds per keepalive scenario
+
+
+class Clock:
+    now = 0
+
+
+real_ticks_ms = time.ticks_ms
+
+
+# The same deadlines for both: (due, what happens first, when)
+def workload(n, seed=1):
+    rng = random.Random(seed)
+    jobs = []
+    for i in range(n):
+        due = rng.randint(1000, 30000)
+        fate = rng.random()
+        if fate < 0.6:
+            jobs.append((due, "cancel", rng.randint(0, due - 1)))
+        elif fate < 0.8:
+            jobs.append((due, "restart", rng.randint(0, due - 1)))
+        else:
+            jobs.append((due, "fire", None))
+    return jobs
+
+
+def events(jobs):
+    start = {}
+    for i, (due, fate, when) in enumerate(jobs):
+        if when is not None:
+            start.setdefault(when - when % POLL, []).append(i)
+    return start
+
+
+def run_wheel(jobs):
+    Clock.now = 0
+    wheel = timerWheel(resolution=RESOLUTION)
+    fired = {}
+    expected = {}
+    timers = []
+    for i, (due, fate, when) in enumerate(jobs):
+        timers.append(wheel.add(due, lambda i=i: fired.__setitem__(i, Clock.now)))
+        expected[i] = due
+    todo = events(jobs)
+    begin = time.perf_counter()
+    for now in range(0, SIMULATED * 1000, POLL):
+        Clock.now = now
+        for i in todo.get(now, ()):
+            if jobs[i][1] == "cancel":
+                wheel.cancel(timers[i])
+                del expected[i]
+            else:
+                wheel.restart(timers[i], jobs[i][0])
+                expected[i] = now + jobs[i][0]
+        wheel.run()
+    elapsed = time.perf_counter() - begin
+    late = [fired[i] - expected[i] for i in expected if i in fired]
+    missed = len([i for i in expected if i not in fired and expected[i] < SIMULATED * 1000 - RESOLUTION])
+    return elapsed, len(fired), min(late), max(late), missed
+
+
+# Every deadline looked at on every check, like loraAPI.service()
+def run_scan(jobs):
+    Clock.now = 0
+    waiting = dict((i, due) for i, (due, fate, when) in enumerate(jobs))
+    fired = 0
+    todo = events(jobs)
+    begin = time.perf_counter()
+    for now in range(0, SIMULATED * 1000, POLL):
+        Clock.now = now
+        for i in todo.get(now, ()):
+            if jobs[i][1] == "cancel":
+                waiting.pop(i, None)
+            elif i in waiting:
+                waiting[i] = now + jobs[i][0]
+        for i, due in list(waiting.items()):
+            if time.ticks_diff(now, due) >= 0:
+                del waiting[i]
+                fired += 1
+    return time.perf_counter() - begin, fired
+
+
+def deadlines():
+    time.ticks_ms = lambda: Clock.now
+    print("{} s simulated, checked every {} ms, wheel resolution {} ms".format(SIMULATED, POLL, RESOLUTION))
+    print("{:>7} {:>12} {:>12} {:>8} {:>12} {:>8}".format("timers", "scan ms", "wheel ms", "fired", "late ms", "missed"))
+    for n in TIMERS:
+        jobs = workload(n)
+        scan, scan_fired = run_scan(jobs)
+        wheel, fired, early, late, missed = run_wheel(jobs)
+        assert fired == scan_fired
+        print("{:7} {:12.1f} {:12.1f} {:8} {:>12} {:8}".format(
+            n, scan * 1000, wheel * 1000, fired, "{} to {}".format(early, late), missed))
+    time.ticks_ms = real_ticks_ms
+
+
+async def timer_task(timers):
+    while True:
+        timers.run()
+        await asyncio.sleep(0.05)
+
+
+async def keepalive(name, supervised=True, traffic=None, silent_at=None):
+    broker = Broker()
+    client = MQTTClient(b"gateway", "127.0.0.1", broker.port, keepalive=KEEPALIVE)
+    client.set_callback(lambda topic, msg: None)
+    timers = timerWheel(resolution=50)
+    tasks = []
+    if supervised:
+        aio = MQTTSupervisor(client, ping_timeout=PING_TIMEOUT, timers=timers)
+        aio.CONNECT_TIMEOUT = 500
+        tasks.append(asyncio.create_task(aio.run()))
+    else:
+        # Connected but nothing sends PINGREQs
+        aio = MQTTClientAsync(client)
+        await aio.connect()
+        aio.connected = True
+
+        async def receive():
+            try:
+                while True:
+                    await aio.wait_msg()
+            except OSError:
+                aio.connected = False
+        tasks.append(asyncio.create_task(receive()))
+    await aio.subscribe("CoreChris/feeds/control")
+    tasks.append(asyncio.create_task(timer_task(timers)))
+
+    start = time.perf_counter()
+    noticed = None
+    sent = 0
+    while time.perf_counter() - start < RUN:
+        if silent_at is not None and time.perf_counter() - start >= silent_at:
+            broker.silent = True
+            silent_at = None
+            silenced = time.perf_counter()
+        if broker.silent and noticed is None and not aio.connected:
+            noticed = time.perf_counter() - silenced
+        if traffic == "publish" and aio.connected:
+            try:
+                await aio.publish("CoreChris/feeds/temp", str(sent), qos=1)
+                sent += 1
+            except OSError:
+                pass
+        elif traffic == "receive":
+            broker.publish("CoreChris/feeds/control", "0")
+        await asyncio.sleep(0.2)
+
+    for t in tasks:
+        t.cancel()
+    print("{:<40} {:6} {:8} {:>9} {:>9}".format(
+        name, aio.pings if supervised else broker.pings, broker.expired,
+        aio.lost if supervised else int(not aio.connected),
+        "{:.0f}".format(noticed * 1000) if noticed is not None else "-"))
+    client.close()
+    broker.close()
+
+
+async def keepalives():
+    print("keepalive {} s (PINGREQ after {} ms idle), {} s each".format(KEEPALIVE, KEEPALIVE * 500, RUN))
+    print("{:<40} {:>6} {:>8} {:>9} {:>9}".format("", "pings", "broker", "lost", "noticed"))
+    print("{:<40} {:>6} {:>8} {:>9} {:>9}".format("", "", "expired", "", "ms"))
+    await keepalive("no pings (keepalive on, nothing pinging)", supervised=False)
+    await keepalive("idle link")
+    await keepalive("publishing every 200 ms", traffic="publish")
+    await keepalive("only receiving, every 200 ms", traffic="receive")
+    await keepalive("broker goes silent after 1 s", silent_at=1.0)
+
+
+deadlines()
+print()
+asyncio.run(keepalives())
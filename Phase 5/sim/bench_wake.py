@@ -0,0 +1,93 @@
+# Wake-to-send latency of a deep sleeping node1 on the simulated Pysense,
+# before and after caching the PIC's RTC calibration (pycoproc.py).
+#
+# Every wake starts from scratch like the real board does after deep
+# sleep: a new Pysense and SI7006A20 on the same board, whose PIC and
+# NVRAM keep their contents. Each wake reads the wake reason and the sleep
+# time left, takes a reading (ready to send), then sets up the next sleep
+# and goes to sleep. calibrate_rtc() listens to 100 RTC pulses, which
+# takes about 0.7 s, as on the real board. Before, it ran in both
+# get_sleep_remaining() and setup_sleep(). Now the saved calibration is
+# used unless it's too old or the temperature has moved; the temperature
+# jumps by TEMPERATURE_STEP part way through. The wakes here are timer
+# wakes, so get_sleep_remaining() no longer reads the time left at all.
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "node1", "lib"))
+
+import board
+import devices
+from pysense import Pysense
+from SI7006A20 import SI7006A20
+
+WAKES = 8
+STEP_AT = 5         # wake the temperature changes at
+TEMPERATURE = 20.0
+TEMPERATURE_STEP = 8.0
+SLEEP = 60          # seconds
+CLOCK_ERROR = 1.03  # how fast the simulated PIC's RTC runs
+
+
+# get_sleep_remaining() and setup_sleep() before, for comparison
+def old_get_sleep_remaining(py):
+    c3 = py.peek_memory(0x064C + 3)
+    c2 = py.peek_memory(0x064C + 2)
+    c1 = py.peek_memory(0x064C + 1)
+    try:
+        py.calibrate_rtc()
+    except Exception:
+        pass
+    py.calibrations += 1
+    return int((((c3 << 16) + (c2 << 8) + c1) / py.clk_cal_factor) + 0.5)
+
+
+def old_setup_sleep(py, time_s, temperature):
+    try:
+        py.calibrate_rtc()
+    except Exception:
+        pass
+    py.calibrations += 1
+    time_s = int((time_s * py.clk_cal_factor) + 0.5)
+    py.cmd[0:4] = bytes([0x20, time_s & 0xFF, (time_s >> 8) & 0xFF, (time_s >> 16) & 0xFF])
+    py._write(4)
+
+
+def run(name, get_sleep_remaining, setup_sleep):
+    state = {"temperature": TEMPERATURE}
+    pysense = devices.pysense_devices(lambda: state["temperature"], lambda: 50.0)
+    pysense[0x08].clock_error = CLOCK_ERROR
+    board.Board("node1", devices=pysense).activate()
+    print(name)
+    print("{:>6} {:>8} {:>12} {:>12} {:>13} {:>8}".format(
+        "wake", "temp C", "wake to", "send to", "calibrations", "factor"))
+    print("{:>6} {:>8} {:>12} {:>12} {:>13} {:>8}".format("", "", "send ms", "sleep ms", "", ""))
+    total = 0
+    for wake in range(1, WAKES + 1):
+        if wake == STEP_AT:
+            state["temperature"] += TEMPERATURE_STEP
+        start = time.perf_counter()
+        py = Pysense()
+        si = SI7006A20(py)
+        py.get_wake_reason()
+        get_sleep_remaining(py)
+        temperature, humid, dew_p, humid_ambient = si.temp_humid()
+        ready = time.perf_counter()
+        setup_sleep(py, SLEEP, temperature)
+        py.go_to_sleep()
+        asleep = time.perf_counter()
+        total += ready - start
+        print("{:6} {:8.1f} {:12.1f} {:12.1f} {:13} {:8.4f}".format(
+            wake, temperature, (ready - start) * 1000, (asleep - ready) * 1000, py.calibrations, py.clk_cal_factor))
+    print("mean wake to send: {:.1f} ms".format(total / WAKES * 1000))
+    print()
+
+
+run("before: calibrate_rtc() on every wake",
+    old_get_sleep_remaining, old_setup_sleep)
+run("cached calibration",
+    lambda py: py.get_sleep_remaining(), lambda py, time_s, temperature: py.setup_sleep(time_s, temperature))
+print("expected factor {:.4f}".format(CLOCK_ERROR * 1000 / 1024))
@@ -0,0 +1,228 @@
+# A simulated Pycom board.
+#
+# Each board runs one device script (gateway.py, node1.py, ...) in its own
+# thread. The stand-in modules (network, machine, pycom) look up the board of
+# the thread that calls them, so every script gets its own radio, I2C bus,
+# LED and unique_id even though they share one Python process.
+import os
+import ast
+import sys
+import shutil
+import builtins
+import tempfile
+import threading
+import time
+import traceback
+import importlib.machinery
+
+_local = threading.local()
+
+
+# Raised in a script's thread when the Pysense turns the board off for
+# deep sleep (Pycoproc.go_to_sleep() pulls P3 low). Not an Exception, so
+# the script's own try/except blocks don't catch it.
+class PowerOff(BaseException):
+    pass
+
+
+class Board:
+
+    def __init__(self, name="Board", position=(0.0, 0.0), channel=None, devices=None, unique_id=None):
+        self.name = name
+        # Metres, used by the channel for path loss
+        self.position = position
+        self.channel = channel
+        # I2C address: device model (see devices.py)
+        self.devices = devices if devices is not None else {}
+        self.unique_id = unique_id or name.encode()[:6].ljust(6, b"\0")
+        self.heartbeat = True
+        self.led = None
+        self.lora = None
+        self.wlan_connected = True
+        # The script's global variables while it runs
+        self.namespace = None
+        self.error = None
+        self.thread = None
+        # Folder standing in for the board's /flash, made when first used
+        self.flash = None
+        # Non-volatile storage (pycom.nvs_*), kept across deep sleep
+        self.nvs = {}
+        # Deep sleep: simulated seconds asleep are slept for sleep_scale
+        # times as long, so runs over many wakes don't take all day
+        self.sleep_scale = 1.0
+        self.wakes = 0
+        self.awake = 0.0        # seconds with the power on
+        self.asleep = 0.0       # seconds of (simulated) deep sleep
+        self.airtime = 0.0      # milliseconds transmitting
+        self.radio = 0.0        # seconds with a LoRa radio set up (receiving)
+        self.radio_since = None
+        self.running = False    # a script is running in run()
+
+    # Make this the board for the calling thread
+    def activate(self):
+        _local.board = self
+
+    # Run a device script on this board, in this thread.
+    # Its lib folder is added to the import path, like on the board.
+    def run(self, script):
+        self.activate()
+        lib = os.path.join(os.path.dirname(os.path.abspath(script)), "lib")
+        if lib not in sys.path:
+            sys.path.insert(0, lib)
+        with open(script) as source:
+            code = compile(source.read(), script, "exec")
+        # Waking from deep sleep runs the script from the top again, with
+        # only the flash, NVS and the devices' state kept
+        self.running = True
+        while True:
+            self.namespace = {"__name__": "__main__", "__file__": script}
+            powered = time.monotonic()
+            try:
+                exec(code, self.namespace)
+            except PowerOff:
+                self.awake += time.monotonic() - powered
+                self.deep_sleep()
+                continue
+            except BaseException as e:
+                self.error = e
+                traceback.print_exc()
+            self.awake += time.monotonic() - powered
+            self.running = False
+            return
+
+    # Pin('P3') going low: the PIC turns the power off if it has been told
+    # to sleep. Only for scripts run by run(), benchmarks carry on.
+    def power_off(self):
+        if self.running and self._sleeping_pic() is not None:
+            raise PowerOff()
+
+    def _sleeping_pic(self):
+        for device in self.devices.values():
+            if getattr(device, "asleep", False):
+                return device
+        return None
+
+    # Called when the script sets up a LoRa radio
+    def radio_on(self):
+        if self.radio_since is None:
+            self.radio_since = time.monotonic()
+
+    # The radio is off and the script gone until the PIC wakes the board
+    def deep_sleep(self):
+        if self.lora is not None and self.lora.channel is not None:
+            self.lora.channel.leave(self.lora)
+        self.lora = None
+        if self.radio_since is not None:
+            self.radio += time.monotonic() - self.radio_since
+            self.radio_since = None
+        pic = self._sleeping_pic()
+        seconds = pic.sleep_seconds()
+        time.sleep(seconds * self.sleep_scale)
+        self.asleep += seconds
+        self.wakes += 1
+        pic.wake()
+
+    # Run a device script on this board in a background thread
+    def start(self, script):
+        self.thread = threading.Thread(target=self.run, args=(script,), name=self.name, daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+# MicroPython's compiler replaces names given a const() value wherever they
+# are used in the file, so Pycom's libraries can use a constant declared in
+# a class body without the class name. This loader does the same by adding
+# every const() name to the module's globals before running it.
+class ConstLoader(importlib.machinery.SourceFileLoader):
+
+    def exec_module(self, module):
+        source = self.get_data(self.get_filename(module.__name__))
+        if b"const(" in source:
+            for node in ast.walk(ast.parse(source)):
+                if (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)
+                        and getattr(node.value.func, "id", None) == "const"):
+                    value = eval(compile(ast.Expression(node.value.args[0]), "<const>", "eval"), module.__dict__)
+                    for target in node.targets:
+                        if isinstance(target, ast.Name):
+                            module.__dict__[target.id] = value
+        super().exec_module(module)
+
+
+# Only for the device scripts' folders, everything else imports as usual
+PHASE5 = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_const_finder = importlib.machinery.FileFinder.path_hook((ConstLoader, [".py"]))
+
+
+def _const_hook(path):
+    if not os.path.abspath(path).startswith(PHASE5):
+        raise ImportError
+    return _const_finder(path)
+
+
+sys.path_hooks.insert(0, _const_hook)
+sys.path_importer_cache.clear()
+
+
+# Used by any thread that hasn't been given a board
+default = Board("Board")
+
+
+def current():
+    return getattr(_local, "board", default)
+
+
+# Files under /flash go to a temporary folder of the calling thread's board,
+# so each board has its own flash and nothing is written to the real /flash
+def flash_path(path):
+    if not isinstance(path, str) or not (path == "/flash" or path.startswith("/flash/")):
+        return path
+    board = current()
+    if board.flash is None:
+        board.flash = tempfile.mkdtemp(prefix="flash_{}_".format(board.name))
+    return board.flash + path[len("/flash"):]
+
+
+def _on_flash(function):
+    def wrapper(path, *args, **kwargs):
+        return function(flash_path(path), *args, **kwargs)
+    return wrapper
+
+
+builtins.open = _on_flash(builtins.open)
+for _name in ("remove", "stat", "listdir", "mkdir"):
+    setattr(os, _name, _on_flash(getattr(os, _name)))
+_rename = os.rename
+os.rename = lambda source, destination: _rename(flash_path(source), flash_path(destination))
+
+
+# Throw away the boards' flash folders
+def erase_flash(*boards):
+    for board in boards:
+        if board.flash:
+            shutil.rmtree(board.flash, ignore_errors=True)
+            board.flash = None
+
+
+# Puts "[board name] " in front of each line printed by a board's thread
+class PrefixedOutput:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.partial = {}
+
+    def write(self, text):
+        board = current()
+        if board is default:
+            return self.stream.write(text)
+        # Hold each board's text until its line is finished, so lines
+        # printed by different boards at the same time don't mix
+        with self.lock:
+            lines = (self.partial.get(board, "") + text).split("\n")
+            for line in lines[:-1]:
+                self.stream.write("[{}] {}\n".format(board.name, line))
+            self.partial[board] = lines[-1]
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
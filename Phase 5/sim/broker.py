@@ -0,0 +1,245 @@
+# A small MQTT broker stand-in for testing the gateway off-device.
+# It runs on 127.0.0.1 in background threads and remembers what was published.
+import time
+import random
+import socket
+import struct
+import threading
+
+
+class Broker:
+
+    # latency: seconds before anything the broker sends reaches the client
+    # drop_acks: chance of a PUBACK, PUBREC or PUBCOMP being lost on the way
+    def __init__(self, latency=0.0, drop_acks=0.0):
+        self.latency = latency
+        self.drop_acks = drop_acks
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(8)
+        self.port = self.server.getsockname()[1]
+        self.clients = []
+        self.lock = threading.Lock()
+        # (time received, topic, message, qos) for every PUBLISH
+        self.published = []
+        # Number of recv() chunks the broker saw, roughly TCP segments
+        self.segments = 0
+        # PUBLISHes that arrived with the DUP flag set
+        self.duplicates = 0
+        # Client id: ids of QoS 2 PUBLISHes received but not yet released,
+        # and client id: topics subscribed to. Kept across connections
+        # unless the client asks for a clean session.
+        self.sessions = {}
+        self.subscriptions = {}
+        # Faults to inject. While 'refuse' is set new connections are
+        # closed straight away. While 'silent' is set the broker ignores
+        # everything and sends nothing, like a connection that died
+        # without being closed.
+        self.refuse = False
+        self.silent = False
+        self.connects = 0
+        # PINGREQs received, and connections closed because the client
+        # sent nothing for 1.5 times its keepalive
+        self.pings = 0
+        self.expired = 0
+        self.running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.running = False
+        self.server.close()
+        self.drop_clients()
+
+    # Close every client connection, as if the network went down
+    def drop_clients(self):
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
+
+    # Send a message to every client subscribed to 'topic'
+    def publish(self, topic, msg, qos=0, pid=1, dup=False):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        body = struct.pack("!H", len(topic)) + topic
+        if qos:
+            body += struct.pack("!H", pid)
+        packet = _packet(0x30 | dup << 3 | qos << 1, body + msg)
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            if topic in client.subscriptions:
+                client.send(packet)
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                return
+            if self.refuse:
+                conn.close()
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(self, conn)
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=client.run, daemon=True).start()
+
+
+def _packet(header, body):
+    size = len(body)
+    length = bytearray()
+    while True:
+        byte = size & 0x7F
+        size >>= 7
+        length.append(byte | 0x80 if size else byte)
+        if not size:
+            return bytes([header]) + bytes(length) + body
+
+
+class _Client:
+
+    def __init__(self, broker, conn):
+        self.broker = broker
+        self.conn = conn
+        self.buffer = b""
+        self.subscriptions = set()
+        self.unreleased = set()
+        self.send_lock = threading.Lock()
+        self.delayed = []
+        self.delayed_ready = threading.Condition()
+        if broker.latency:
+            threading.Thread(target=self._send_delayed, daemon=True).start()
+
+    def send(self, data):
+        if self.broker.latency:
+            with self.delayed_ready:
+                self.delayed.append((time.perf_counter() + self.broker.latency, data))
+                self.delayed_ready.notify()
+            return
+        self._send(data)
+
+    # Sends what send() queued once its latency has passed, in order
+    def _send_delayed(self):
+        while True:
+            with self.delayed_ready:
+                while not self.delayed:
+                    self.delayed_ready.wait()
+                due, data = self.delayed.pop(0)
+            time.sleep(max(0.0, due - time.perf_counter()))
+            self._send(data)
+
+    def _send(self, data):
+        if self.broker.silent:
+            return
+        with self.send_lock:
+            try:
+                self.conn.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def _read(self, size):
+        while len(self.buffer) < size:
+            chunk = self.conn.recv(4096)
+            if not chunk:
+                raise EOFError
+            self.broker.segments += 1
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def run(self):
+        try:
+            while True:
+                header = self._read(1)[0]
+                size = 0
+                shift = 0
+                while True:
+                    byte = self._read(1)[0]
+                    size |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                self._handle(header, self._read(size))
+        except socket.timeout:
+            self.broker.expired += 1
+        except (EOFError, OSError):
+            pass
+        with self.broker.lock:
+            if self in self.broker.clients:
+                self.broker.clients.remove(self)
+        self.conn.close()
+
+    def _ack(self, kind, pid):
+        if random.random() >= self.broker.drop_acks:
+            self.send(bytes([kind, 2]) + pid)
+
+    def _handle(self, header, body):
+        if self.broker.silent:
+            return
+        kind = header & 0xF0
+        if kind == 0x10:    # CONNECT
+            clean = body[7] & 2
+            client_id = body[12:12 + struct.unpack("!H", body[10:12])[0]]
+            present = client_id in self.broker.sessions and not clean
+            if not present:
+                self.broker.sessions[client_id] = set()
+                self.broker.subscriptions[client_id] = set()
+            self.unreleased = self.broker.sessions[client_id]
+            self.subscriptions = self.broker.subscriptions[client_id]
+            self.broker.connects += 1
+            keepalive = struct.unpack("!H", body[8:10])[0]
+            if keepalive:
+                self.conn.settimeout(keepalive * 1.5)
+            self.send(b"\x20\x02" + bytes([present]) + b"\x00")
+        elif kind == 0x30:  # PUBLISH
+            qos = (header >> 1) & 3
+            if header & 8:
+                self.broker.duplicates += 1
+            topic_len = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + topic_len].decode()
+            pos = 2 + topic_len
+            if qos:
+                pid = body[pos:pos + 2]
+                pos += 2
+            # A QoS 2 message is only passed on once, however often it's sent
+            if qos < 2 or pid not in self.unreleased:
+                self.broker.published.append((time.perf_counter(), topic, body[pos:], qos))
+            if qos == 1:
+                self._ack(0x40, pid)
+            elif qos == 2:
+                self.unreleased.add(pid)
+                self._ack(0x50, pid)
+        elif kind == 0x50:  # PUBREC, for a QoS 2 message the broker sent
+            self.send(b"\x62\x02" + body[:2])
+        elif kind == 0x60:  # PUBREL
+            self.unreleased.discard(body[:2])
+            self._ack(0x70, body[:2])
+        elif kind == 0x70:  # PUBCOMP
+            pass
+        elif kind == 0x80:  # SUBSCRIBE
+            pos = 2
+            codes = b""
+            while pos < len(body):
+                topic_len = struct.unpack("!H", body[pos:pos + 2])[0]
+                self.subscriptions.add(body[pos + 2:pos + 2 + topic_len])
+                pos += 2 + topic_len
+                codes += body[pos:pos + 1]
+                pos += 1
+            self.send(_packet(0x90, body[:2] + codes))
+        elif kind == 0xC0:  # PINGREQ
+            self.broker.pings += 1
+            self.send(b"\xd0\x00")
+        elif kind == 0xE0:  # DISCONNECT
+            raise EOFError
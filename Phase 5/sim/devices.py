@@ -0,0 +1,225 @@
+# I2C device models for a simulated Pysense board.
+# Add them to a Board's devices by I2C address, e.g. pysense_devices().
+# Sensor readings are functions with no arguments, so they can change
+# over time.
+import math
+import time
+import random
+
+
+def pysense_devices(temperature=None, humidity=None, lux=None):
+    return {
+        0x08: PIC(),
+        0x40: SI7006A20(temperature, humidity),
+        0x29: LTR329ALS01(lux),
+    }
+
+
+# CRC-8 used by the SI7006-A20: polynomial x^8 + x^5 + x^4 + 1, initial value 0
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for i in range(8):
+            crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+# Default sensor readings: a slow daily-looking cycle
+def _default_temperature():
+    return 22.0 + 3.0 * math.sin(time.monotonic() / 60.0)
+
+
+def _default_humidity():
+    return 55.0 + 10.0 * math.cos(time.monotonic() / 90.0)
+
+
+# The Pysense's PIC co-processor (see pycoproc.py for the protocol).
+# After each command the PIC is busy for 'busy_reads' status reads, then
+# answers with 0xFF followed by the result.
+class PIC:
+
+    FW_VERSION = 10
+    HW_VERSION = 3
+    PRODUCT_ID = 0xEF   # Pysense
+
+    def __init__(self, busy_reads=1, clock_error=1.0):
+        self.memory = {}
+        self.busy_reads = busy_reads
+        self.busy = 0
+        self.response = b""
+        # How fast the PIC's RTC runs compared to real time
+        self.clock_error = clock_error
+        self.sleep_time = None
+        self.asleep = False
+        self.commands = 0
+
+    def peek(self, addr):
+        return self.memory.get(addr, 0)
+
+    def write(self, data):
+        self.commands += 1
+        self.busy = self.busy_reads
+        command = data[0]
+        self.response = b""
+        if command == 0x00:     # PEEK
+            self.response = bytes([self.peek(data[1] | data[2] << 8)])
+        elif command == 0x01:   # POKE
+            self.memory[data[1] | data[2] << 8] = data[3]
+        elif command == 0x02:   # MAGIC: (value & AND | OR) ^ XOR
+            addr = data[1] | data[2] << 8
+            value = ((self.peek(addr) & data[3]) | data[4]) ^ data[5]
+            self.memory[addr] = value
+            self.response = bytes([value])
+        elif command == 0x10:
+            self.response = bytes([self.HW_VERSION, 0])
+        elif command == 0x11:
+            self.response = bytes([self.FW_VERSION, 0])
+        elif command == 0x12:
+            self.response = bytes([self.PRODUCT_ID, 0])
+        elif command == 0x20:   # SETUP_SLEEP
+            self.sleep_time = data[1] | data[2] << 8 | data[3] << 16
+        elif command == 0x21:   # GO_SLEEP
+            self.asleep = True
+
+    def read(self, size):
+        if self.busy > 0:
+            self.busy -= 1
+            return bytes(size)
+        return (b"\xff" + self.response + bytes(size))[:size]
+
+    # Real seconds the sleep set up with SETUP_SLEEP lasts: the PIC counts
+    # in ticks of its RTC, which runs clock_error times fast
+    def sleep_seconds(self):
+        return (self.sleep_time or 0) / (self.clock_error * 1000 / 1024)
+
+    # The sleep has ended. The wake reason and time left (0x064C on) say so.
+    def wake(self, reason=4):
+        self.asleep = False
+        self.memory[0x064C] = reason
+        for addr in (0x064D, 0x064E, 0x064F):
+            self.memory[addr] = 0
+
+    # RTC pulse timestamps (microseconds) for Pycoproc.calibrate_rtc()
+    def pulses(self):
+        period = 7000 / self.clock_error
+        return [(i & 1, int(i * period)) for i in range(100)]
+
+
+# SI7006-A20 temperature and humidity sensor.
+# A "no hold master" measurement NACKs reads until it has finished converting.
+class SI7006A20:
+
+    RH_CONVERSION = 0.012       # seconds, RH measurement includes a temperature
+    TEMP_CONVERSION = 0.007
+
+    def __init__(self, temperature=None, humidity=None):
+        self.temperature = temperature or _default_temperature
+        self.humidity = humidity or _default_humidity
+        self.ready_at = 0
+        self.response = b""
+        self.last_temperature_code = 0
+        # Probability that a read has a flipped bit, to test CRC checking
+        self.corrupt_rate = 0.0
+        self.conversions = 0
+
+    def _temperature_code(self):
+        return int((self.temperature() + 46.85) * 65536 / 175.72) & 0xFFFC
+
+    def _humidity_code(self):
+        return int((self.humidity() + 6.0) * 65536 / 125.0) & 0xFFFC
+
+    def _with_crc(self, code):
+        data = bytes([code >> 8, code & 0xFF])
+        return data + bytes([crc8(data)])
+
+    def write(self, data):
+        command = data[0]
+        now = time.monotonic()
+        if command in (0xF5, 0xE5):     # Measure RH (no hold / hold)
+            self.conversions += 1
+            self.last_temperature_code = self._temperature_code()
+            self.response = self._with_crc(self._humidity_code())
+            self.ready_at = now + (self.RH_CONVERSION if command == 0xF5 else 0)
+        elif command in (0xF3, 0xE3):   # Measure temperature
+            self.conversions += 1
+            self.last_temperature_code = self._temperature_code()
+            self.response = self._with_crc(self.last_temperature_code)
+            self.ready_at = now + (self.TEMP_CONVERSION if command == 0xF3 else 0)
+        elif command == 0xE0:           # Temperature from the previous RH measurement
+            code = self.last_temperature_code
+            self.response = bytes([code >> 8, code & 0xFF])
+        elif command == 0xE7:
+            self.response = b"\x3a"
+        elif command == 0x11:
+            self.response = b"\x00"
+        elif command == 0xFA:
+            self.response = b"\x06\x00\x00\x00"
+        elif command == 0xFC:
+            self.response = b"\x06\x00\x00\x00"
+        elif command == 0x84:
+            self.response = b"\x20"
+        else:
+            self.response = b""
+
+    def read(self, size):
+        if time.monotonic() < self.ready_at:
+            raise OSError("I2C bus error")     # NACK: still converting
+        data = bytearray((self.response + bytes(size))[:size])
+        if self.corrupt_rate and size > 0 and random.random() < self.corrupt_rate:
+            data[0] ^= 0x10
+        return bytes(data)
+
+
+# LTR-329ALS-01 ambient light sensor. Registers auto-increment on reads.
+# After the gain or integration time is changed, the data keeps the old
+# settings until a measurement with the new ones has finished. The status
+# register (0x8C) has the gain the data was measured with and a new data
+# flag, cleared by reading the data.
+class LTR329ALS01:
+
+    GAINS = {0: 1, 1: 2, 2: 4, 3: 8, 6: 48, 7: 96}
+    INTEGRATION_MS = {0: 100, 1: 50, 2: 200, 3: 400, 4: 150, 5: 250, 6: 300, 7: 350}
+    # Infrared (CH1) compared to visible+IR (CH0), like indoor lighting
+    IR_RATIO = 0.3
+
+    def __init__(self, lux=None):
+        self.lux = lux or (lambda: 300.0)
+        self.registers = {0x80: 0x00, 0x85: 0x03, 0x86: 0xA0, 0x87: 0x05, 0x8C: 0x00}
+        self.pointer = 0
+        self.measured = (0x00, 0x03)    # control and rate registers the data was measured with
+        self.ready_at = 0
+        self.new_data = True
+
+    def _counts(self):
+        gain = self.GAINS.get((self.measured[0] >> 2) & 0x07, 1)
+        integration = self.INTEGRATION_MS[(self.measured[1] >> 3) & 0x07] / 100
+        # Inverse of the datasheet lux formula for ratio < 0.45
+        ratio = self.IR_RATIO / (1 - self.IR_RATIO)
+        ch0 = self.lux() * gain * integration / (1.7743 + 1.1059 * ratio)
+        ch1 = ch0 * ratio
+        return min(int(ch0), 0xFFFF), min(int(ch1), 0xFFFF)
+
+    def write(self, data):
+        self.pointer = data[0]
+        for offset, value in enumerate(data[1:]):
+            self.registers[self.pointer + offset] = value
+            if self.pointer + offset in (0x80, 0x85):
+                integration = self.INTEGRATION_MS[(self.registers[0x85] >> 3) & 0x07]
+                self.ready_at = time.monotonic() + integration / 1000
+
+    def read(self, size):
+        if time.monotonic() >= self.ready_at and self.measured != (self.registers[0x80], self.registers[0x85]):
+            self.measured = (self.registers[0x80], self.registers[0x85])
+            self.new_data = True
+        ch0, ch1 = self._counts()
+        self.registers[0x88] = ch1 & 0xFF
+        self.registers[0x89] = ch1 >> 8
+        self.registers[0x8A] = ch0 & 0xFF
+        self.registers[0x8B] = ch0 >> 8
+        self.registers[0x8C] = (((self.measured[0] >> 2) & 0x07) << 4) | (0x04 if self.new_data else 0)
+        data = bytes([self.registers.get(self.pointer + i, 0) for i in range(size)])
+        if self.pointer <= 0x8B and self.pointer + size > 0x88:
+            self.new_data = False
+        self.pointer += size
+        return data
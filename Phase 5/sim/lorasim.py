@@ -0,0 +1,344 @@
+# Host-side LoRa network simulator.
+#
+# A Channel carries packages between radios with the physics that decide
+# whether a real package gets through:
+#   - path loss with distance (log-distance model from LoRaSim, Bor et al.)
+#   - the receiver's sensitivity for the spreading factor
+#   - collisions: packages on the same frequency and spreading factor that
+#     overlap in time, unless one is CAPTURE dB stronger than the other
+#   - half duplex: a radio can't hear anything while it is transmitting
+#   - IQ: a node (tx_iq=True) is only heard by the gateway (rx_iq=True)
+#     and the other way round, like loraAPI sets up
+#
+# It runs in two ways:
+#
+#   python lorasim.py scripts [seconds]
+#       Runs ../gateway/gateway.py, ../node1/node1.py and ../node2/node2.py
+#       unchanged, each on its own simulated board (board.py), over the
+#       channel in real time. The gateway talks to the local MQTT broker
+#       stand-in (broker.py) instead of io.adafruit.com.
+#
+#   python lorasim.py scale [nodes] [seconds]
+#       Discrete-event run of thousands of simple nodes sending to one
+#       gateway. Simulated time, so an hour of traffic takes seconds.
+import os
+import sys
+import math
+import time
+import heapq
+import random
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+
+import board
+from lora_airtime import time_on_air
+
+# Log-distance path loss: PL(d) = PATH_LOSS_D0 + 10 * GAMMA * log10(d / D0)
+D0 = 40.0               # metres
+PATH_LOSS_D0 = 127.41   # dB
+GAMMA = 2.08
+
+# SX1276 sensitivity at 125 kHz for each spreading factor (dBm)
+SENSITIVITY = {7: -123.0, 8: -126.0, 9: -129.0, 10: -132.0, 11: -134.5, 12: -137.0}
+NOISE_FLOOR = -117.0    # dBm, 125 kHz with a 6 dB noise figure
+CAPTURE = 6.0           # dB a package must beat each interferer by to survive
+
+
+def path_loss(a, b):
+    distance = max(math.hypot(a[0] - b[0], a[1] - b[1]), 1.0)
+    return PATH_LOSS_D0 + 10 * GAMMA * math.log10(distance / D0)
+
+
+# Runs things at a time. now() is in seconds.
+class RealTimeScheduler:
+
+    def __init__(self):
+        self.events = []
+        self.count = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="channel", daemon=True)
+        self.thread.start()
+
+    def now(self):
+        return time.monotonic()
+
+    def at(self, when, action):
+        with self.condition:
+            self.count += 1
+            heapq.heappush(self.events, (when, self.count, action))
+            self.condition.notify()
+
+    # A blocking send on a real radio returns when the package is sent
+    def wait_until(self, when):
+        if threading.current_thread() is not self.thread:
+            time.sleep(max(0.0, when - self.now()))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.events or self.events[0][0] > self.now():
+                    self.condition.wait(self.events[0][0] - self.now() if self.events else None)
+                when, count, action = heapq.heappop(self.events)
+            action()
+
+
+class EventScheduler:
+
+    def __init__(self):
+        self.events = []
+        self.count = 0
+        self.time = 0.0
+
+    def now(self):
+        return self.time
+
+    def at(self, when, action):
+        self.count += 1
+        heapq.heappush(self.events, (when, self.count, action))
+
+    def wait_until(self, when):
+        pass
+
+    def run(self, until):
+        while self.events and self.events[0][0] <= until:
+            self.time, count, action = heapq.heappop(self.events)
+            action()
+        self.time = until
+
+
+class Transmission:
+
+    def __init__(self, radio, package, start, end):
+        self.radio = radio
+        self.package = package
+        self.start = start
+        self.end = end
+        self.frequency = radio.frequency()
+        self.sf = radio.sf()
+        self.iq = radio.tx_iq
+
+
+class Channel:
+
+    def __init__(self, scheduler=None, capture=CAPTURE):
+        self.scheduler = scheduler or RealTimeScheduler()
+        self.capture = capture
+        self.radios = []
+        self.receivers = []
+        self.on_air = []
+        self.busy_until = {}
+        self.lock = threading.RLock()
+        self.stats = {"sent": 0, "delivered": 0, "collided": 0, "too_weak": 0, "half_duplex": 0}
+
+    # Radios that only transmit (receives=False) aren't checked for each
+    # package, which keeps runs with thousands of nodes quick
+    def join(self, radio):
+        with self.lock:
+            self.radios.append(radio)
+            if getattr(radio, "receives", True):
+                self.receivers.append(radio)
+
+    # A board going into deep sleep takes its radio with it
+    def leave(self, radio):
+        with self.lock:
+            if radio in self.radios:
+                self.radios.remove(radio)
+            if radio in self.receivers:
+                self.receivers.remove(radio)
+            self.busy_until.pop(radio, None)
+
+    def rssi(self, sender, receiver):
+        return sender.tx_power - path_loss(sender.position, receiver.position)
+
+    # Called by a radio to send a package. Returns when it is off the air.
+    # A radio sends one package at a time, so one sent while it's still
+    # sending (e.g. from a receive callback) goes out after it.
+    def transmit(self, radio, package):
+        with self.lock:
+            now = max(self.scheduler.now(), self.busy_until.get(radio, 0.0))
+            sending = Transmission(radio, package, now, now + radio.airtime(len(package)) / 1000)
+            self.busy_until[radio] = sending.end
+            self.on_air.append(sending)
+            self.stats["sent"] += 1
+        self.scheduler.at(sending.end, lambda: self._finish(sending))
+        self.scheduler.wait_until(sending.end)
+        return sending.end
+
+    def _finish(self, sending):
+        deliveries = []
+        with self.lock:
+            for radio in self.receivers:
+                if radio is sending.radio:
+                    continue
+                if radio.rx_iq != sending.iq or radio.frequency() != sending.frequency or radio.sf() != sending.sf:
+                    continue
+                rssi = self.rssi(sending.radio, radio)
+                if rssi < SENSITIVITY[sending.sf]:
+                    self.stats["too_weak"] += 1
+                    continue
+                result = self._interference(sending, radio, rssi)
+                self.stats[result] += 1
+                if result == "delivered":
+                    deliveries.append((radio, rssi))
+            # Forget packages that ended before everything still on the air
+            # began, they can't overlap anything else
+            now = sending.end
+            earliest = min([t.start for t in self.on_air if t.end > now] or [now])
+            self.on_air = [t for t in self.on_air if t.end > earliest]
+        finished = getattr(sending.radio, "transmitted", None)
+        if finished is not None:
+            finished()
+        for radio, rssi in deliveries:
+            radio.deliver(sending.package, round(rssi), round(rssi - NOISE_FLOOR))
+
+    def _interference(self, sending, receiver, rssi):
+        for other in self.on_air:
+            if other is sending or other.end <= sending.start or other.start >= sending.end:
+                continue
+            if other.radio is receiver:
+                return "half_duplex"
+            if other.frequency == sending.frequency and other.sf == sending.sf:
+                if rssi - self.rssi(other.radio, receiver) < self.capture:
+                    return "collided"
+        return "delivered"
+
+
+# A bare radio for discrete-event runs, without a script or loraAPI behind it
+class SimRadio:
+
+    def __init__(self, channel, position, frequency=916800000, sf=7, tx_iq=True, rx_iq=False, receives=True):
+        self.channel = channel
+        self.position = position
+        self._frequency = frequency
+        self._sf = sf
+        self.tx_iq = tx_iq
+        self.rx_iq = rx_iq
+        self.tx_power = 14
+        self.receives = receives
+        self.received = []
+        channel.join(self)
+
+    def frequency(self):
+        return self._frequency
+
+    def sf(self):
+        return self._sf
+
+    def airtime(self, length):
+        return time_on_air(length, self._sf)
+
+    def send(self, package):
+        return self.channel.transmit(self, package)
+
+    def deliver(self, package, rssi, snr):
+        self.received.append((self.channel.scheduler.now(), package, rssi, snr))
+
+
+# Nodes spread evenly over a disc around one gateway, each sending a package
+# of 'payload' bytes every 'interval' seconds on average (exponential gaps).
+# Spreading factors go up with distance so every node can reach the gateway.
+def simulate(nodes=1000, duration=3600, interval=600, payload=20, radius=100, sf=None, seed=1):
+    rng = random.Random(seed)
+    scheduler = EventScheduler()
+    channel = Channel(scheduler)
+    gateway = SimRadio(channel, (0.0, 0.0), sf=7, tx_iq=False, rx_iq=True)
+    gateways = {7: gateway}
+    radios = []
+    for i in range(nodes):
+        distance = radius * math.sqrt(rng.random())
+        angle = rng.random() * 2 * math.pi
+        position = (distance * math.cos(angle), distance * math.sin(angle))
+        node_sf = sf
+        if node_sf is None:
+            node_sf = 12
+            for option in range(7, 13):
+                if 14 - path_loss(position, (0.0, 0.0)) >= SENSITIVITY[option]:
+                    node_sf = option
+                    break
+        # One gateway demodulator per spreading factor in use
+        if node_sf not in gateways:
+            gateways[node_sf] = SimRadio(channel, (0.0, 0.0), sf=node_sf, tx_iq=False, rx_iq=True)
+        radios.append(SimRadio(channel, position, sf=node_sf, receives=False))
+
+    package = bytes(payload)
+
+    def send(radio):
+        radio.send(package)
+        scheduler.at(scheduler.now() + rng.expovariate(1.0 / interval), lambda: send(radio))
+
+    for radio in radios:
+        scheduler.at(rng.uniform(0, interval), lambda radio=radio: send(radio))
+
+    started = time.perf_counter()
+    scheduler.run(duration)
+    elapsed = time.perf_counter() - started
+    received = sum(len(g.received) for g in gateways.values())
+    return {
+        "nodes": nodes,
+        "sent": channel.stats["sent"],
+        "received": received,
+        "collided": channel.stats["collided"],
+        "too_weak": channel.stats["too_weak"],
+        "delivery_ratio": received / channel.stats["sent"] if channel.stats["sent"] else 0.0,
+        "events": scheduler.count,
+        "wall_seconds": elapsed,
+    }
+
+
+# Runs the Phase 5 scripts unchanged, each on its own board
+def run_scripts(duration=30, control_at=15):
+    import usocket
+    import devices
+    from broker import Broker
+
+    broker = Broker()
+    usocket.redirect["io.adafruit.com"] = ("127.0.0.1", broker.port)
+    channel = Channel()
+    phase5 = os.path.join(HERE, "..")
+    boards = [
+        (board.Board("gateway", (0.0, 0.0), channel), "gateway/gateway.py"),
+        (board.Board("node1", (30.0, 0.0), channel, devices.pysense_devices()), "node1/node1.py"),
+        (board.Board("node2", (0.0, 50.0), channel), "node2/node2.py"),
+    ]
+    sys.stdout = board.PrefixedOutput(sys.stdout)
+    for b, script in boards:
+        b.start(os.path.join(phase5, script))
+        # Let each script set itself up before the next one starts
+        time.sleep(0.5)
+
+    gateway = boards[0][0]
+    stop = time.monotonic() + duration
+    control_sent = False
+    while time.monotonic() < stop:
+        time.sleep(0.1)
+        if not control_sent and time.monotonic() > stop - duration + control_at:
+            broker.publish(gateway.namespace["AIO_CONTROL_FEED"], b"1")
+            control_sent = True
+
+    sys.stdout = sys.stdout.stream
+    print()
+    print("Channel:", channel.stats)
+    for b, script in boards:
+        print("{:8} {}".format(b.name, "error: {!r}".format(b.error) if b.error else "running"))
+    print("Published to the broker:")
+    for when, topic, msg, qos in broker.published:
+        print("  {:40} {}".format(topic, msg.decode()))
+    broker.close()
+    board.erase_flash(*[b for b, script in boards])
+    return channel, broker
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "scripts"
+    if mode == "scale":
+        nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        duration = float(sys.argv[3]) if len(sys.argv) > 3 else 3600
+        print("{:>6} {:>8} {:>8} {:>8} {:>9} {:>8}".format("nodes", "sent", "received", "collided", "delivery", "wall s"))
+        for n in sorted(set([n for n in (10, 100, nodes) if n <= nodes])):
+            r = simulate(n, duration)
+            print("{nodes:6} {sent:8} {received:8} {collided:8} {delivery_ratio:9.3f} {wall_seconds:8.2f}".format(**r))
+    else:
+        run_scripts(float(sys.argv[2]) if len(sys.argv) > 2 else 30)
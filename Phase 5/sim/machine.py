@@ -0,0 +1,151 @@
+# Stand-in for the Pycom firmware 'machine' module.
+# Hardware belongs to the calling thread's simulated board (see board.py).
+import time
+import random
+import builtins
+
+import board
+
+# MicroPython's const() marks constants for its compiler
+if not hasattr(builtins, "const"):
+    builtins.const = lambda value: value
+
+# MicroPython's time module has millisecond/microsecond tick counters.
+# Every Pycom script imports machine, so add them to time here.
+if not hasattr(time, "ticks_ms"):
+    time.ticks_ms = lambda: int(time.monotonic() * 1000)
+    time.ticks_us = lambda: int(time.monotonic() * 1000000)
+    time.ticks_diff = lambda new, old: new - old
+    time.ticks_add = lambda ticks, delta: ticks + delta
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+
+
+class Timer:
+
+    class Chrono:
+
+        def __init__(self):
+            self._start = None
+            self._elapsed = 0.0
+
+        def start(self):
+            self._start = time.monotonic()
+
+        def stop(self):
+            self._elapsed = self.read()
+            self._start = None
+
+        def reset(self):
+            self._elapsed = 0.0
+            if self._start is not None:
+                self._start = time.monotonic()
+
+        def read(self):
+            if self._start is None:
+                return self._elapsed
+            return self._elapsed + time.monotonic() - self._start
+
+        def read_ms(self):
+            return self.read() * 1000
+
+
+def idle():
+    time.sleep(0)
+
+
+def unique_id():
+    return board.current().unique_id
+
+
+# 24 random bits from the hardware random number generator
+def rng():
+    return random.getrandbits(24)
+
+
+class Pin:
+
+    IN = 1
+    OUT = 2
+    OPEN_DRAIN = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=IN, pull=None, value=None, **kwargs):
+        self.id = id
+        self._value = 0
+        self.init(mode, pull, value)
+        # The Pysense's PIC keeps the board powered through P3
+        if id == "P3" and mode == Pin.OUT and value == 0:
+            board.current().power_off()
+
+    def init(self, mode=IN, pull=None, value=None, **kwargs):
+        self.mode = mode
+        if value is not None:
+            self._value = value
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+
+# I2C bus. Transfers go to the device models on the board (devices.py).
+# A missing or busy device raises OSError, like a NACK on the real bus.
+class I2C:
+
+    MASTER = 0
+
+    def __init__(self, bus=0, mode=MASTER, pins=None, baudrate=100000):
+        self.board = board.current()
+        # Every transfer, for counting round trips: (kind, address, bytes)
+        self.transactions = []
+        # Probability that a transfer fails (NACK, noise on the bus)
+        self.error_rate = 0.0
+        self.init(mode, pins=pins, baudrate=baudrate)
+
+    def init(self, mode=MASTER, pins=None, baudrate=100000):
+        self.enabled = True
+
+    def deinit(self):
+        self.enabled = False
+
+    def _device(self, addr, kind, size):
+        if not self.enabled:
+            raise OSError("I2C bus not initialised")
+        self.transactions.append((kind, addr, size))
+        if self.error_rate and random.random() < self.error_rate:
+            raise OSError("I2C bus error")
+        try:
+            return self.board.devices[addr]
+        except KeyError:
+            raise OSError("I2C bus error")
+
+    def scan(self):
+        return sorted(self.board.devices)
+
+    def writeto(self, addr, buf, stop=True):
+        self._device(addr, "write", len(buf)).write(bytes(buf))
+        return len(buf)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        return bytes(self._device(addr, "read", nbytes).read(nbytes))
+
+    def readfrom_into(self, addr, buf, stop=True):
+        buf[:] = self._device(addr, "read", len(buf)).read(len(buf))
+
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        self._device(addr, "write", 1 + len(buf)).write(bytes([memaddr]) + bytes(buf))
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        device = self._device(addr, "write+read", 1 + nbytes)
+        device.write(bytes([memaddr]))
+        return bytes(device.read(nbytes))
+
+    def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+        device = self._device(addr, "write+read", 1 + len(buf))
+        device.write(bytes([memaddr]))
+        buf[:] = device.read(len(buf))
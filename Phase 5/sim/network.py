@@ -0,0 +1,214 @@
+# Stand-in for the Pycom firmware 'network' module.
+#
+# On a Pycom board socket.socket(socket.AF_LORA, socket.SOCK_RAW) opens the
+# LoRa radio. Importing this module adds the same to Python's socket module.
+# The socket is attached to the last LoRa object made on the calling
+# thread's board (see board.py). If the board is on a simulated channel
+# (see lorasim.py) packages go over it, otherwise they are only recorded
+# in LoRaSocket.sent and arrive through LoRaSocket.inject().
+import socket
+import threading
+
+import board
+from lora_airtime import time_on_air
+
+
+class LoRa:
+
+    LORA = 0
+    LORAWAN = 1
+
+    AS923 = 1
+    AU915 = 2
+    EU868 = 5
+    US915 = 8
+
+    RX_PACKET_EVENT = 1
+    TX_PACKET_EVENT = 2
+    TX_FAILED_EVENT = 4
+
+    BW_125KHZ = 0
+    BW_250KHZ = 1
+    BW_500KHZ = 2
+
+    CODING_4_5 = 1
+    CODING_4_6 = 2
+    CODING_4_7 = 3
+    CODING_4_8 = 4
+
+    # Default frequency for each region in raw LoRa mode
+    FREQUENCIES = {AS923: 923200000, AU915: 916800000, EU868: 868000000, US915: 903900000}
+    BANDWIDTHS = {BW_125KHZ: 125000, BW_250KHZ: 250000, BW_500KHZ: 500000}
+
+    def __init__(self, mode=LORA, region=EU868, rx_iq=False, tx_iq=False, frequency=None,
+                 sf=7, bandwidth=BW_125KHZ, coding_rate=CODING_4_5, preamble=8, tx_power=14, **kwargs):
+        self.mode = mode
+        self.region = region
+        self.rx_iq = rx_iq
+        self.tx_iq = tx_iq
+        self.tx_power = tx_power
+        self._frequency = frequency or LoRa.FREQUENCIES[region]
+        self._sf = sf
+        self._bandwidth = bandwidth
+        self._coding_rate = coding_rate
+        self._preamble = preamble
+        self._trigger = 0
+        self._handler = None
+        self._events = 0
+        self._lock = threading.Lock()
+        self._stats = LoRaStats()
+        self.socket = None
+        self.board = board.current()
+        self.board.lora = self
+        self.board.radio_on()
+        self.channel = self.board.channel
+        if self.channel is not None:
+            self.channel.join(self)
+
+    @property
+    def position(self):
+        return self.board.position
+
+    def frequency(self, value=None):
+        if value is None:
+            return self._frequency
+        self._frequency = value
+
+    def sf(self, value=None):
+        if value is None:
+            return self._sf
+        self._sf = value
+
+    def bandwidth(self, value=None):
+        if value is None:
+            return self._bandwidth
+        self._bandwidth = value
+
+    def coding_rate(self, value=None):
+        if value is None:
+            return self._coding_rate
+        self._coding_rate = value
+
+    def preamble(self, value=None):
+        if value is None:
+            return self._preamble
+        self._preamble = value
+
+    def stats(self):
+        return self._stats
+
+    def callback(self, trigger, handler=None, arg=None):
+        self._trigger = trigger
+        self._handler = handler
+        self._arg = self if arg is None else arg
+
+    def events(self):
+        with self._lock:
+            events = self._events
+            self._events = 0
+        return events
+
+    def _event(self, event):
+        with self._lock:
+            self._events |= event
+        if self._trigger & event and self._handler is not None:
+            self._handler(self._arg)
+
+    # Used by the channel
+    def airtime(self, length):
+        return time_on_air(length, self._sf, LoRa.BANDWIDTHS[self._bandwidth], self._coding_rate, self._preamble)
+
+    def transmitted(self):
+        self._event(LoRa.TX_PACKET_EVENT)
+
+    def deliver(self, package, rssi, snr):
+        # Callbacks run on the channel's thread, as this board
+        self.board.activate()
+        self._stats = LoRaStats(rssi=rssi, snr=snr, sfrx=self._sf)
+        if self.socket is not None:
+            self.socket.inject(package)
+
+
+class LoRaStats:
+
+    def __init__(self, rssi=0, snr=0, sfrx=0):
+        self.rx_timestamp = 0
+        self.rssi = rssi
+        self.snr = snr
+        self.sftx = 0
+        self.sfrx = sfrx
+        self.tx_trials = 0
+
+
+class LoRaSocket:
+
+    def __init__(self, lora):
+        self.lora = lora
+        lora.socket = self
+        self.rx = []
+        self.sent = []
+        self.blocking = True
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def send(self, package):
+        self.sent.append(bytes(package))
+        self.lora.board.airtime += self.lora.airtime(len(package))
+        if self.lora.channel is not None:
+            self.lora.channel.transmit(self.lora, bytes(package))
+        else:
+            self.lora.transmitted()
+        return len(package)
+
+    def recv(self, size):
+        try:
+            return self.rx.pop(0)[:size]
+        except IndexError:
+            return b""
+
+    def close(self):
+        pass
+
+    # Simulation side: a package arrives over the air
+    def inject(self, package):
+        self.rx.append(bytes(package))
+        self.lora._event(LoRa.RX_PACKET_EVENT)
+
+
+class WLAN:
+
+    STA = 1
+    AP = 2
+    WEP = 1
+    WPA = 2
+    WPA2 = 3
+
+    def __init__(self, mode=STA, **kwargs):
+        self.mode = mode
+        self.board = board.current()
+
+    def connect(self, ssid, auth=None, timeout=None, **kwargs):
+        self.ssid = ssid
+
+    def isconnected(self):
+        return self.board.wlan_connected
+
+    def disconnect(self):
+        pass
+
+    def ifconfig(self, *args, **kwargs):
+        return ("192.168.1.10", "255.255.255.0", "192.168.1.1", "192.168.1.1")
+
+
+if not hasattr(socket, "AF_LORA"):
+    socket.AF_LORA = 160
+    socket.SOCK_RAW = getattr(socket, "SOCK_RAW", 3)
+    _socket = socket.socket
+
+    def _lora_socket(family=-1, type=-1, *args, **kwargs):
+        if family == socket.AF_LORA:
+            return LoRaSocket(board.current().lora)
+        return _socket(family, type, *args, **kwargs)
+
+    socket.socket = _lora_socket
@@ -0,0 +1,43 @@
+# Stand-in for the Pycom firmware 'pycom' module.
+# State is kept on the calling thread's simulated board (see board.py).
+import time
+
+import board
+
+
+def heartbeat(state=None):
+    if state is None:
+        return board.current().heartbeat
+    board.current().heartbeat = state
+
+
+def rgbled(colour):
+    board.current().led = colour
+
+
+# Pycoproc.calibrate_rtc() times the PIC's RTC pulses on P21. The PIC model
+# (devices.py) supplies pulses that match its simulated clock error, taking
+# as long as they would to arrive.
+def pulses_get(pin, timeout):
+    for device in board.current().devices.values():
+        if hasattr(device, "pulses"):
+            pulses = device.pulses()
+            time.sleep(pulses[-1][1] / 1000000)
+            return pulses
+    return []
+
+
+# Non-volatile storage: integers by key, kept across deep sleep
+def nvs_set(key, value):
+    board.current().nvs[key] = int(value) & 0xFFFFFFFF
+
+
+def nvs_get(key):
+    try:
+        return board.current().nvs[key]
+    except KeyError:
+        raise ValueError("No matching object for the provided key")
+
+
+def nvs_erase(key):
+    board.current().nvs.pop(key, None)
@@ -0,0 +1,2 @@
+# Stand-in for MicroPython's 'ubinascii' module.
+from binascii import *
@@ -0,0 +1,93 @@
+# Stand-in for MicroPython's 'usocket' module.
+# Wraps a normal socket with MicroPython's stream methods, read() and write().
+import socket as _socket
+
+AF_INET = _socket.AF_INET
+SOCK_STREAM = _socket.SOCK_STREAM
+
+# Host name: (host, port) to use instead, so a script that connects to
+# io.adafruit.com can be pointed at the local broker (see broker.py)
+redirect = {}
+
+
+def getaddrinfo(host, port, *args):
+    if host in redirect:
+        host, port = redirect[host]
+    return _socket.getaddrinfo(host, port, *args)
+
+
+class socket:
+
+    def __init__(self, af=AF_INET, type=SOCK_STREAM, proto=0):
+        self._sock = _socket.socket(af, type, proto)
+        self._sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+        self._blocking = True
+        # Every write() call, for counting how a packet was sent
+        self.writes = []
+        # Number of read()/readinto() and setblocking() calls
+        self.reads = 0
+        self.mode_changes = 0
+
+    def connect(self, addr):
+        self._sock.connect(addr)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def setblocking(self, flag):
+        self.mode_changes += 1
+        self._blocking = flag
+        self._sock.setblocking(flag)
+
+    def settimeout(self, value):
+        self._blocking = value is None or value > 0
+        self._sock.settimeout(value)
+
+    def write(self, buf, length=None):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        data = bytes(memoryview(buf)[:length] if length is not None else buf)
+        self.writes.append(len(data))
+        # Like MicroPython: a non-blocking write sends what it can and
+        # returns how much that was, or None if it couldn't send anything
+        if not self._blocking:
+            try:
+                return self._sock.send(data)
+            except (BlockingIOError, _socket.timeout):
+                return None
+        self._sock.sendall(data)
+        return len(data)
+
+    # Like MicroPython: a non-blocking read returns None when nothing is
+    # waiting, a blocking read waits for all 'size' bytes (or end of stream).
+    def read(self, size):
+        self.reads += 1
+        if not self._blocking:
+            try:
+                return self._sock.recv(size)
+            except (BlockingIOError, _socket.timeout):
+                return None
+        data = b""
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def readinto(self, buf, size=None):
+        size = len(buf) if size is None else size
+        self.reads += 1
+        try:
+            return self._sock.recv_into(buf, size)
+        except (BlockingIOError, _socket.timeout):
+            return None
+
+    def send(self, data):
+        return self.write(data)
+
+    def recv(self, size):
+        return self.read(size)
+
+    def close(self):
+        self._sock.close()